@@ -19,6 +19,7 @@ f,force    ignore existing bloom file and regenerate it from scratch
 o,output=  output bloom filename (default: auto)
 d,dir=     input directory to look for idx files (default: auto)
 k,hashes=  number of hash functions to use (4 or 5) (default: auto)
+format=    bloom format version to write: 2, or 3 for blocked (default: auto)
 c,check=   check the given .idx file against the bloom filter
 """
 
@@ -61,11 +62,18 @@ _first = None
 def do_bloom(path, outfilename):
     global _first
     b = None
+    version = opt.format
     if os.path.exists(outfilename) and not opt.force:
         b = bloom.ShaBloom(outfilename)
         if not b.valid():
             debug1("bloom: Existing invalid bloom found, regenerating.\n")
             b = None
+        elif version and b.version != version:
+            debug1("bloom: converting from v%d to v%d.\n"
+                   % (b.version, version))
+            b = None
+        else:
+            version = b.version
 
     add = []
     rest = []
@@ -117,7 +125,8 @@ def do_bloom(path, outfilename):
     tfname = None
     if b is None:
         tfname = os.path.join(path, 'bup.tmp.bloom')
-        b = bloom.create(tfname, expected=add_count, k=opt.k)
+        b = bloom.create(tfname, expected=add_count, k=opt.k,
+                         version=version or bloom.BLOOM_VERSION)
     count = 0
     icount = 0
     for name in add:
@@ -148,6 +157,9 @@ git.check_repo_or_die()
 
 if not opt.check and opt.k and opt.k not in (4,5):
     o.fatal('only k values of 4 and 5 are supported')
+if opt.format and opt.format not in (bloom.BLOOM_VERSION,
+                                     bloom.BLOCKED_BLOOM_VERSION):
+    o.fatal('only bloom formats 2 and 3 are supported')
 
 paths = opt.dir and [opt.dir] or git.all_packdirs()
 for path in paths:
@@ -158,7 +170,8 @@ for path in paths:
     elif opt.ruin:
         ruin_bloom(outfilename)
     else:
-        do_bloom(path, outfilename)
+        with bloom.locked(path):
+            do_bloom(path, outfilename)
 
 if saved_errors:
     log('WARNING: %d errors encountered during bloom.\n' % len(saved_errors))
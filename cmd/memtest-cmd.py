@@ -7,7 +7,7 @@ exec "$bup_python" "$0" ${1+"$@"}
 
 import sys, re, struct, time, resource
 
-from bup import git, bloom, midx, options, _helpers
+from bup import git, bloom, hashtable, midx, options, _helpers
 from bup.helpers import handle_ctrl_c
 
 
@@ -73,6 +73,8 @@ bup memtest [-n elements] [-c cycles]
 n,number=  number of objects per cycle [10000]
 c,cycles=  number of cycles to run [100]
 ignore-midx  ignore .midx files, use only .idx files
+python-midx  search .midx files in python rather than with _helpers
+hashtable  look objects up in an exact hash table (bup.hashtable) first
 existing   test with existing objects instead of fake ones
 """
 o = options.Options(optspec)
@@ -82,9 +84,13 @@ if extra:
     o.fatal('no arguments expected')
 
 git.ignore_midx = opt.ignore_midx
+midx.native_search = not opt.python_midx
 
 git.check_repo_or_die()
-m = git.PackIdxList(git.repo('objects/pack'))
+if opt.hashtable:
+    m = git.HashedPackIdxList(git.repo('objects/pack'))
+else:
+    m = git.PackIdxList(git.repo('objects/pack'))
 
 report(-1)
 _helpers.random_sha()
@@ -116,12 +122,33 @@ if bloom._total_searches:
     print ('bloom: %d objects searched in %d steps: avg %.3f steps/object' 
            % (bloom._total_searches, bloom._total_steps,
               bloom._total_steps*1.0/bloom._total_searches))
+elapsed = time.time() - start
+if m.bloom and opt.number:
+    # Every random sha the bloom finds is a false positive
+    b = m.bloom
+    shas = [_helpers.random_sha() for i in xrange(opt.number)]
+    bstart = time.time()
+    false_positives = sum(1 for sha in shas if b.exists(sha))
+    bloom_us = (time.time() - bstart) * 1e6 / len(shas)
+    print ('bloom: v%d, k=%d, 2^%d bytes: %.3f%% false positives'
+           ' (expected %.3f%%), %.2fus/lookup'
+           % (b.version, b.k, b.bits, false_positives * 100.0 / len(shas),
+              b.pfalse_positive(), bloom_us))
 if midx._total_searches:
-    print ('midx: %d objects searched in %d steps: avg %.3f steps/object' 
+    print ('midx: %d objects searched in %d steps: avg %.3f steps/object'
+           ', %.0f steps/s'
            % (midx._total_searches, midx._total_steps,
-              midx._total_steps*1.0/midx._total_searches))
+              midx._total_steps*1.0/midx._total_searches,
+              midx._total_steps/elapsed))
+if hashtable._total_searches:
+    t = m.table
+    print ('hashtable: %d objects searched in %d steps: avg %.3f steps/object'
+           ', 2^%d slots, %.1f%% full'
+           % (hashtable._total_searches, hashtable._total_steps,
+              hashtable._total_steps*1.0/hashtable._total_searches,
+              t.bits, t.load() * 100))
 if git._total_searches:
     print ('idx: %d objects searched in %d steps: avg %.3f steps/object' 
            % (git._total_searches, git._total_steps,
               git._total_steps*1.0/git._total_searches))
-print 'Total time: %.3fs' % (time.time() - start)
+print 'Total time: %.3fs' % elapsed
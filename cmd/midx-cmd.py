@@ -5,17 +5,13 @@ exec "$bup_python" "$0" ${1+"$@"}
 """
 # end of bup preamble
 
-import glob, math, os, resource, struct, sys, tempfile
+import glob, os, resource, sys
 
-from bup import options, git, midx, _helpers, xstat
-from bup.helpers import (Sha1, add_error, atomically_replaced_file, debug1, fdatasync,
-                         handle_ctrl_c, log, mmap_readwrite, qprogress,
-                         saved_errors, unlink)
+from bup import options, git, midx, xstat
+from bup.helpers import (Sha1, add_error, debug1, handle_ctrl_c, log,
+                         qprogress, saved_errors, unlink)
 
 
-PAGE_SIZE=4096
-SHA_PER_PAGE=PAGE_SIZE/20.
-
 optspec = """
 bup midx [options...] <idxnames...>
 --
@@ -28,9 +24,6 @@ max-files= maximum number of idx files to open at once [-1]
 d,dir=     directory containing idx/midx files
 """
 
-merge_into = _helpers.merge_into
-
-
 def _group(l, count):
     for i in xrange(0, len(l), count):
         yield l[i:i+count]
@@ -87,25 +80,13 @@ def _do_midx(outdir, outfilename, infilenames, prefixstr):
         sum = Sha1('\0'.join(infilenames)).hexdigest()
         outfilename = '%s/midx-%s.midx' % (outdir, sum)
     
-    inp = []
     total = 0
-    allfilenames = []
     midxs = []
     try:
         for name in infilenames:
             ix = git.open_idx(name)
             midxs.append(ix)
-            inp.append((
-                ix.map,
-                len(ix),
-                ix.sha_ofs,
-                isinstance(ix, midx.PackMidx) and ix.which_ofs or 0,
-                len(allfilenames),
-            ))
-            for n in ix.idxnames:
-                allfilenames.append(os.path.basename(n))
             total += len(ix)
-        inp.sort(lambda x,y: cmp(str(y[0][y[2]:y[2]+20]),str(x[0][x[2]:x[2]+20])))
 
         if not _first: _first = outdir
         dirprefix = (_first != outdir) and git.repo_rel(outdir)+': ' or ''
@@ -117,45 +98,12 @@ def _do_midx(outdir, outfilename, infilenames, prefixstr):
             debug1('midx: nothing to do.\n')
             return
 
-        pages = int(total/SHA_PER_PAGE) or 1
-        bits = int(math.ceil(math.log(pages, 2)))
-        entries = 2**bits
-        debug1('midx: table size: %d (%d bits)\n' % (entries*4, bits))
-
-        unlink(outfilename)
-        with atomically_replaced_file(outfilename, 'wb') as f:
-            f.write('MIDX')
-            f.write(struct.pack('!II', midx.MIDX_VERSION, bits))
-            assert(f.tell() == 12)
-
-            f.truncate(12 + 4*entries + 20*total + 4*total)
-            f.flush()
-            fdatasync(f.fileno())
-
-            fmap = mmap_readwrite(f, close=False)
-
-            count = merge_into(fmap, bits, total, inp)
-            del fmap # Assume this calls msync() now.
-            f.seek(0, os.SEEK_END)
-            f.write('\0'.join(allfilenames))
+        midx.write_midx(outfilename, midxs)
     finally:
         for ix in midxs:
             if isinstance(ix, midx.PackMidx):
                 ix.close()
         midxs = None
-        inp = None
-
-
-    # This is just for testing (if you enable this, don't clear inp above)
-    if 0:
-        p = midx.PackMidx(outfilename)
-        assert(len(p.idxnames) == len(infilenames))
-        print p.idxnames
-        assert(len(p) == total)
-        for pe, e in p, git.idxmerge(inp, final_progress=False):
-            pin = next(pi)
-            assert(i == pin)
-            assert(p.exists(i))
 
     return total, outfilename
 
@@ -167,6 +115,11 @@ def do_midx(outdir, outfilename, infilenames, prefixstr):
 
 
 def do_midx_dir(path, outfilename):
+    if opt.auto and not opt.force:
+        for name in midx.compact(path, max_files=opt.max_files):
+            if opt['print']:
+                print name
+        return
     already = {}
     sizes = {}
     if opt.force and not opt.auto:
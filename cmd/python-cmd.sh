@@ -0,0 +1,2 @@
+#!/bin/sh
+exec /root/.pyenv/versions/2.7.18/bin/python2.7 "$@"
\ No newline at end of file
@@ -5,6 +5,7 @@ exec "$bup_python" "$0" ${1+"$@"}
 """
 # end of bup preamble
 
+from collections import deque
 from errno import EACCES
 from io import BytesIO
 import os, sys, stat, time, math
@@ -35,6 +36,10 @@ strip      strips the path to every filename given
 strip-path= path-prefix to be stripped when saving
 graft=     a graft point *old_path*=*new_path* (can be used more than once)
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
+compress-threads=  number of threads to compress new objects with [1]
+adaptive-compression  store blobs that don't look compressible uncompressed
+j,jobs=    number of threads to split, hash, and compress files with [1]
+prefetch=  ask the OS to read up to n bytes of upcoming files ahead of time
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -49,6 +54,11 @@ opt.progress = (istty2 and not opt.quiet)
 opt.smaller = parse_num(opt.smaller or 0)
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
+if opt.compress_threads < 1:
+    o.fatal('--compress-threads must be at least 1')
+opt.prefetch = parse_num(opt.prefetch or 0)
 
 if opt.date:
     date = parse_date_or_fatal(opt.date, o.fatal)
@@ -91,11 +101,24 @@ if opt.remote or is_reverse:
         log('error: %s' % e)
         sys.exit(1)
     oldref = refname and cli.read_ref(refname) or None
-    w = cli.new_packwriter(compression_level=opt.compress)
+    w = cli.new_packwriter(compression_level=opt.compress,
+                           compress_threads=opt.compress_threads,
+                           adaptive_compression=opt.adaptive_compression)
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
-    w = git.PackWriter(compression_level=opt.compress)
+    w = git.PackWriter(compression_level=opt.compress,
+                       compress_threads=opt.compress_threads,
+                       adaptive_compression=opt.adaptive_compression,
+                       background_finish=True)
+
+try:
+    hashsplit.chunker = hashsplit.chunker_from_config(
+        cli.config_get('bup.split.chunker') if cli
+        else git.git_config_get('bup.split.chunker'))
+except ValueError as e:
+    log('error: %s\n' % e)
+    sys.exit(1)
 
 handle_ctrl_c()
 
@@ -235,6 +258,67 @@ def wantrecurse_pre(ent):
 def wantrecurse_during(ent):
     return not already_saved(ent) or ent.sha_missing()
 
+def wantsplit(ent):
+    return stat.S_ISREG(ent.mode) and (ent.flags & index.IX_EXISTS) \
+        and not (opt.smaller and ent.size >= opt.smaller) \
+        and not already_saved(ent)
+
+def with_lookahead(entries, split_pool, max_jobs, prefetcher,
+                   max_pending=10000):
+    # Yield (transname, ent, split_job) for each of the entries, where
+    # split_job is the SplitPool job for ent's content, if it has
+    # already been started.  Jobs are submitted for up to max_jobs
+    # upcoming files, so that the workers can keep busy while the
+    # caller writes the results in order.  The prefetcher (if any) is
+    # handed upcoming files for as far ahead as it has room for, and
+    # each prefetch is finished when the caller asks for the next
+    # entry, i.e. once the file has been saved.
+    if not (split_pool or prefetcher):
+        for (transname, ent) in entries:
+            yield (transname, ent, None)
+        return
+    entries = iter(entries)
+    ahead = deque()  # (transname, ent, prefetch)
+    ready = deque()  # (transname, ent, prefetch, split, split_job)
+    nsplits = 0
+    exhausted = False
+    while True:
+        while not exhausted and len(ahead) + len(ready) < max_pending \
+              and (not ahead or (prefetcher and prefetcher.has_room())):
+            item = next(entries, None)
+            if item is None:
+                exhausted = True
+                break
+            (transname, ent) = item
+            pf = None
+            if prefetcher and wantsplit(ent):
+                pf = prefetcher.prefetch(ent.name, ent.size)
+            ahead.append((transname, ent, pf))
+        while ahead and nsplits <= max_jobs:
+            (transname, ent, pf) = ahead.popleft()
+            split = wantsplit(ent)
+            job = None
+            if split:
+                nsplits += 1
+                if split_pool:
+                    try:
+                        f = hashsplit.open_noatime(ent.name)
+                    except (IOError, OSError):
+                        pass  # Let the serial path report it
+                    else:
+                        job = split_pool.submit(f)
+            ready.append((transname, ent, pf, split, job))
+        if not ready:
+            return
+        if not (ahead or exhausted or len(ready) >= max_pending):
+            continue
+        (transname, ent, pf, split, job) = ready.popleft()
+        if split:
+            nsplits -= 1
+        yield (transname, ent, job)
+        if pf:
+            prefetcher.done(pf)
+
 def find_hardlink_target(hlink_db, ent):
     if hlink_db and not stat.S_ISDIR(ent.mode) and ent.nlink > 1:
         link_paths = hlink_db.node_paths(ent.dev, ent.ino)
@@ -273,7 +357,16 @@ tstart = time.time()
 count = subcount = fcount = 0
 lastskip_name = None
 lastdir = ''
-for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
+split_pool = prefetcher = None
+if opt.jobs > 1:
+    split_pool = hashsplit.SplitPool(w.encode_blob, opt.jobs)
+if opt.prefetch:
+    prefetcher = hashsplit.Prefetcher(opt.prefetch)
+entries = r.filter(extra, wantrecurse=wantrecurse_during)
+for (transname,ent,split_job) in with_lookahead(entries, split_pool,
+                                                2 * opt.jobs if split_pool
+                                                else 0,
+                                                prefetcher):
     (dir, file) = os.path.split(ent.name)
     exists = (ent.flags & index.IX_EXISTS)
     hashvalid = already_saved(ent)
@@ -372,6 +465,8 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
 
     # it's not a directory
     id = None
+    if split_job and hashvalid:
+        split_job.cancel()  # Saved by an earlier file in the meantime
     if hashvalid:
         id = ent.sha
         git_name = git.mangle_name(file, ent.mode, ent.gitmode)
@@ -384,7 +479,15 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
         (meta.atime, meta.mtime, meta.ctime) = (ent.atime, ent.mtime, ent.ctime)
         metalists[-1].append((sort_key, meta))
     else:
-        if stat.S_ISREG(ent.mode):
+        if split_job:
+            try:
+                (mode, id) = hashsplit.encoded_to_blob_or_tree(
+                                        w.maybe_write_encoded_many,
+                                        w.new_blob, w.new_tree, split_job)
+            except (IOError, OSError) as e:
+                add_error('%s: %s' % (ent.name, e))
+                lastskip_name = ent.name
+        elif stat.S_ISREG(ent.mode):
             try:
                 f = hashsplit.open_noatime(ent.name)
             except (IOError, OSError) as e:
@@ -436,6 +539,11 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
         subcount = 0
 
 
+if split_pool:
+    split_pool.close()
+if prefetcher:
+    prefetcher.close()
+
 if opt.progress:
     pct = total and count*100.0/total or 100
     progress('Saving: %.2f%% (%d/%dk, %d/%d files), done.    \n'
@@ -463,6 +571,9 @@ if opt.commit or opt.name:
 
 msr.close()
 w.close()  # must close before we can update the ref
+if opt.adaptive_compression and opt.verbose:
+    log('Stored %d/%dk of blob data uncompressed.\n'
+        % (w.stored_bytes/1024, w.probed_bytes/1024))
         
 if opt.name:
     if cli:
@@ -15,6 +15,9 @@ from bup.helpers import (Conn, debug1, debug2, linereader, lines_until_sentinel,
 
 suspended_w = None
 dumb_server_mode = False
+# Received objects are looked up (and written) in batches of this size
+max_object_batch = 256
+max_object_batch_bytes = 1024 * 1024
 
 
 def do_help(conn, junk):
@@ -73,6 +76,32 @@ def send_index(conn, name):
     conn.ok()
 
 
+def _write_objects(conn, w, objs, suggested):
+    # Write each (sha, crc, buf) in objs to w, unless it's already in
+    # the repository, in which case suggest the index it's in instead.
+    # All the objects are looked up at once.
+    if not dumb_server_mode:
+        shas = sorted(set(sha for sha, crc, buf in objs))
+        sources = dict(zip(shas, w.exists_many(shas, want_source=True)))
+    for shar, crcr, buf in objs:
+        if not dumb_server_mode:
+            oldpack = sources[shar]
+            if oldpack:
+                assert(not oldpack == True)
+                assert(oldpack.endswith('.idx'))
+                (dir,name) = os.path.split(oldpack)
+                if not (name in suggested):
+                    debug1("bup server: suggesting index %s\n"
+                           % git.shorten_hash(name))
+                    debug1("bup server:   because of object %s\n"
+                           % shar.encode('hex'))
+                    conn.write('index %s\n' % name)
+                    suggested.add(name)
+                continue
+        nw, crc = w._raw_write((buf,), sha=shar)
+        _check(w, crcr, crc, 'object read: expected crc %d, got %d\n')
+
+
 def receive_objects_v2(conn, junk):
     global suspended_w
     _init_session()
@@ -85,6 +114,8 @@ def receive_objects_v2(conn, junk):
             w = git.PackWriter(objcache_maker=None)
         else:
             w = git.PackWriter()
+    objs = []
+    objs_size = 0
     while 1:
         ns = conn.read(4)
         if not ns:
@@ -92,6 +123,10 @@ def receive_objects_v2(conn, junk):
             raise Exception('object read: expected length header, got EOF\n')
         n = struct.unpack('!I', ns)[0]
         #debug2('expecting %d bytes\n' % n)
+        if objs and n in (0, 0xffffffff):
+            _write_objects(conn, w, objs, suggested)
+            objs = []
+            objs_size = 0
         if not n:
             debug1('bup server: received %d object%s.\n' 
                 % (w.count, w.count!=1 and "s" or ''))
@@ -113,22 +148,15 @@ def receive_objects_v2(conn, junk):
         buf = conn.read(n)  # object sizes in bup are reasonably small
         #debug2('read %d bytes\n' % n)
         _check(w, n, len(buf), 'object read: expected %d bytes, got %d\n')
-        if not dumb_server_mode:
-            oldpack = w.exists(shar, want_source=True)
-            if oldpack:
-                assert(not oldpack == True)
-                assert(oldpack.endswith('.idx'))
-                (dir,name) = os.path.split(oldpack)
-                if not (name in suggested):
-                    debug1("bup server: suggesting index %s\n"
-                           % git.shorten_hash(name))
-                    debug1("bup server:   because of object %s\n"
-                           % shar.encode('hex'))
-                    conn.write('index %s\n' % name)
-                    suggested.add(name)
-                continue
-        nw, crc = w._raw_write((buf,), sha=shar)
-        _check(w, crcr, crc, 'object read: expected crc %d, got %d\n')
+        objs.append((shar, crcr, buf))
+        objs_size += n
+        # Don't hold objects back while the client is waiting (e.g. for
+        # index suggestions) rather than sending more.
+        if len(objs) >= max_object_batch \
+           or objs_size >= max_object_batch_bytes or not conn.has_input():
+            _write_objects(conn, w, objs, suggested)
+            objs = []
+            objs_size = 0
     # NOTREACHED
     
 
@@ -152,6 +180,16 @@ def update_ref(conn, refname):
     git.update_ref(refname, newval.decode('hex'), oldval.decode('hex'))
     conn.ok()
 
+# The only config settings a client may ask about (e.g. not the
+# remotes or credentials)
+client_config = frozenset(('bup.split.chunker',))
+
+def config_get(conn, name):
+    _init_session()
+    value = git.git_config_get(name) if name in client_config else None
+    conn.write('%s\n' % (value or '').strip().replace('\n', ' '))
+    conn.ok()
+
 def join(conn, id):
     _init_session()
     try:
@@ -166,22 +204,26 @@ def join(conn, id):
         conn.write('\0\0\0\0')
         conn.ok()
 
-def cat_batch(conn, dummy):
+def cat_batch(conn, dummy, include_data=True):
     _init_session()
     cat_pipe = git.cp()
     # For now, avoid potential deadlock by just reading them all
-    for ref in tuple(lines_until_sentinel(conn, '\n', Exception)):
-        ref = ref[:-1]
-        it = cat_pipe.get(ref)
-        info = next(it)
-        if not info[0]:
+    refs = tuple(ref[:-1] for ref in lines_until_sentinel(conn, '\n',
+                                                           Exception))
+    for oidx, typ, size, it in cat_pipe.get_many(refs,
+                                                 include_data=include_data):
+        if not oidx:
             conn.write('missing\n')
             continue
-        conn.write('%s %s %d\n' % info)
-        for buf in it:
-            conn.write(buf)
+        conn.write('%s %s %d\n' % (oidx, typ, size))
+        if it:
+            for buf in it:
+                conn.write(buf)
     conn.ok()
 
+def cat_batch_check(conn, dummy):
+    cat_batch(conn, dummy, include_data=False)
+
 def refs(conn, args):
     limit_to_heads, limit_to_tags = args.split()
     assert limit_to_heads in ('0', '1')
@@ -247,9 +289,11 @@ commands = {
     'receive-objects-v2': receive_objects_v2,
     'read-ref': read_ref,
     'update-ref': update_ref,
+    'config-get': config_get,
     'join': join,
     'cat': join,  # apocryphal alias
     'cat-batch' : cat_batch,
+    'cat-batch-check' : cat_batch_check,
     'refs': refs,
     'rev-list': rev_list
 }
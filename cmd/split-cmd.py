@@ -38,6 +38,8 @@ max-pack-objects=  maximum number of objects in a single pack
 fanout=    average number of blobs in a single tree
 bwlimit=   maximum bytes/sec to transmit to server
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
+compress-threads=  number of threads to compress new objects with [1]
+adaptive-compression  store blobs that don't look compressible uncompressed
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -54,6 +56,8 @@ if opt.blobs and (opt.tree or opt.commit or opt.name):
     o.fatal('-b is incompatible with -t, -c, -n')
 if extra and opt.git_ids:
     o.fatal("don't provide filenames when using --git-ids")
+if opt.compress_threads < 1:
+    o.fatal('--compress-threads must be at least 1')
 
 if opt.verbose >= 2:
     git.verbose = opt.verbose - 1
@@ -103,13 +107,26 @@ elif opt.remote or is_reverse:
     oldref = refname and cli.read_ref(refname) or None
     pack_writer = cli.new_packwriter(compression_level=opt.compress,
                                      max_pack_size=max_pack_size,
-                                     max_pack_objects=max_pack_objects)
+                                     max_pack_objects=max_pack_objects,
+                                     compress_threads=opt.compress_threads,
+                                     adaptive_compression=opt.adaptive_compression)
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
     pack_writer = git.PackWriter(compression_level=opt.compress,
                                  max_pack_size=max_pack_size,
-                                 max_pack_objects=max_pack_objects)
+                                 max_pack_objects=max_pack_objects,
+                                 compress_threads=opt.compress_threads,
+                                 adaptive_compression=opt.adaptive_compression,
+                                 background_finish=True)
+
+try:
+    hashsplit.chunker = hashsplit.chunker_from_config(
+        cli.config_get('bup.split.chunker') if cli
+        else git.git_config_get('bup.split.chunker'))
+except ValueError as e:
+    log('error: %s\n' % e)
+    sys.exit(1)
 
 if opt.git_ids:
     # the input is actually a series of git object ids that we should retrieve
@@ -168,6 +185,14 @@ elif pack_writer:  # tree or commit or name
                       pack_writer.new_blob, pack_writer.new_tree, files,
                       keep_boundaries=opt.keep_boundaries, progress=prog)
     tree = pack_writer.new_tree(shalist)
+elif opt.noop and opt.bench and not opt.copy:
+    for name, secs, size, chunks, unique in \
+            hashsplit.compare_chunkers(files, progress=prog):
+        hashsplit.total_split = size
+        log('bup: %s: %.2f MB/s, %d chunks, %d bytes average, '
+            'dedup ratio %.3f\n'
+            % (name, size / 1024. / 1024. / max(secs, 1e-6), chunks,
+               size / max(chunks, 1), float(size) / max(unique, 1)))
 else:
     last = 0
     it = hashsplit.hashsplit_iter(files,
@@ -211,6 +236,10 @@ size = hashsplit.total_split
 if opt.bench:
     log('bup: %.2fkbytes in %.2f secs = %.2f kbytes/sec\n'
         % (size/1024., secs, size/1024./secs))
+    if pack_writer and pack_writer.adaptive_compression:
+        log('bup: stored %.2f of %.2f kbytes of blobs uncompressed\n'
+            % (pack_writer.stored_bytes/1024.,
+               pack_writer.probed_bytes/1024.))
 
 if saved_errors:
     log('WARNING: %d errors encountered while saving.\n' % len(saved_errors))
@@ -0,0 +1,3 @@
+COMMIT='a10320d8b0277b2ccc9dccaa204f8e2396f7aaf9'
+NAMES='(tag: a10320d)'
+DATE='2026-10-17 00:14:54 +0000'
@@ -65,21 +65,6 @@ typedef unsigned char byte;
 static int istty2 = 0;
 
 
-#ifndef htonll
-// This function should technically be macro'd out if it's going to be used
-// more than ocasionally.  As of this writing, it'll actually never be called
-// in real world bup scenarios (because our packs are < MAX_INT bytes).
-static uint64_t htonll(uint64_t value)
-{
-    static const int endian_test = 42;
-
-    if (*(char *)&endian_test == endian_test) // LSB-MSB
-	return ((uint64_t)htonl(value & 0xFFFFFFFF) << 32) | htonl(value >> 32);
-    return value; // already in network byte order MSB-LSB
-}
-#endif
-
-
 #define INTEGRAL_ASSIGNMENT_FITS(dest, src)                             \
     ({                                                                  \
         *(dest) = (src);                                                \
@@ -498,6 +483,99 @@ static PyObject *splitbuf(PyObject *self, PyObject *args)
 }
 
 
+// Return a list of (ofs, bits) pairs, one for each chunk that
+// repeated calls to splitbuf() would find in buf, restarting the
+// rolling checksum after each chunk.  If chunker is "fastcdc", use
+// the FastCDC gear hash instead of the rollsum.  A chunk longer than max_blob is
+// cut at max_blob and reported with bits of 0, and the scan resumes
+// there.  Any data after the last split point is left for the caller.
+// The scan itself runs without the GIL, so the caller must not modify
+// buf while this is running.
+static PyObject *splitbuf_all(PyObject *self, PyObject *args)
+{
+    unsigned char *buf = NULL;
+    Py_ssize_t len = 0, pos = 0, i, n = 0, alloc = 0;
+    int max_blob = 0, oom = 0;
+    int *split = NULL, *tmp;
+    const char *chunker = "rollsum";
+    int (*find_ofs)(const unsigned char *, int, int *);
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "t#i|s", &buf, &len, &max_blob, &chunker))
+	return NULL;
+    assert(len <= INT_MAX);
+    if (max_blob < 1)
+    {
+	PyErr_SetString(PyExc_ValueError, "max_blob must be positive");
+	return NULL;
+    }
+    if (strcmp(chunker, "rollsum") == 0)
+	find_ofs = bupsplit_find_ofs;
+    else if (strcmp(chunker, "fastcdc") == 0)
+	find_ofs = bupsplit_fastcdc_find_ofs;
+    else
+    {
+	PyErr_Format(PyExc_ValueError, "unknown chunker %s", chunker);
+	return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS;
+    while (pos < len)
+    {
+	int bits = -1;
+	int ofs = find_ofs(buf + pos, len - pos, &bits);
+	if (!ofs)
+	    break;
+	if (ofs > max_blob)
+	{
+	    ofs = max_blob;
+	    bits = 0;
+	}
+	if (n == alloc)
+	{
+	    alloc = alloc ? alloc * 2 : 256;
+	    tmp = realloc(split, alloc * 2 * sizeof(*split));
+	    if (!tmp)
+	    {
+		oom = 1;
+		break;
+	    }
+	    split = tmp;
+	}
+	split[n * 2] = ofs;
+	split[n * 2 + 1] = bits;
+	n++;
+	pos += ofs;
+    }
+    Py_END_ALLOW_THREADS;
+
+    if (oom)
+    {
+	free(split);
+	return PyErr_NoMemory();
+    }
+    result = PyList_New(n);
+    if (!result)
+    {
+	free(split);
+	return NULL;
+    }
+    for (i = 0; i < n; i++)
+    {
+	PyObject *pair = Py_BuildValue("ii", split[i * 2], split[i * 2 + 1]);
+	if (!pair)
+	{
+	    Py_DECREF(result);
+	    free(split);
+	    return NULL;
+	}
+	PyList_SET_ITEM(result, i, pair);
+    }
+    free(split);
+    return result;
+}
+
+
 static PyObject *bitmatch(PyObject *self, PyObject *args)
 {
     unsigned char *buf1 = NULL, *buf2 = NULL;
@@ -599,36 +677,102 @@ BLOOM_GET_BIT(bloom_get_bit4, to_bloom_address_bitmask4, uint64_t)
 BLOOM_GET_BIT(bloom_get_bit5, to_bloom_address_bitmask5, uint32_t)
 
 
+// Version 3 ("blocked") bloom filters put all k bits for a sha in the
+// same 64 byte block, so that a lookup touches only one cache line
+// (and one page).  The first nbits - 6 bits of the sha pick the block,
+// and each of the k bit numbers within it is 9 bits taken from the
+// last 8 bytes of the sha.
+#define BLOOM3_BLOCK_BITS 6
+#define BLOOM3_MIN_BITS BLOOM3_BLOCK_BITS
+#define BLOOM3_MAX_BITS 40
+
+static uint64_t bloom3_get64(const unsigned char *buf)
+{
+    uint64_t v = 0;
+    int i;
+    for (i = 0; i < 8; i++)
+	v = (v << 8) | buf[i];
+    return v;
+}
+
+static unsigned char *bloom3_block(unsigned char *bloom,
+				   const unsigned char *sha, int nbits)
+{
+    uint64_t block = 0;
+    if (nbits > BLOOM3_BLOCK_BITS)
+	block = bloom3_get64(sha) >> (64 - (nbits - BLOOM3_BLOCK_BITS));
+    return bloom + BLOOM2_HEADERLEN + (block << BLOOM3_BLOCK_BITS);
+}
+
+static void bloom3_set(unsigned char *bloom, const unsigned char *sha,
+		       int nbits, int k)
+{
+    unsigned char *block = bloom3_block(bloom, sha, nbits);
+    uint64_t w = bloom3_get64(sha + 12);
+    int i;
+    for (i = 0; i < k; i++, w >>= 9)
+	block[(w & 511) >> 3] |= 1 << (w & 7);
+}
+
+// Returns the number of bits checked if sha is (probably) present,
+// or minus that if it definitely isn't.
+static int bloom3_get(const unsigned char *bloom, const unsigned char *sha,
+		      int nbits, int k)
+{
+    const unsigned char *block = bloom3_block((unsigned char *) bloom,
+					      sha, nbits);
+    uint64_t w = bloom3_get64(sha + 12);
+    int i;
+    for (i = 0; i < k; i++, w >>= 9)
+	if (!(block[(w & 511) >> 3] & (1 << (w & 7))))
+	    return -(i + 1);
+    return k;
+}
+
+static int bloom_params_ok(int version, int nbits, int k)
+{
+    if (version == 3)
+	return k >= 1 && k <= 7
+	    && nbits >= BLOOM3_MIN_BITS && nbits <= BLOOM3_MAX_BITS;
+    if (version == 2)
+	return (k == 5 && nbits >= 0 && nbits <= 29)
+	    || (k == 4 && nbits >= 0 && nbits <= 37);
+    return 0;
+}
+
+
 static PyObject *bloom_add(PyObject *self, PyObject *args)
 {
     unsigned char *sha = NULL, *bloom = NULL;
     unsigned char *end;
     Py_ssize_t len = 0, blen = 0;
-    int nbits = 0, k = 0;
+    int nbits = 0, k = 0, version = 2;
 
-    if (!PyArg_ParseTuple(args, "w#s#ii", &bloom, &blen, &sha, &len, &nbits, &k))
+    if (!PyArg_ParseTuple(args, "w#s#ii|i", &bloom, &blen, &sha, &len,
+			  &nbits, &k, &version))
 	return NULL;
 
-    if (blen < 16+(1<<nbits) || len % 20 != 0)
+    if (!bloom_params_ok(version, nbits, k))
 	return NULL;
 
-    if (k == 5)
+    if (blen < 16+((Py_ssize_t) 1<<nbits) || len % 20 != 0)
+	return NULL;
+
+    if (version == 3)
+    {
+	for (end = sha + len; sha < end; sha += 20)
+	    bloom3_set(bloom, sha, nbits, k);
+    }
+    else if (k == 5)
     {
-	if (nbits > 29)
-	    return NULL;
 	for (end = sha + len; sha < end; sha += 20/k)
 	    bloom_set_bit5(bloom, sha, nbits);
     }
-    else if (k == 4)
+    else
     {
-	if (nbits > 37)
-	    return NULL;
 	for (end = sha + len; sha < end; sha += 20/k)
 	    bloom_set_bit4(bloom, sha, nbits);
     }
-    else
-	return NULL;
-
 
     return Py_BuildValue("n", len/20);
 }
@@ -637,38 +781,101 @@ static PyObject *bloom_contains(PyObject *self, PyObject *args)
 {
     unsigned char *sha = NULL, *bloom = NULL;
     Py_ssize_t len = 0, blen = 0;
-    int nbits = 0, k = 0;
+    int nbits = 0, k = 0, version = 2;
     unsigned char *end;
     int steps;
 
-    if (!PyArg_ParseTuple(args, "t#s#ii", &bloom, &blen, &sha, &len, &nbits, &k))
+    if (!PyArg_ParseTuple(args, "t#s#ii|i", &bloom, &blen, &sha, &len,
+			  &nbits, &k, &version))
 	return NULL;
 
     if (len != 20)
 	return NULL;
 
-    if (k == 5)
+    if (!bloom_params_ok(version, nbits, k))
+	return NULL;
+
+    if (version == 3)
+    {
+	steps = bloom3_get(bloom, sha, nbits, k);
+	if (steps < 0)
+	    return Py_BuildValue("Oi", Py_None, -steps);
+    }
+    else if (k == 5)
     {
-	if (nbits > 29)
-	    return NULL;
 	for (steps = 1, end = sha + 20; sha < end; sha += 20/k, steps++)
 	    if (!bloom_get_bit5(bloom, sha, nbits))
 		return Py_BuildValue("Oi", Py_None, steps);
     }
-    else if (k == 4)
+    else
     {
-	if (nbits > 37)
-	    return NULL;
 	for (steps = 1, end = sha + 20; sha < end; sha += 20/k, steps++)
 	    if (!bloom_get_bit4(bloom, sha, nbits))
 		return Py_BuildValue("Oi", Py_None, steps);
     }
-    else
-	return NULL;
 
     return Py_BuildValue("ii", 1, k);
 }
 
+// Like bloom_contains(), but for every 20-byte sha in shas, and without
+// the GIL.  Returns a string with a byte for each sha that's 1 if the
+// filter (probably) contains it and 0 if it definitely doesn't.
+static PyObject *bloom_contains_many(PyObject *self, PyObject *args)
+{
+    unsigned char *shas = NULL, *bloom = NULL;
+    Py_ssize_t len = 0, blen = 0, i, n;
+    int nbits = 0, k = 0, version = 2;
+    char *found;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "t#s#ii|i", &bloom, &blen, &shas, &len,
+			  &nbits, &k, &version))
+	return NULL;
+
+    if (!bloom_params_ok(version, nbits, k))
+    {
+	PyErr_Format(PyExc_ValueError, "unsupported bloom v%d k=%d nbits=%d",
+		     version, k, nbits);
+	return NULL;
+    }
+    if (blen < BLOOM2_HEADERLEN + ((Py_ssize_t) 1 << nbits) || len % 20 != 0)
+    {
+	PyErr_SetString(PyExc_ValueError, "invalid bloom or sha buffer size");
+	return NULL;
+    }
+
+    n = len / 20;
+    result = PyString_FromStringAndSize(NULL, n);
+    if (!result)
+	return NULL;
+    found = PyString_AS_STRING(result);
+
+    Py_BEGIN_ALLOW_THREADS;
+    for (i = 0; i < n; i++)
+    {
+	const unsigned char *sha = shas + i * 20, *end = sha + 20;
+	if (version == 3)
+	{
+	    found[i] = bloom3_get(bloom, sha, nbits, k) > 0;
+	    continue;
+	}
+	found[i] = 1;
+	for (; sha < end; sha += 20 / k)
+	{
+	    int hit = (k == 5) ? bloom_get_bit5(bloom, sha, nbits)
+		: bloom_get_bit4(bloom, sha, nbits);
+	    if (!hit)
+	    {
+		found[i] = 0;
+		break;
+	    }
+	}
+    }
+    Py_END_ALLOW_THREADS;
+
+    return result;
+}
+
 
 static uint32_t _extract_bits(unsigned char *buf, int nbits)
 {
@@ -768,6 +975,333 @@ static uint32_t _get_idx_i(struct idx *idx)
     return ntohl(*idx->cur_name) + idx->name_base;
 }
 
+// Look up each of the sorted 20-byte shas in a sorted table of count
+// entries, the first 20 bytes of every stride bytes of which are a
+// sha (i.e. a .idx or .midx sha table).  Since both are sorted, this
+// is a single merge pass: each search gallops forward from where the
+// last one ended.  Returns a list containing the table index of each
+// sha, or None for the ones that aren't in the table.
+static PyObject *find_sorted_shas(PyObject *self, PyObject *args)
+{
+    const unsigned char *table = NULL, *shas = NULL;
+    Py_ssize_t tlen = 0, len = 0, count = 0, n, i, lo = 0;
+    Py_ssize_t *pos;
+    int stride = 0;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "t#ins#", &table, &tlen, &stride, &count,
+			  &shas, &len))
+	return NULL;
+
+    if (stride < 20 || count < 0
+	|| (count && (count - 1) * stride + 20 > tlen))
+    {
+	PyErr_SetString(PyExc_ValueError, "invalid sha table size");
+	return NULL;
+    }
+    if (len % 20 != 0)
+    {
+	PyErr_SetString(PyExc_ValueError, "shas must be 20 bytes each");
+	return NULL;
+    }
+    n = len / 20;
+    for (i = 1; i < n; i++)
+	if (memcmp(shas + (i - 1) * 20, shas + i * 20, 20) > 0)
+	{
+	    PyErr_SetString(PyExc_ValueError, "shas must be sorted");
+	    return NULL;
+	}
+
+    pos = PyMem_Malloc((n ? n : 1) * sizeof(*pos));
+    if (!pos)
+	return PyErr_NoMemory();
+
+    Py_BEGIN_ALLOW_THREADS;
+    for (i = 0; i < n; i++)
+    {
+	const unsigned char *want = shas + i * 20;
+	Py_ssize_t hi = lo, step = 1;
+	// Gallop until table[hi] >= want, keeping table[lo - 1] < want
+	while (hi < count && memcmp(table + hi * stride, want, 20) < 0)
+	{
+	    lo = hi + 1;
+	    hi += step;
+	    step <<= 1;
+	}
+	if (hi > count)
+	    hi = count;
+	while (lo < hi)
+	{
+	    Py_ssize_t mid = lo + (hi - lo) / 2;
+	    if (memcmp(table + mid * stride, want, 20) < 0)
+		lo = mid + 1;
+	    else
+		hi = mid;
+	}
+	if (lo < count && memcmp(table + lo * stride, want, 20) == 0)
+	    pos[i] = lo;
+	else
+	    pos[i] = -1;
+    }
+    Py_END_ALLOW_THREADS;
+
+    result = PyList_New(n);
+    if (!result)
+    {
+	PyMem_Free(pos);
+	return NULL;
+    }
+    for (i = 0; i < n; i++)
+    {
+	PyObject *item;
+	if (pos[i] < 0)
+	{
+	    Py_INCREF(Py_None);
+	    item = Py_None;
+	}
+	else if (!(item = PyInt_FromSsize_t(pos[i])))
+	{
+	    Py_DECREF(result);
+	    PyMem_Free(pos);
+	    return NULL;
+	}
+	PyList_SET_ITEM(result, i, item);
+    }
+    PyMem_Free(pos);
+    return result;
+}
+
+
+// Find want in the sha table of a midx via the same interpolation
+// search PackMidx.exists() used to do in python, given its fanout
+// table of 2^bits entries.  Returns (None, steps) if want isn't there,
+// and otherwise (True, steps), or (n, steps) where n is the number of
+// the idx the object came from if the midx's whichlist is provided.
+static PyObject *midx_find(PyObject *self, PyObject *args)
+{
+    const unsigned char *fanout = NULL, *shatable = NULL, *want = NULL;
+    const unsigned char *whichlist = NULL;
+    Py_ssize_t flen = 0, slen = 0, wlen = 0, whichlen = 0;
+    int bits = 0, steps = 1;  // the lookup table is a step
+    uint32_t el, nsha, start, end, mid;
+    uint64_t startv, endv, hashv;
+
+    if (!PyArg_ParseTuple(args, "t#t#is#|t#", &fanout, &flen,
+			  &shatable, &slen, &bits, &want, &wlen,
+			  &whichlist, &whichlen))
+	return NULL;
+
+    if (bits < 0 || bits > 31 || wlen != 20 || flen < (4 << bits))
+    {
+	PyErr_SetString(PyExc_ValueError, "invalid midx_find arguments");
+	return NULL;
+    }
+    nsha = ntohl(((const uint32_t *) fanout)[((Py_ssize_t) 1 << bits) - 1]);
+    if ((Py_ssize_t) nsha > slen / 20
+	|| (whichlist && (Py_ssize_t) nsha > whichlen / 4))
+    {
+	PyErr_SetString(PyExc_ValueError, "midx tables are too short");
+	return NULL;
+    }
+
+    hashv = ntohl(*(const uint32_t *) want);
+    el = bits ? _extract_bits((unsigned char *) want, bits) : 0;
+    start = el ? ntohl(((const uint32_t *) fanout)[el - 1]) : 0;
+    end = ntohl(((const uint32_t *) fanout)[el]);
+    startv = (uint64_t) el << (32 - bits);
+    endv = (uint64_t) (el + 1) << (32 - bits);
+    if (end > nsha)
+	end = nsha;
+
+    while (start < end)
+    {
+	const unsigned char *v;
+	int cmp;
+	steps++;
+	if (endv > startv && hashv >= startv)
+	{
+	    uint64_t ofs = (hashv - startv) * (end - start - 1)
+		/ (endv - startv);
+	    mid = start + (ofs < end - start ? (uint32_t) ofs : end - start - 1);
+	}
+	else
+	    mid = start;
+	v = shatable + (Py_ssize_t) mid * 20;
+	cmp = memcmp(v, want, 20);
+	if (cmp < 0)
+	{
+	    start = mid + 1;
+	    startv = ntohl(*(const uint32_t *) v);
+	}
+	else if (cmp > 0)
+	{
+	    end = mid;
+	    endv = ntohl(*(const uint32_t *) v);
+	}
+	else if (whichlist)
+	    return Py_BuildValue("ki", (unsigned long)
+				 ntohl(((const uint32_t *) whichlist)[mid]),
+				 steps);
+	else
+	    return Py_BuildValue("Oi", Py_True, steps);
+    }
+    return Py_BuildValue("Oi", Py_None, steps);
+}
+
+
+// An open-addressed hash table of 2^nbits 20-byte shas (cf.
+// bup.hashtable), after a header of SHATABLE_HEADERLEN bytes.  Each
+// sha goes in the first free slot at or after the one given by its
+// first nbits bits, and a slot of all zeros is free.
+#define SHATABLE_HEADERLEN 32
+#define SHATABLE_MAX_BITS 40
+
+static const unsigned char shatable_free[20];
+
+static int shatable_args_ok(Py_ssize_t tlen, Py_ssize_t len, int nbits)
+{
+    if (nbits < 1 || nbits > SHATABLE_MAX_BITS || len % 20 != 0
+	|| tlen < SHATABLE_HEADERLEN + ((Py_ssize_t) 20 << nbits))
+    {
+	PyErr_SetString(PyExc_ValueError, "invalid shatable arguments");
+	return 0;
+    }
+    return 1;
+}
+
+// Find sha's slot (or the free slot where it would go) and store it
+// in *slot, and whether sha is there in *found.  Returns the number of
+// slots looked at, or 0 if the table is full and doesn't contain sha.
+static uint64_t shatable_find(const unsigned char *table,
+			      const unsigned char *sha, int nbits,
+			      uint64_t *slot, int *found)
+{
+    const uint64_t mask = ((uint64_t) 1 << nbits) - 1;
+    uint64_t i = bloom3_get64(sha) >> (64 - nbits), steps;
+    for (steps = 1; steps <= mask + 1; steps++, i = (i + 1) & mask)
+    {
+	const unsigned char *s = table + SHATABLE_HEADERLEN + i * 20;
+	*found = 0;
+	if (memcmp(s, shatable_free, 20) == 0
+	    || (*found = (memcmp(s, sha, 20) == 0)))
+	{
+	    *slot = i;
+	    return steps;
+	}
+    }
+    return 0;
+}
+
+// Add each of the shas that isn't all zeros (so another table's slots
+// can be passed as shas) and isn't already in the table.  If stride is
+// given, shas is a string of records of that many bytes, each starting
+// with a sha.  Returns the number added.
+static PyObject *shatable_add(PyObject *self, PyObject *args)
+{
+    unsigned char *table = NULL;
+    const unsigned char *shas = NULL, *sha, *end;
+    Py_ssize_t tlen = 0, len = 0, added = 0, stride = 20, offset = 0;
+    int nbits = 0, full = 0, found;
+    uint64_t slot = 0;
+
+    if (!PyArg_ParseTuple(args, "w#s#i|nn", &table, &tlen, &shas, &len, &nbits,
+			  &stride, &offset))
+	return NULL;
+    // Each stride byte record has a sha at offset
+    if (stride < 20 || offset < 0 || offset > stride - 20
+	|| len % stride != 0)
+    {
+	PyErr_SetString(PyExc_ValueError, "invalid shatable record length");
+	return NULL;
+    }
+    if (!shatable_args_ok(tlen, 0, nbits))
+	return NULL;
+
+    Py_BEGIN_ALLOW_THREADS;
+    for (sha = shas + offset, end = shas + len; sha < end; sha += stride)
+    {
+	if (memcmp(sha, shatable_free, 20) == 0)
+	    continue;
+	if (!shatable_find(table, sha, nbits, &slot, &found))
+	{
+	    full = 1;
+	    break;
+	}
+	if (!found)
+	{
+	    memcpy(table + SHATABLE_HEADERLEN + slot * 20, sha, 20);
+	    added++;
+	}
+    }
+    Py_END_ALLOW_THREADS;
+
+    if (full)
+    {
+	PyErr_SetString(PyExc_ValueError, "shatable is full");
+	return NULL;
+    }
+    return Py_BuildValue("n", added);
+}
+
+static PyObject *shatable_contains(PyObject *self, PyObject *args)
+{
+    const unsigned char *table = NULL, *sha = NULL;
+    Py_ssize_t tlen = 0, len = 0;
+    int nbits = 0, found = 0;
+    uint64_t slot = 0, steps;
+
+    if (!PyArg_ParseTuple(args, "t#s#i", &table, &tlen, &sha, &len, &nbits))
+	return NULL;
+    if (!shatable_args_ok(tlen, len, nbits))
+	return NULL;
+    if (len != 20)
+    {
+	PyErr_SetString(PyExc_ValueError, "sha must be 20 bytes");
+	return NULL;
+    }
+
+    steps = shatable_find(table, sha, nbits, &slot, &found);
+    if (found)
+	return Py_BuildValue("OK", Py_True, (unsigned PY_LONG_LONG) steps);
+    return Py_BuildValue("OK", Py_None, (unsigned PY_LONG_LONG) steps);
+}
+
+// Like shatable_contains(), but for every 20-byte sha in shas, and
+// without the GIL.  Returns a string with a byte for each sha that's 1
+// if the table contains it and 0 if it doesn't.
+static PyObject *shatable_contains_many(PyObject *self, PyObject *args)
+{
+    const unsigned char *table = NULL, *shas = NULL;
+    Py_ssize_t tlen = 0, len = 0, i, n;
+    int nbits = 0;
+    uint64_t slot = 0;
+    char *found;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "t#s#i", &table, &tlen, &shas, &len, &nbits))
+	return NULL;
+    if (!shatable_args_ok(tlen, len, nbits))
+	return NULL;
+
+    n = len / 20;
+    result = PyString_FromStringAndSize(NULL, n);
+    if (!result)
+	return NULL;
+    found = PyString_AS_STRING(result);
+
+    Py_BEGIN_ALLOW_THREADS;
+    for (i = 0; i < n; i++)
+    {
+	int hit = 0;
+	shatable_find(table, shas + i * 20, nbits, &slot, &hit);
+	found[i] = hit;
+    }
+    Py_END_ALLOW_THREADS;
+
+    return result;
+}
+
+
 #define MIDX4_HEADERLEN 12
 
 static PyObject *merge_into(PyObject *self, PyObject *args)
@@ -816,6 +1350,7 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
     last_i = num_i-1;
     count = 0;
     prefix = 0;
+    Py_BEGIN_ALLOW_THREADS;
     while (last_i >= 0)
     {
 	struct idx *idx;
@@ -837,6 +1372,7 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
     }
     while (prefix < (1<<bits))
 	table_ptr[prefix++] = htonl(count);
+    Py_END_ALLOW_THREADS;
     assert(count == total);
     assert(prefix == (1<<bits));
     assert(sha_ptr == sha_start+count);
@@ -848,30 +1384,64 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
 
 #define FAN_ENTRIES 256
 
+// PackWriter keeps an IDX_RECORD_LEN byte record for each object it
+// writes: the sha, and then the crc and offset as they'll appear in
+// the idx, i.e. big-endian, and for offsets of 2^31 and beyond,
+// 0x80000000 plus the number of the offset's big-endian 8 byte entry
+// in a separate table.  Comparing whole records orders them by sha,
+// then crc, then offset.
+#define IDX_RECORD_LEN 28
+
+static int _cmp_idx_record(const void *a, const void *b)
+{
+    return memcmp(a, b, IDX_RECORD_LEN);
+}
+
+// Sort count records (in place), and write them to fmap as a v2 idx
+// (without the trailing checksums), with ofs64 being the table of
+// large offsets they refer to.
 static PyObject *write_idx(PyObject *self, PyObject *args)
 {
     char *filename = NULL;
-    PyObject *py_total, *idx = NULL;
-    PyObject *part;
-    unsigned char *fmap = NULL;
-    Py_ssize_t flen = 0;
+    PyObject *py_total;
+    Py_buffer recbuf, ofs64buf;
+    unsigned char *fmap = NULL, *records, *rec, *end;
+    const unsigned char *ofs64;
+    Py_ssize_t flen = 0, rlen, olen;
     unsigned int total = 0;
-    uint32_t count;
-    int i, j, ofs64_count;
+    uint32_t count, ofs64_count, fan;
     uint32_t *fan_ptr, *crc_ptr, *ofs_ptr;
     uint64_t *ofs64_ptr;
     struct sha *sha_ptr;
+    int i, bad = 0;
 
-    if (!PyArg_ParseTuple(args, "sw#OO",
-                          &filename, &fmap, &flen, &idx, &py_total))
+    if (!PyArg_ParseTuple(args, "sw#w*s*O", &filename, &fmap, &flen,
+			  &recbuf, &ofs64buf, &py_total))
 	return NULL;
+    records = recbuf.buf;
+    rlen = recbuf.len;
+    ofs64 = ofs64buf.buf;
+    olen = ofs64buf.len;
 
     if (!bup_uint_from_py(&total, py_total, "total"))
-        return NULL;
-
-    if (PyList_Size (idx) != FAN_ENTRIES) // Check for list of the right length.
-        return PyErr_Format (PyExc_TypeError, "idx must contain %d entries",
-                             FAN_ENTRIES);
+	bad = 1;
+    else if (rlen != (Py_ssize_t) total * IDX_RECORD_LEN || olen % 8 != 0)
+    {
+	PyErr_Format(PyExc_ValueError, "idx must contain %u %d byte records",
+		     total, IDX_RECORD_LEN);
+	bad = 1;
+    }
+    else if (flen < 8 + 4 * FAN_ENTRIES + 28 * (Py_ssize_t) total + olen)
+    {
+	PyErr_SetString(PyExc_ValueError, "idx map is too small");
+	bad = 1;
+    }
+    if (bad)
+    {
+	PyBuffer_Release(&recbuf);
+	PyBuffer_Release(&ofs64buf);
+	return NULL;
+    }
 
     const char idx_header[] = "\377tOc\0\0\0\002";
     memcpy (fmap, idx_header, sizeof(idx_header) - 1);
@@ -882,46 +1452,44 @@ static PyObject *write_idx(PyObject *self, PyObject *args)
     ofs_ptr = (uint32_t *)&crc_ptr[total];
     ofs64_ptr = (uint64_t *)&ofs_ptr[total];
 
+    Py_BEGIN_ALLOW_THREADS;
+    qsort(records, total, IDX_RECORD_LEN, _cmp_idx_record);
+
     count = 0;
     ofs64_count = 0;
+    rec = records;
+    end = records + rlen;
     for (i = 0; i < FAN_ENTRIES; ++i)
     {
-	int plen;
-	part = PyList_GET_ITEM(idx, i);
-	PyList_Sort(part);
-	plen = PyList_GET_SIZE(part);
-	count += plen;
-	*fan_ptr++ = htonl(count);
-	for (j = 0; j < plen; ++j)
+	for (; rec < end && rec[0] == i; rec += IDX_RECORD_LEN)
 	{
-	    unsigned char *sha = NULL;
-	    Py_ssize_t sha_len = 0;
-            PyObject *crc_py, *ofs_py;
-	    unsigned int crc;
-            unsigned PY_LONG_LONG ofs_ull;
-	    uint64_t ofs;
-	    if (!PyArg_ParseTuple(PyList_GET_ITEM(part, j), "t#OO",
-				  &sha, &sha_len, &crc_py, &ofs_py))
-		return NULL;
-            if(!bup_uint_from_py(&crc, crc_py, "crc"))
-                return NULL;
-            if(!bup_ullong_from_py(&ofs_ull, ofs_py, "ofs"))
-                return NULL;
-            assert(crc <= UINT32_MAX);
-            assert(ofs_ull <= UINT64_MAX);
-	    ofs = ofs_ull;
-	    if (sha_len != sizeof(struct sha))
-		return NULL;
-	    memcpy(sha_ptr++, sha, sizeof(struct sha));
-	    *crc_ptr++ = htonl(crc);
-	    if (ofs > 0x7fffffff)
+	    uint32_t ofs;
+	    memcpy(sha_ptr++, rec, sizeof(struct sha));
+	    memcpy(crc_ptr++, rec + 20, 4);
+	    memcpy(&ofs, rec + 24, 4);
+	    if (ntohl(ofs) & 0x80000000)
 	    {
-                *ofs64_ptr++ = htonll(ofs);
-		ofs = 0x80000000 | ofs64_count++;
+		uint32_t n = ntohl(ofs) & 0x7fffffff;
+		if ((Py_ssize_t) n >= olen / 8)
+		{
+		    bad = 1;
+		    break;
+		}
+		memcpy(ofs64_ptr++, ofs64 + 8 * (Py_ssize_t) n, 8);
+		ofs = htonl(0x80000000 | ofs64_count++);
 	    }
-	    *ofs_ptr++ = htonl((uint32_t)ofs);
+	    memcpy(ofs_ptr++, &ofs, 4);
+	    count++;
 	}
+	fan = htonl(count);
+	memcpy(fan_ptr++, &fan, 4);
     }
+    Py_END_ALLOW_THREADS;
+    PyBuffer_Release(&recbuf);
+    PyBuffer_Release(&ofs64buf);
+
+    if (bad)
+	return PyErr_Format(PyExc_ValueError, "invalid large offset in idx");
 
     int rc = msync(fmap, flen, MS_ASYNC);
     if (rc != 0)
@@ -1046,7 +1614,7 @@ static PyObject *open_noatime(PyObject *self, PyObject *args)
 }
 
 
-static PyObject *fadvise_done(PyObject *self, PyObject *args)
+static PyObject *bup_fadvise(PyObject *args, int advice)
 {
     int fd = -1;
     long long llofs, lllen = 0;
@@ -1059,13 +1627,32 @@ static PyObject *fadvise_done(PyObject *self, PyObject *args)
     if (!INTEGRAL_ASSIGNMENT_FITS(&len, lllen))
         return PyErr_Format(PyExc_OverflowError,
                             "fadvise length overflows off_t");
-#ifdef POSIX_FADV_DONTNEED
-    posix_fadvise(fd, ofs, len, POSIX_FADV_DONTNEED);
-#endif    
+    if (advice != -1)
+        posix_fadvise(fd, ofs, len, advice);
     return Py_BuildValue("");
 }
 
 
+static PyObject *fadvise_done(PyObject *self, PyObject *args)
+{
+#ifdef POSIX_FADV_DONTNEED
+    return bup_fadvise(args, POSIX_FADV_DONTNEED);
+#else
+    return bup_fadvise(args, -1);
+#endif
+}
+
+
+static PyObject *fadvise_willneed(PyObject *self, PyObject *args)
+{
+#ifdef POSIX_FADV_WILLNEED
+    return bup_fadvise(args, POSIX_FADV_WILLNEED);
+#else
+    return bup_fadvise(args, -1);
+#endif
+}
+
+
 // Currently the Linux kernel and FUSE disagree over the type for
 // FS_IOC_GETFLAGS and FS_IOC_SETFLAGS.  The kernel actually uses int,
 // but FUSE chose long (matching the declaration in linux/fs.h).  So
@@ -1490,16 +2077,30 @@ static PyMethodDef helper_methods[] = {
 	"Return the number of bits in the rolling checksum." },
     { "splitbuf", splitbuf, METH_VARARGS,
 	"Split a list of strings based on a rolling checksum." },
+    { "splitbuf_all", splitbuf_all, METH_VARARGS,
+	"Return the (ofs, bits) of every rolling checksum split in a buffer." },
     { "bitmatch", bitmatch, METH_VARARGS,
 	"Count the number of matching prefix bits between two strings." },
     { "firstword", firstword, METH_VARARGS,
         "Return an int corresponding to the first 32 bits of buf." },
     { "bloom_contains", bloom_contains, METH_VARARGS,
 	"Check if a bloom filter of 2^nbits bytes contains an object" },
+    { "bloom_contains_many", bloom_contains_many, METH_VARARGS,
+	"Check which of a string of shas a bloom filter of 2^nbits bytes contains" },
     { "bloom_add", bloom_add, METH_VARARGS,
 	"Add an object to a bloom filter of 2^nbits bytes" },
     { "extract_bits", extract_bits, METH_VARARGS,
 	"Take the first 'nbits' bits from 'buf' and return them as an int." },
+    { "find_sorted_shas", find_sorted_shas, METH_VARARGS,
+	"Return the index of each of a sorted string of shas in a sha table" },
+    { "midx_find", midx_find, METH_VARARGS,
+	"Search a midx for an object, returning (found, steps)." },
+    { "shatable_add", shatable_add, METH_VARARGS,
+	"Add a string of shas to a hash table of 2^nbits shas" },
+    { "shatable_contains", shatable_contains, METH_VARARGS,
+	"Check if a hash table of 2^nbits shas contains an object" },
+    { "shatable_contains_many", shatable_contains_many, METH_VARARGS,
+	"Check which of a string of shas a hash table of 2^nbits shas contains" },
     { "merge_into", merge_into, METH_VARARGS,
 	"Merges a bunch of idx and midx files into a single midx." },
     { "write_idx", write_idx, METH_VARARGS,
@@ -1512,6 +2113,8 @@ static PyMethodDef helper_methods[] = {
 	"open() the given filename for read with O_NOATIME if possible" },
     { "fadvise_done", fadvise_done, METH_VARARGS,
 	"Inform the kernel that we're finished with earlier parts of a file" },
+    { "fadvise_willneed", fadvise_willneed, METH_VARARGS,
+	"Ask the kernel to start reading part of a file into the cache" },
 #ifdef BUP_HAVE_FILE_ATTRS
     { "get_linux_file_attr", bup_get_linux_file_attr, METH_VARARGS,
       "Return the Linux attributes for the given file." },
@@ -1613,6 +2216,17 @@ PyMODINIT_FUNC init_helpers(void)
         Py_DECREF(value);
     }
 #endif
+#if defined(SEEK_DATA) && defined(SEEK_HOLE)
+    {
+        PyObject *value;
+        value = INTEGER_TO_PY(SEEK_DATA);
+        PyObject_SetAttrString(m, "SEEK_DATA", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(SEEK_HOLE);
+        PyObject_SetAttrString(m, "SEEK_HOLE", value);
+        Py_DECREF(value);
+    }
+#endif
 #pragma clang diagnostic pop  // ignored "-Wtautological-compare"
 
     e = getenv("BUP_FORCE_TTY");
@@ -78,9 +78,21 @@ table with k=5 can represent the repository.
 None of this tells us what max_pfalse_positive to choose.
 
 Brandon Low <lostlogic@lostlogicx.com> 2011-02-04
+
+Version 3 of the format is a "blocked" bloom filter.  Once the filter no
+longer fits in memory, the k page faults per lookup of the above dominate,
+so a v3 filter puts all the k bits for an object in the same 64 byte
+block, chosen by the first bits of the SHA.  The bits within the block are
+taken from the last 8 bytes of the SHA.  Every lookup then touches exactly
+one cache line, and so at most one page.  In exchange, the entries aren't
+spread quite as evenly (some blocks get more than their share), which
+raises pfalse_positive a bit for the same size and k; pfalse_positive()
+accounts for that.  The header and the list of idx names are the same as
+for v2.
 """
 
-import sys, os, math, mmap, struct
+from contextlib import contextmanager
+import sys, os, fcntl, math, mmap, struct
 
 from bup import _helpers
 from bup.helpers import (debug1, debug2, log, mmap_read, mmap_readwrite,
@@ -88,14 +100,18 @@ from bup.helpers import (debug1, debug2, log, mmap_read, mmap_readwrite,
 
 
 BLOOM_VERSION = 2
+BLOCKED_BLOOM_VERSION = 3
 MAX_BITS_EACH = 32 # Kinda arbitrary, but 4 bytes per entry is pretty big
 MAX_BLOOM_BITS = {4: 37, 5: 29} # 160/k-log2(8)
+BLOCK_BITS = 6 # v3 blocks are 2^6 bytes (a cache line)
+MAX_BLOCKED_BLOOM_BITS = 40
 MAX_PFALSE_POSITIVE = 1. # Totally arbitrary, needs benchmarking
 
 _total_searches = 0
 _total_steps = 0
 
 bloom_contains = _helpers.bloom_contains
+bloom_contains_many = _helpers.bloom_contains_many
 bloom_add = _helpers.bloom_add
 
 # FIXME: check bloom create() and ShaBloom handling/ownership of "f".
@@ -150,10 +166,11 @@ class ShaBloom:
             log('Warning: ignoring old-style (v%d) bloom %r\n' 
                 % (ver, filename))
             return self._init_failed()
-        if ver > BLOOM_VERSION:
+        if ver > BLOCKED_BLOOM_VERSION:
             log('Warning: ignoring too-new (v%d) bloom %r\n'
                 % (ver, filename))
             return self._init_failed()
+        self.version = ver
 
         self.bits, self.k, self.entries = struct.unpack('!HHI', self.map[8:16])
         idxnamestr = str(self.map[16 + 2**self.bits:])
@@ -170,6 +187,7 @@ class ShaBloom:
             self.rwfile = None
         self.idxnames = []
         self.bits = self.entries = 0
+        self.version = BLOOM_VERSION
 
     def valid(self):
         return self.map and self.bits
@@ -195,13 +213,27 @@ class ShaBloom:
         n = self.entries + additional
         m = 8*2**self.bits
         k = self.k
-        return 100*(1-math.exp(-k*float(n)/m))**k
+        if self.version < BLOCKED_BLOOM_VERSION:
+            return 100*(1-math.exp(-k*float(n)/m))**k
+        # The number of entries in each block is roughly Poisson
+        # distributed, so sum the false positive rate of a block with i
+        # entries, weighted by the probability of i.
+        block = 8*2**BLOCK_BITS
+        mean = float(n) * block / m
+        if not mean:
+            return 0.
+        p = 0.
+        for i in xrange(1, int(mean + 10*math.sqrt(mean) + 10)):
+            weight = math.exp(-mean + i*math.log(mean) - math.lgamma(i+1))
+            p += weight * (1-math.exp(-k*float(i)/block))**k
+        return 100*p
 
     def add(self, ids):
         """Add the hashes in ids (packed binary 20-bytes) to the filter."""
         if not self.map:
             raise Exception("Cannot add to closed bloom")
-        self.entries += bloom_add(self.map, ids, self.bits, self.k)
+        self.entries += bloom_add(self.map, ids, self.bits, self.k,
+                                  self.version)
 
     def add_idx(self, ix):
         """Add the object to the filter."""
@@ -219,25 +251,46 @@ class ShaBloom:
         _total_searches += 1
         if not self.map:
             return None
-        found, steps = bloom_contains(self.map, str(sha), self.bits, self.k)
+        found, steps = bloom_contains(self.map, str(sha), self.bits, self.k,
+                                      self.version)
         _total_steps += steps
         return found
 
+    def exists_many(self, shas):
+        """Return a list of what exists() would return for each of the
+        (binary) shas."""
+        global _total_searches
+        _total_searches += len(shas)
+        if not self.map:
+            return [None] * len(shas)
+        found = bloom_contains_many(self.map, ''.join(shas), self.bits, self.k,
+                                    self.version)
+        return [c == '\1' or None for c in found]
+
     def __len__(self):
         return int(self.entries)
 
 
-def create(name, expected, delaywrite=None, f=None, k=None):
+def create(name, expected, delaywrite=None, f=None, k=None,
+           version=BLOOM_VERSION):
     """Create and return a bloom filter for `expected` entries."""
     bits = int(math.floor(math.log(expected*MAX_BITS_EACH/8,2)))
-    k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
-    if bits > MAX_BLOOM_BITS[k]:
+    if version == BLOCKED_BLOOM_VERSION:
+        k = k or 5
+        bits = max(bits, BLOCK_BITS)
+        max_bits = MAX_BLOCKED_BLOOM_BITS
+    else:
+        assert(version == BLOOM_VERSION)
+        k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
+        max_bits = MAX_BLOOM_BITS[k]
+    if bits > max_bits:
         log('bloom: warning, max bits exceeded, non-optimal\n')
-        bits = MAX_BLOOM_BITS[k]
-    debug1('bloom: using 2^%d bytes and %d hash functions\n' % (bits, k))
+        bits = max_bits
+    debug1('bloom: using v%d, 2^%d bytes and %d hash functions\n'
+           % (version, bits, k))
     f = f or open(name, 'w+b')
     f.write('BLOM')
-    f.write(struct.pack('!IHHI', BLOOM_VERSION, bits, k, 0))
+    f.write(struct.pack('!IHHI', version, bits, k, 0))
     assert(f.tell() == 16)
     # NOTE: On some systems this will not extend+zerofill, but it does on
     # darwin, linux, bsd and solaris.
@@ -249,5 +302,48 @@ def create(name, expected, delaywrite=None, f=None, k=None):
     return ShaBloom(name, f=f, readwrite=True, expected=expected)
 
 
+@contextmanager
+def locked(dir):
+    """Hold an exclusive lock on dir/bup.bloom while in the context."""
+    fd = os.open(os.path.join(dir, 'bup.bloom.lock'), os.O_RDWR | os.O_CREAT,
+                 0666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def update(dir, ixs):
+    """Add the objects in the open idxs ixs that aren't already in
+    dir/bup.bloom to it, under its lock, and return true.  Return false
+    without changing anything if there's no valid filter, or if adding
+    them would make it too full (i.e. it needs regenerating)."""
+    name = os.path.join(dir, 'bup.bloom')
+    with locked(dir):
+        if not os.path.exists(name):
+            return False
+        b = ShaBloom(name)
+        if not b.valid():
+            return False
+        ixs = [ix for ix in ixs
+               if os.path.basename(ix.name) not in b.idxnames]
+        count = sum(len(ix) for ix in ixs)
+        if not count:
+            return True
+        if b.pfalse_positive(count) > MAX_PFALSE_POSITIVE:
+            debug1('bloom: adding %d entries gives %.2f%% false positives\n'
+                   % (count, b.pfalse_positive(count)))
+            return False
+        b.close()
+        b = ShaBloom(name, readwrite=True, expected=count)
+        if not b.valid():
+            return False
+        for ix in ixs:
+            b.add_idx(ix)
+        b.close()
+        return True
+
+
 def clear_bloom(dir):
     unlink(os.path.join(dir, 'bup.bloom'))
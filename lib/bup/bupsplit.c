@@ -116,6 +116,151 @@ int bupsplit_find_ofs(const unsigned char *buf, int len, int *bits)
 }
 
 
+// Gear hash values for FastCDC: the output of splitmix64 seeded with
+// 0x62757073706c6974 ("bupsplit").  These can never change without
+// changing every split point.
+static const uint64_t gear[256] = {
+    0xa62eec74c2356e51ULL, 0x1c0f19469af8d3e0ULL, 0xbdec128ee54144bbULL,
+    0xe9c4332c5505e3a9ULL, 0x95be6b5d3a380ad0ULL, 0xc0ac7fff7f89cacaULL,
+    0xf0881cc94f825fb5ULL, 0xce9fa1ef83f12474ULL, 0x3ed827b0d09c268aULL,
+    0x8b763c3e5c6027b7ULL, 0x037f857e70c71ccaULL, 0x30e2344b9d190566ULL,
+    0x0257c943c39dbfd4ULL, 0x783e2d9fb3ce5864ULL, 0x4e62767f72c312a8ULL,
+    0x708329c9660546a8ULL, 0x40e6f3f3f20c52aaULL, 0x6f86b9c49eaa2bf5ULL,
+    0x00ddc05b0ca89cb5ULL, 0x0a930b0b23992fe3ULL, 0x53c40029a0705324ULL,
+    0x58c37a04bd8f4996ULL, 0xf4655f74212e21c1ULL, 0x5aa85ce078821da3ULL,
+    0xfdf02f1510128343ULL, 0x520d4ea68451bd60ULL, 0xaf549c56a5dfe6c1ULL,
+    0x00ea5d5c1260de8bULL, 0x27a60b6b51b9cf74ULL, 0x3938b56f74ef714cULL,
+    0xb9b679b5047a9a31ULL, 0xd317fa77b12c4e2aULL, 0xb9e03776703118c8ULL,
+    0xb4f202b39f79f10dULL, 0x697eebee8cb4288eULL, 0xfb5d0047a8c93b25ULL,
+    0x70f3245819e20f81ULL, 0x655ecaf39972ce0fULL, 0x0938dacde1c1a346ULL,
+    0x6ba3d75b349df511ULL, 0x099fd78b10a9b487ULL, 0x99b786ea84cbb8a0ULL,
+    0x2a96fbc7393d6d43ULL, 0x8b91f3332b425a6cULL, 0xfc5a6b9ae7d5e606ULL,
+    0xbe7676acd907be91ULL, 0xd5f5a709c54399feULL, 0x1e3fc190efaf87feULL,
+    0x76fb758ad366b720ULL, 0x4b1ce44752e196aeULL, 0xdc8a99f1374ec843ULL,
+    0x8d9886c0e8536d11ULL, 0x8a23155a994f5281ULL, 0x671984d3c6cdc7ceULL,
+    0x29aa1ccd49dd9f1bULL, 0x19e375c4c0579887ULL, 0xcbd5351c92720152ULL,
+    0x9bb0c7e700e7773eULL, 0x0f9380d09e33fdd7ULL, 0x045a1f91d491ee8fULL,
+    0x7715fd5fc7a828e4ULL, 0x9621c68d84305c7dULL, 0x0296abc4cb86d614ULL,
+    0x43625c844fdb4b47ULL, 0x96f1555c2090e145ULL, 0xc2e66f8a5536d930ULL,
+    0x829a64d52911730bULL, 0xa88a033aa3db9abeULL, 0x91d0882a36bd7841ULL,
+    0xebb04b466afbc638ULL, 0xd484bccb609b2dedULL, 0x12c7ddf273b95ec3ULL,
+    0x1e2ddaa71fbbe4e9ULL, 0x379e7f9ab7dbcba5ULL, 0x58c4f74fd6894f27ULL,
+    0x9177f57720cf50d1ULL, 0x58fdbf66341ef7c4ULL, 0x521b78a9f733a10aULL,
+    0xabe877d84338fd15ULL, 0x4c9f920ae7fccdb9ULL, 0xa30c02cba6e966bdULL,
+    0x8d401599db23ebb6ULL, 0x5e4eb360e2dfbc3dULL, 0xdf912eb532002767ULL,
+    0x38e31d2d30535154ULL, 0xbb46d062a27a86ebULL, 0xef745d544aded8f4ULL,
+    0xf07a62a990c2ecdfULL, 0x98a82f64397f7c55ULL, 0xc932120e5e8b0be1ULL,
+    0x4173a95427bec38cULL, 0x01c36c90e87d4beeULL, 0xd9806615811af560ULL,
+    0x09de760cfef7b6c1ULL, 0x73a174cd5182e353ULL, 0x72a117e8a8a5eee1ULL,
+    0xe6fba14dbd0ef075ULL, 0x03080a52f57ae40bULL, 0xa92c26e740f3d0faULL,
+    0x4d826d997e8058d6ULL, 0xdc63945f2ef2becaULL, 0x8f3137c50be1fa7aULL,
+    0xa1bbf011d119e8fcULL, 0xaf704ff805de37f3ULL, 0x80d3ec9702f43438ULL,
+    0x2376bf7fe5e5cdb8ULL, 0xe0a376c816dc6d66ULL, 0xb2ae881edc2bf450ULL,
+    0x52d4f98daad156e0ULL, 0x49baf8dde4f27844ULL, 0xd5adea3325dc8b3bULL,
+    0x7840c28da44daa85ULL, 0x7ab41b5de947f090ULL, 0xb3b07d2d40676c24ULL,
+    0x344ff715ef8eaf82ULL, 0xe13a7f6d7f3cd1b2ULL, 0x5c27299a5d632f58ULL,
+    0xca35ccb027c1b9d0ULL, 0x03c378bbe44be5f6ULL, 0x1772c00da7255a7bULL,
+    0xf0cc6ba9744514ebULL, 0x0a7b15ad1ad98dceULL, 0x23154dac48b90122ULL,
+    0x832b6e53d102709dULL, 0xb113f4ed726376fcULL, 0x3685224ad5122878ULL,
+    0x1a4e97acfe1549eeULL, 0x7ddf13335c19cc50ULL, 0xdcba10659e0d6e9fULL,
+    0x246012c7a110ed37ULL, 0xcb0f660cad6b9cc9ULL, 0x82e1b217c0b8e247ULL,
+    0x772fe40991c75e21ULL, 0xf319b75be5e5291fULL, 0x6db3ab9adc82dd83ULL,
+    0x2a3159fd0beb6d6dULL, 0x2f6fee683a6e42a3ULL, 0x8cf44f119005da7bULL,
+    0x154fb48899649302ULL, 0xa29b4627dc1d0ed4ULL, 0xc3a3aa52eff9f71fULL,
+    0xfee3a63339f4dc84ULL, 0x46119a467901e2e6ULL, 0x2f619bb8761db24cULL,
+    0x1a197f7628e87256ULL, 0x560682ec0a4496daULL, 0x237709efafa3e893ULL,
+    0x87099cf0501a832aULL, 0xe81d1adfdc9bb039ULL, 0xad25c40f990ea0c8ULL,
+    0xd042fe397e3d4685ULL, 0xa222283beab19a6dULL, 0xad71faa2b5277244ULL,
+    0x0f8065bb1e5fd7ccULL, 0x6dd80628fc0a4126ULL, 0xe7880c15c661b14fULL,
+    0xdd5f2018dd22cab8ULL, 0x927e0f3493a1caa9ULL, 0x150238f2eab132a0ULL,
+    0x31cb29abd05ca3bbULL, 0x04ecc39962c44843ULL, 0x8eb5292e32cedafcULL,
+    0x286a4a6de6de1c60ULL, 0xda5a0fe1777e21dcULL, 0xaa303cd2f54b9d82ULL,
+    0x6b3d7f5a49272474ULL, 0x07f62bf37b34da5eULL, 0xa6abf26fbbe899a5ULL,
+    0x3d139c7c8e32fcb6ULL, 0x5b89106910c66e37ULL, 0x35d30dbd50521437ULL,
+    0xea29dc4bbca40456ULL, 0x7c9f427931b7b7b9ULL, 0xd2fd7aaf58e0369aULL,
+    0x8c286893158ec3f6ULL, 0x9a9a9c6609e80ac1ULL, 0x483d208c1063bb8aULL,
+    0x7dde8fce0561845dULL, 0x3b30eda6ded10835ULL, 0xe971016972abde69ULL,
+    0xb292048b091436d8ULL, 0x55a5d6822b8f47b0ULL, 0x9136fa10e17dfea4ULL,
+    0x84cf6d877a24388aULL, 0x172924b173abe9a0ULL, 0x8e56a94094e0b59dULL,
+    0x107b55c23c98ed67ULL, 0x0dc1a55edd44f7a2ULL, 0xc421c14ed0fe4bbdULL,
+    0x90809db1a918bc0dULL, 0xd1e1df71a6191909ULL, 0xb03ec6e35726ceebULL,
+    0x855b459495e300efULL, 0xfbb0c5769fe7b42eULL, 0x12dc4d2d5ee85e79ULL,
+    0x63d141979589dc4fULL, 0x9c6bb4f52fe3d36aULL, 0x5cf0a1f1535ec4a5ULL,
+    0x00708b16585aadfcULL, 0x3e6b56b308be1640ULL, 0x69b5027bdbd419a4ULL,
+    0xa44bc08fbb4f062aULL, 0x5cf611132891f6ceULL, 0x39c19158e26ee80fULL,
+    0xebf8086cde273f33ULL, 0x0f7afedc1f7e589dULL, 0x8e77ed2c3cb80ce3ULL,
+    0xb20c7c41f4b597d9ULL, 0xa62e890583f1f24bULL, 0x55b32f4dd5f1370fULL,
+    0x208c96b7965df9f5ULL, 0xbfe24b8a2c65b791ULL, 0xf32ce282228a3493ULL,
+    0x5e6981ac328b022eULL, 0xbeea9ed6bf0a9f07ULL, 0x00b96b015ee0d477ULL,
+    0xd1f8e8dbd86c4bc1ULL, 0x62b412feed6e4d08ULL, 0xcb1452ddb9cc8333ULL,
+    0x1fb5801e8421d0bcULL, 0x214f79e39f525b4cULL, 0xce0ec6cdca8abb6bULL,
+    0xbca127777e79ca5dULL, 0x9055701c2fad52b0ULL, 0x79e0f0593f5f9ed5ULL,
+    0x8e4d3cec08da5376ULL, 0x2015638aa1682de3ULL, 0x366b8fe2457285b4ULL,
+    0x81fa127aa1589715ULL, 0x2fe480884710a7abULL, 0xbfa06e022783fd4cULL,
+    0x90969dc395f94720ULL, 0x361b192b506c04e7ULL, 0x794a2f87ab79529bULL,
+    0x92a4baad39260bb0ULL, 0x47a51c3e838f9a1aULL, 0xf4993fae49466d8cULL,
+    0x09fbb3da958d4242ULL, 0xdea6c0659d6eb04fULL, 0x58178102ea8053d5ULL,
+    0xcbf3dfbcab11f974ULL, 0x9550e36f93e928fdULL, 0xbee357bab8c8fb7eULL,
+    0xf2592668c4cae65bULL, 0x0f67ca6c78817ad0ULL, 0xed4637260a3b84bdULL,
+    0x4e323f95fa629cb6ULL, 0x8bd4bb574da07d27ULL, 0x164a79049ab9d083ULL,
+    0x1b7d18f156c9cfffULL, 0x0335682cba9ee373ULL, 0x5fe2bb25a754fab6ULL,
+    0xa6484b489786127fULL, 0xa5fa08f4901f56ddULL, 0x051d09f68956c127ULL,
+    0xaa10603d8298376cULL
+};
+
+// FastCDC (Xia et al., USENIX ATC 2016) with normalized chunking.
+// Nothing before FASTCDC_MIN_SIZE can be a split point, and the gear
+// hash has to match more bits before BUP_BLOBSIZE than after it, which
+// pulls the chunk sizes in towards BUP_BLOBSIZE.  The masks use the top
+// bits of the hash, since those depend on the most recent 64 bytes.
+#define FASTCDC_MIN_SIZE (BUP_BLOBSIZE / 4)
+#define FASTCDC_SMALL_BITS (BUP_BLOBBITS + 2)
+#define FASTCDC_LARGE_BITS (BUP_BLOBBITS - 2)
+
+int bupsplit_fastcdc_find_ofs(const unsigned char *buf, int len, int *bits)
+{
+    const uint64_t mask_s = ~0ULL << (64 - FASTCDC_SMALL_BITS);
+    const uint64_t mask_l = ~0ULL << (64 - FASTCDC_LARGE_BITS);
+    const int normal = len < BUP_BLOBSIZE ? len : BUP_BLOBSIZE;
+    uint64_t h = 0;
+    int count, matched;
+
+    for (count = FASTCDC_MIN_SIZE; count < normal; count++)
+    {
+	h = (h << 1) + gear[buf[count]];
+	if (!(h & mask_s))
+	{
+	    matched = FASTCDC_SMALL_BITS;
+	    goto found;
+	}
+    }
+    for (; count < len; count++)
+    {
+	h = (h << 1) + gear[buf[count]];
+	if (!(h & mask_l))
+	{
+	    matched = FASTCDC_LARGE_BITS;
+	    goto found;
+	}
+    }
+    return 0;
+
+found:
+    if (bits)
+    {
+	// As with the rollsum, each further matching (zero) bit of the
+	// hash raises the split level by one.
+	uint64_t rest = h << matched;
+	for (*bits = BUP_BLOBBITS; matched < 64 && !(rest >> 63); matched++)
+	{
+	    rest <<= 1;
+	    (*bits)++;
+	}
+    }
+    return count+1;
+}
+
+
 #ifndef BUP_NO_SELFTEST
 #define BUP_SELFTEST_SIZE 100000
 
@@ -269,14 +269,16 @@ class Client:
         idx = None
         for idx in suggested:
             self.sync_index(idx)
-        git.auto_midx(self.cachedir)
+        git.auto_midx(self.cachedir,
+                      [os.path.join(self.cachedir, idx) for idx in suggested])
         if ob:
             self._busy = ob
             self.conn.write('%s\n' % ob)
         return idx
 
     def new_packwriter(self, compression_level=1,
-                       max_pack_size=None, max_pack_objects=None):
+                       max_pack_size=None, max_pack_objects=None,
+                       compress_threads=1, adaptive_compression=False):
         self._require_command('receive-objects-v2')
         self.check_busy()
         def _set_busy():
@@ -290,7 +292,9 @@ class Client:
                                  ensure_busy = self.ensure_busy,
                                  compression_level=compression_level,
                                  max_pack_size=max_pack_size,
-                                 max_pack_objects=max_pack_objects)
+                                 max_pack_objects=max_pack_objects,
+                                 compress_threads=compress_threads,
+                                 adaptive_compression=adaptive_compression)
 
     def read_ref(self, refname):
         self._require_command('read-ref')
@@ -312,6 +316,17 @@ class Client:
                            (oldval or '').encode('hex')))
         self.check_ok()
 
+    def config_get(self, name):
+        """Return the value of the remote repository's git config
+        setting name, or None if it isn't set or the server can't say."""
+        if 'config-get' not in self._available_commands:
+            return None
+        self.check_busy()
+        self.conn.write('config-get %s\n' % re.sub(r'[\n\r ]', '_', name))
+        r = self.conn.readline().strip()
+        self.check_ok()
+        return r or None
+
     def join(self, id):
         self._require_command('join')
         self.check_busy()
@@ -328,12 +343,20 @@ class Client:
         if e:
             raise KeyError(str(e))
 
-    def cat_batch(self, refs):
-        self._require_command('cat-batch')
+    def cat_batch(self, refs, include_data=True):
+        """Yield (oidx, type, size, data_iter) for each of the refs, or
+        (None, None, None, None) for any that don't exist.  Unless
+        include_data is true, the server only sends the objects' types
+        and sizes, and data_iter is always None."""
+        send_data = include_data \
+                    or 'cat-batch-check' not in self._available_commands
+        # Older servers can only send the content too, so it's discarded
+        command = 'cat-batch' if send_data else 'cat-batch-check'
+        self._require_command(command)
         self.check_busy()
-        self._busy = 'cat-batch'
+        self._busy = command
         conn = self.conn
-        conn.write('cat-batch\n')
+        conn.write(command + '\n')
         # FIXME: do we want (only) binary protocol?
         for ref in refs:
             assert ref
@@ -351,7 +374,15 @@ class Client:
                                   % info)
             oidx, oid_t, size = info.split(' ')
             size = int(size)
+            if not send_data:
+                yield oidx, oid_t, size, None
+                continue
             cr = chunkyreader(conn, size)
+            if not include_data:
+                for _ in cr:
+                    pass
+                yield oidx, oid_t, size, None
+                continue
             yield oidx, oid_t, size, cr
             detritus = next(cr, None)
             if detritus:
@@ -441,12 +472,16 @@ class PackWriter_Remote(git.PackWriter):
                  ensure_busy,
                  compression_level=1,
                  max_pack_size=None,
-                 max_pack_objects=None):
+                 max_pack_objects=None,
+                 compress_threads=1,
+                 adaptive_compression=False):
         git.PackWriter.__init__(self,
                                 objcache_maker=objcache_maker,
                                 compression_level=compression_level,
                                 max_pack_size=max_pack_size,
-                                max_pack_objects=max_pack_objects)
+                                max_pack_objects=max_pack_objects,
+                                compress_threads=compress_threads,
+                                adaptive_compression=adaptive_compression)
         self.file = conn
         self.filename = 'remote socket'
         self.suggest_packs = suggest_packs
@@ -472,6 +507,10 @@ class PackWriter_Remote(git.PackWriter):
             return self.suggest_packs() # Returns last idx received
 
     def close(self):
+        try:
+            self._finish_writes()
+        finally:
+            self._close_encode_pool()
         id = self._end()
         self.file = None
         return id
@@ -479,7 +518,7 @@ class PackWriter_Remote(git.PackWriter):
     def abort(self):
         raise ClientError("don't know how to abort remote pack writing")
 
-    def _raw_write(self, datalist, sha):
+    def _raw_write(self, datalist, sha, crc=None):
         assert(self.file)
         if not self._packopen:
             self._open()
@@ -487,7 +526,8 @@ class PackWriter_Remote(git.PackWriter):
         data = ''.join(datalist)
         assert(data)
         assert(sha)
-        crc = zlib.crc32(data) & 0xffffffff
+        if crc is None:
+            crc = zlib.crc32(data) & 0xffffffff
         outbuf = ''.join((struct.pack('!I', len(data) + 20 + 4),
                           sha,
                           struct.pack('!I', crc),
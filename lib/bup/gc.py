@@ -1,43 +1,39 @@
-import glob, os, subprocess, sys, tempfile
-from bup import bloom, git, midx
+import glob, os, subprocess, sys
+from bup import bloom, git, hashtable, midx, packread
 from bup.git import MissingObject, walk_object
 from bup.helpers import Nonlocal, log, progress, qprogress
 from os.path import basename
 
-# This garbage collector uses a Bloom filter to track the live objects
-# during the mark phase.  This means that the collection is
-# probabilistic; it may retain some (known) percentage of garbage, but
-# it can also work within a reasonable, fixed RAM budget for any
-# particular percentage and repository size.
+# This garbage collector tracks the live objects during the mark phase
+# with one bit for each object in each of the repository's idx files,
+# so the collection is exact, and it works within a fixed RAM budget
+# (an eighth of a byte per object) for any particular repository size.
 #
 # The collection proceeds as follows:
 #
-#   - Scan all live objects by walking all of the refs, and insert
-#     every hash encountered into a new Bloom "liveness" filter.
-#     Compute the size of the liveness filter based on the total
-#     number of objects in the repository.  This is the "mark phase".
+#   - Scan all live objects by walking all of the refs, and set the
+#     "liveness" bit of every hash encountered (in whichever idx the
+#     repository's PackIdxList finds it in first).  Skip any object
+#     that's already live, along with everything reachable from it,
+#     since that's already been (or is being) visited.  This is the
+#     "mark phase".
 #
 #   - Clear the data that's dependent on the repository's object set,
 #     i.e. the reflog, the normal Bloom filter, and the midxes.
 #
-#   - Traverse all of the pack files, consulting the liveness filter
-#     to decide which objects to keep.
+#   - Traverse all of the pack files, consulting the liveness bits to
+#     decide which objects to keep.
 #
-#     For each pack file, rewrite it iff it probably contains more
-#     than (currently) 10% garbage (computed by an initial traversal
-#     of the packfile in consultation with the liveness filter).  To
-#     rewrite, traverse the packfile (again) and write each hash that
-#     tests positive against the liveness filter to a packwriter.
+#     For each pack file, rewrite it iff it contains more than
+#     (currently) 10% garbage.  To rewrite, traverse the packfile and
+#     copy each live object to a packwriter, as it's stored, i.e.
+#     without inflating and deflating it again (unless it's a delta).
+#     An object that's in more than one pack is only live in one of
+#     them, so the others' copies are discarded.
 #
 #     During the traversal of all of the packfiles, delete redundant,
 #     old packfiles only after the packwriter has finished the pack
 #     that contains all of their live objects.
-#
-# The current code unconditionally tracks the set of tree hashes seen
-# during the mark phase, and skips any that have already been visited.
-# This should decrease the IO load at the cost of increased RAM use.
-
-# FIXME: add a bloom filter tuning parameter?
 
 
 def count_objects(dir, verbosity):
@@ -86,41 +82,77 @@ def report_live_item(n, total, ref_name, ref_id, item, verbosity):
         log('%s %s:%s%s\n' % (status, hex_id, ps, dirslash))
 
 
+class LiveObjects:
+    """An exact set of the (binary) ids of the objects in the idx files
+    in pack_dir, kept as a bitmap for each idx, indexed by each
+    object's position in the idx."""
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        self.count = 0
+        self.bitmaps = {}
+        self._idxes = {}
+        for idx_name in glob.glob(os.path.join(pack_dir, '*.idx')):
+            ix = git.open_idx(idx_name)
+            self._idxes[basename(idx_name)] = ix
+            self.bitmaps[basename(idx_name)] = bytearray((len(ix) + 7) // 8)
+        self._idxlist = git.PackIdxList(pack_dir, exclusive=False)
+        # Live objects that aren't in any idx (i.e. loose ones), which
+        # gc doesn't touch, but the mark phase still has to remember.
+        self._others = hashtable.ShaSet()
+
+    def close(self):
+        self._idxlist = self._idxes = None
+
+    def _position(self, oid):
+        # Return (bitmap, i) for the object, or (None, None).
+        source = self._idxlist.exists(oid, want_source=True)
+        bitmap = source and self.bitmaps.get(source)
+        if not bitmap:
+            return None, None
+        return bitmap, self._idxes[source]._find_sorted(str(oid))[0]
+
+    def __contains__(self, oid):
+        bitmap, i = self._position(oid)
+        if bitmap is None:
+            return oid in self._others
+        return bool(bitmap[i >> 3] & (1 << (i & 7)))
+
+    def add(self, oid):
+        """Add the object to the set, and return true if it wasn't
+        already there."""
+        bitmap, i = self._position(oid)
+        if bitmap is None:
+            if oid in self._others:
+                return False
+            self._others.add(oid)
+        else:
+            bit = 1 << (i & 7)
+            if bitmap[i >> 3] & bit:
+                return False
+            bitmap[i >> 3] |= bit
+        self.count += 1
+        return True
+
+
+_bit_counts = [bin(i).count('1') for i in range(256)]
+
+def _live_count(bitmap):
+    return sum(_bit_counts[b] for b in bitmap)
+
+
 def find_live_objects(existing_count, cat_pipe, verbosity=0):
-    prune_visited_trees = True # In case we want a command line option later
-    pack_dir = git.repo('objects/pack')
-    ffd, bloom_filename = tempfile.mkstemp('.bloom', 'tmp-gc-', pack_dir)
-    os.close(ffd)
-    # FIXME: allow selection of k?
-    # FIXME: support ephemeral bloom filters (i.e. *never* written to disk)
-    live_objs = bloom.create(bloom_filename, expected=existing_count, k=None)
-    # live_objs will hold on to the fd until close or exit
-    os.unlink(bloom_filename)
-    stop_at, trees_visited = None, None
-    if prune_visited_trees:
-        trees_visited = set()
-        stop_at = lambda (x): x.decode('hex') in trees_visited
-    approx_live_count = 0
+    live_objs = LiveObjects(git.repo('objects/pack'))
+    stop_at = lambda (x): x.decode('hex') in live_objs
     for ref_name, ref_id in git.list_refs():
         for item in walk_object(cat_pipe, ref_id.encode('hex'),
                                 stop_at=stop_at,
                                 include_data=None):
-            # FIXME: batch ids
             if verbosity:
-                report_live_item(approx_live_count, existing_count,
+                report_live_item(live_objs.count, existing_count,
                                  ref_name, ref_id, item, verbosity)
-            if trees_visited is not None and item.type == 'tree':
-                trees_visited.add(item.oid)
-            if verbosity:
-                if not live_objs.exists(item.oid):
-                    live_objs.add(item.oid)
-                    approx_live_count += 1
-            else:
-                live_objs.add(item.oid)
-    trees_visited = None
+            live_objs.add(item.oid)
     if verbosity:
-        log('expecting to retain about %.2f%% unnecessary objects\n'
-            % live_objs.pfalse_positive())
+        log('found %d live objects\n' % live_objs.count)
     return live_objs
 
 
@@ -154,14 +186,15 @@ def sweep(live_objects, existing_count, cat_pipe, threshold, compression,
         if verbosity:
             qprogress('preserving live data (%d%% complete)\r'
                       % ((float(collect_count) / existing_count) * 100))
+        live = live_objects.bitmaps.get(basename(idx_name))
+        if live is None:
+            # It appeared after the mark phase
+            if verbosity:
+                log('keeping new %s\n' % git.repo_rel(basename(idx_name)))
+            continue
         idx = git.open_idx(idx_name)
 
-        idx_live_count = 0
-        for i in xrange(0, len(idx)):
-            sha = idx.shatable[i * 20 : (i + 1) * 20]
-            if live_objects.exists(sha):
-                idx_live_count += 1
-
+        idx_live_count = _live_count(live)
         collect_count += idx_live_count
         if idx_live_count == 0:
             if verbosity:
@@ -181,12 +214,18 @@ def sweep(live_objects, existing_count, cat_pipe, threshold, compression,
         if verbosity:
             log('rewriting %s (%.2f%% live)\n' % (basename(idx_name),
                                                   live_frac * 100))
+        stored = packread.StoredObjects(idx, idx_name[:-3] + 'pack')
         for i in xrange(0, len(idx)):
-            sha = idx.shatable[i * 20 : (i + 1) * 20]
-            if live_objects.exists(sha):
+            if live[i >> 3] & (1 << (i & 7)):
+                sha = idx._idx_to_hash(i)
+                data, crc = stored.get(i)
+                if data is not None:
+                    writer.just_write_encoded(sha, data, crc)
+                    continue
                 item_it = cat_pipe.get(sha.encode('hex'))
                 _, typ, _ = next(item_it)
                 writer.just_write(sha, typ, ''.join(item_it))
+        stored.close()
 
         ns.stale_files.append(idx_name)
         ns.stale_files.append(idx_name[:-3] + 'pack')
@@ -233,6 +272,7 @@ def bup_gc(threshold=10, compression=1, verbosity=0):
             midx.clear_midxes()
             if verbosity: log('clearing bloom filter\n')
             bloom.clear_bloom(git.repo('objects/pack'))
+            hashtable.clear_hashtable(git.repo('objects/pack'))
             if verbosity: log('clearing reflog\n')
             expirelog_cmd = ['git', 'reflog', 'expire', '--all', '--expire=all']
             expirelog = subprocess.Popen(expirelog_cmd, preexec_fn = git._gitenv())
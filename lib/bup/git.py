@@ -3,13 +3,17 @@ bup repositories are in Git format. This library allows us to
 interact with the Git data structures.
 """
 
+from Queue import Queue
 import errno, os, sys, zlib, time, subprocess, struct, stat, re, tempfile, glob
-from collections import namedtuple
-from itertools import islice
+import threading
+from collections import deque, namedtuple
+from itertools import islice, izip
 from numbers import Integral
 
-from bup import _helpers, compat, hashsplit, path, midx, bloom, xstat
-from bup.helpers import (Sha1, add_error, chunkyreader, debug1, debug2,
+from bup import (_helpers, compat, hashsplit, hashtable, packread, path,
+                 midx, bloom, xstat)
+from bup.helpers import (Sha1, add_error, atomically_replaced_file,
+                         chunkyreader, debug1, debug2,
                          fdatasync,
                          hostname, localtime, log, merge_iter,
                          mmap_read, mmap_readwrite,
@@ -169,16 +173,29 @@ def all_packdirs():
     return paths
 
 
-def auto_midx(objdir):
-    args = [path.exe(), 'midx', '--auto', '--dir', objdir]
+def auto_midx(objdir, new_idxs=None):
+    """Update the midx files, bloom filter and hash table (if any) in
+    objdir.  If new_idxs lists the idx files added to objdir since the
+    last call, they're added to the bloom and hash table directly, and
+    "bup bloom" only runs if the filter is missing or needs to grow."""
+    # Same as "bup midx --auto", but without the cost of starting a
+    # new process every time a pack is finished.
     try:
-        rv = subprocess.call(args, stdout=open('/dev/null', 'w'))
-    except OSError as e:
-        # make sure 'args' gets printed to help with debugging
-        add_error('%r: exception: %s' % (args, e))
-        raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
+        midx.compact(objdir)
+    except (EnvironmentError, GitError) as e:
+        add_error('%s: midx: %s' % (objdir, e))
+
+    if new_idxs is not None:
+        try:
+            hashtable.update(objdir, new_idxs)
+        except (EnvironmentError, GitError, ValueError) as e:
+            add_error('%s: hashtable: %s' % (objdir, e))
+        try:
+            if bloom.update(objdir, [open_idx(name) for name in new_idxs]):
+                return
+        except (EnvironmentError, GitError) as e:
+            add_error('%s: bloom: %s' % (objdir, e))
+            return
 
     args = [path.exe(), 'bloom', '--dir', objdir]
     try:
@@ -350,6 +367,15 @@ class PackIdx:
             return want_source and os.path.basename(self.name) or True
         return None
 
+    def exists_many(self, hashes, want_source=False):
+        """Return a list of what exists() would return for each of the
+        sorted (binary) hashes."""
+        global _total_searches
+        _total_searches += len(hashes)
+        found = want_source and os.path.basename(self.name) or True
+        return [found if i is not None else None
+                for i in self._find_sorted(''.join(hashes))]
+
     def __len__(self):
         return int(self.fanout[255])
 
@@ -391,9 +417,16 @@ class PackIdxV1(PackIdx):
     def _ofs_from_idx(self, idx):
         return struct.unpack('!I', str(self.shatable[idx*24 : idx*24+4]))[0]
 
+    def _find_sorted(self, hashes):
+        return _helpers.find_sorted_shas(buffer(self.shatable, 4), 24,
+                                         len(self), hashes)
+
     def _idx_to_hash(self, idx):
         return str(self.shatable[idx*24+4 : idx*24+24])
 
+    def _crc_from_idx(self, idx):
+        return None  # v1 doesn't record them
+
     def __iter__(self):
         for i in xrange(self.fanout[255]):
             yield buffer(self.map, 256*4 + 24*i + 4, 20)
@@ -412,6 +445,7 @@ class PackIdxV2(PackIdx):
         nsha = self.fanout[255]
         self.sha_ofs = 8 + 256*4
         self.shatable = buffer(self.map, self.sha_ofs, nsha*20)
+        self.crctable = buffer(self.map, self.sha_ofs + nsha*20, nsha*4)
         self.ofstable = buffer(self.map,
                                self.sha_ofs + nsha*20 + nsha*4,
                                nsha*4)
@@ -429,19 +463,211 @@ class PackIdxV2(PackIdx):
     def _idx_to_hash(self, idx):
         return str(self.shatable[idx*20:(idx+1)*20])
 
+    def _crc_from_idx(self, idx):
+        return struct.unpack('!I', str(buffer(self.crctable, idx*4, 4)))[0]
+
+    def _find_sorted(self, hashes):
+        return _helpers.find_sorted_shas(self.shatable, 20, len(self), hashes)
+
     def __iter__(self):
         for i in xrange(self.fanout[255]):
             yield buffer(self.map, 8 + 256*4 + 20*i, 20)
 
 
+class _IdxGroup:
+    """Search a few indexes as if they were one.  Stands in for a midx
+    that disappeared (e.g. was merged into a bigger one) before it was
+    opened."""
+    def __init__(self, ixs):
+        self.ixs = ixs
+
+    def __iter__(self):
+        return iter(idxmerge(self.ixs, final_progress=False))
+
+    def __len__(self):
+        return sum(len(ix) for ix in self.ixs)
+
+    def exists(self, hash, want_source=False):
+        for ix in self.ixs:
+            found = ix.exists(hash, want_source=want_source)
+            if found:
+                return found
+        return None
+
+    def exists_many(self, hashes, want_source=False):
+        result = [None] * len(hashes)
+        for ix in self.ixs:
+            found = ix.exists_many(hashes, want_source=want_source)
+            result = [old or new for old, new in zip(result, found)]
+        return result
+
+
+class _LazyIdx:
+    """An index that isn't opened (or mapped) until it's first searched.
+    Its length, and for a midx its idxnames, come from the pack dir
+    listing, so PackIdxList can order and prune indexes without opening
+    any of them."""
+    def __init__(self, name, info):
+        self.name = name
+        self.count = info.count
+        self.force_keep = info.force_keep
+        if name.endswith('.midx'):
+            self.idxnames = info.idxnames
+        else:
+            self.idxnames = [name]
+        self._ix = None
+
+    def _open(self):
+        if self._ix is None:
+            try:
+                self._ix = open_idx(self.name)
+            except EnvironmentError as e:
+                if e.errno != errno.ENOENT or not self.name.endswith('.midx'):
+                    raise
+                dir = os.path.dirname(self.name)
+                self._ix = _IdxGroup([open_idx(os.path.join(dir, name))
+                                      for name in self.idxnames])
+        return self._ix
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._open(), name)
+
+    def __iter__(self):
+        return iter(self._open())
+
+    def __len__(self):
+        return self.count
+
+    def exists(self, hash, want_source=False):
+        return self._open().exists(hash, want_source=want_source)
+
+    def exists_many(self, hashes, want_source=False):
+        return self._open().exists_many(hashes, want_source=want_source)
+
+    def close(self):
+        ix, self._ix = self._ix, None
+        if ix and hasattr(ix, 'close'):
+            ix.close()
+
+
+def _is_midx(ix):
+    """Return true if ix (an index or its name) is a midx."""
+    name = getattr(ix, 'name', ix)
+    return name.endswith('.midx')
+
+
+# What PackIdxList needs to know about an index without opening it.
+# The mtime and idxnames are only recorded for midxes.
+_IndexInfo = namedtuple('_IndexInfo', ('count', 'mtime', 'force_keep',
+                                       'idxnames'))
+
+_manifest_version = 1
+
+def _manifest_name(dir):
+    # Kept next to the pack dir rather than in it, so that writing it
+    # doesn't change the mtime it records.
+    return os.path.normpath(dir) + '.manifest'
+
+
+def _read_manifest(dir):
+    """Return the pack dir mtime and index listing recorded by
+    _write_manifest(), or (None, {}) if there's no usable manifest."""
+    try:
+        with open(_manifest_name(dir), 'rb') as f:
+            lines = f.read().split('\n')
+        header = lines[0].split(' ')
+        if header[:2] != ['BUPMANIFEST', str(_manifest_version)] \
+           or lines[-1] != '':
+            return None, {}
+        listing = {}
+        for line in lines[1:-1]:
+            fields = line.split('\0')
+            listing[os.path.join(dir, fields[3])] = \
+                _IndexInfo(int(fields[0]), int(fields[1]), fields[2] == '1',
+                           fields[4:])
+        return int(header[2]), listing
+    except (EnvironmentError, IndexError, ValueError):
+        return None, {}
+
+
+def _write_manifest(dir, mtime, listing):
+    try:
+        with atomically_replaced_file(_manifest_name(dir), 'wb') as f:
+            f.write('BUPMANIFEST %d %d\n' % (_manifest_version, mtime))
+            for name, info in sorted(listing.iteritems()):
+                f.write('\0'.join(['%d' % info.count, '%d' % info.mtime,
+                                   info.force_keep and '1' or '0',
+                                   os.path.basename(name)]
+                                  + info.idxnames))
+                f.write('\n')
+    except EnvironmentError as e:
+        debug1('PackIdxList: unable to write manifest: %s\n' % e)
+
+
+def _index_listing(dir):
+    """Return a dict mapping the path of each .idx and .midx in dir to
+    its _IndexInfo.  When nothing has been added to or removed from dir
+    since the listing was last saved, it's read back from the manifest
+    without looking at any of the indexes."""
+    before = xstat.stat(dir).st_mtime
+    mtime, old = _read_manifest(dir)
+    if mtime == before:
+        return old
+    listing = {}
+    for full in glob.glob(os.path.join(dir, '*.idx')):
+        # idx files are named after their content, so an old count is
+        # still good.
+        info = old.get(full)
+        if not info:
+            try:
+                ix = open_idx(full)
+            except GitError as e:
+                add_error(e)
+                continue
+            except EnvironmentError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            info = _IndexInfo(len(ix), 0, False, [])
+            del ix
+        listing[full] = info
+    for full in glob.glob(os.path.join(dir, '*.midx')):
+        try:
+            mx = midx.PackMidx(full)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        try:
+            listing[full] = _IndexInfo(len(mx), xstat.stat(full).st_mtime,
+                                       bool(mx.force_keep),
+                                       [os.path.basename(name)
+                                        for name in mx.idxnames])
+        finally:
+            mx.close()
+    after = xstat.stat(dir).st_mtime
+    # Don't save a listing that might have missed a change, either
+    # during the scan or within the same mtime tick as it.
+    if after == before and time.time() - after / 10**9 > 2:
+        _write_manifest(dir, after, listing)
+    return listing
+
+
 _mpi_count = 0
 class PackIdxList:
-    def __init__(self, dir):
+    def __init__(self, dir, exclusive=True):
+        """Unless exclusive is false (e.g. for a PackReader's own
+        lookups), this must be the only PackIdxList."""
         global _mpi_count
-        assert(_mpi_count == 0) # these things suck tons of VM; don't waste it
-        _mpi_count += 1
+        self.exclusive = exclusive
+        if exclusive:
+            # these things suck tons of VM; don't waste it
+            assert(_mpi_count == 0)
+            _mpi_count += 1
         self.dir = dir
-        self.also = set()
+        self.also = hashtable.ShaSet()
         self.packs = []
         self.do_bloom = False
         self.bloom = None
@@ -449,8 +675,9 @@ class PackIdxList:
 
     def __del__(self):
         global _mpi_count
-        _mpi_count -= 1
-        assert(_mpi_count == 0)
+        if self.exclusive:
+            _mpi_count -= 1
+            assert(_mpi_count == 0)
 
     def __iter__(self):
         return iter(idxmerge(self.packs))
@@ -481,6 +708,39 @@ class PackIdxList:
         self.do_bloom = True
         return None
 
+    def exists_many(self, hashes, want_source=False):
+        """Return a list of what exists() would return for each of the
+        sorted (binary) hashes.  The bloom filter (if any) and then each
+        index are consulted once for all the hashes they haven't ruled
+        out or found yet."""
+        global _total_searches
+        result = [None] * len(hashes)
+        todo = []
+        for i, also in enumerate(self.also.exists_many(hashes)):
+            if also:
+                result[i] = True
+            else:
+                todo.append(i)
+        if todo and self.bloom:
+            maybe = self.bloom.exists_many([hashes[i] for i in todo])
+            _total_searches -= len(todo)  # counted by the bloom
+            todo = [i for i, found in zip(todo, maybe) if found]
+        for p in self.packs:
+            if not todo:
+                break
+            _total_searches -= len(todo)  # will be counted by the pack
+            found = p.exists_many([hashes[i] for i in todo],
+                                  want_source=want_source)
+            missing = []
+            for i, ix in zip(todo, found):
+                if ix:
+                    result[i] = ix
+                else:
+                    missing.append(i)
+            todo = missing
+        _total_searches += len(hashes)
+        return result
+
     def refresh(self, skip_midx = False):
         """Refresh the index list.
         This method verifies if .midx files were superseded (e.g. all of its
@@ -497,57 +757,53 @@ class PackIdxList:
         self.do_bloom = False
         skip_midx = skip_midx or ignore_midx
         d = dict((p.name, p) for p in self.packs
-                 if not skip_midx or not isinstance(p, midx.PackMidx))
+                 if not skip_midx or not _is_midx(p))
         if os.path.exists(self.dir):
+            listing = _index_listing(self.dir)
+            for name, ix in d.items():
+                # Forget indexes that went away before we needed them
+                if name not in listing and getattr(ix, '_ix', True) is None:
+                    del d[name]
             if not skip_midx:
                 midxl = []
-                for ix in self.packs:
-                    if isinstance(ix, midx.PackMidx):
+                for ix in set(d.values()):
+                    if _is_midx(ix):
                         for name in ix.idxnames:
                             d[os.path.join(self.dir, name)] = ix
-                for full in glob.glob(os.path.join(self.dir,'*.midx')):
-                    if not d.get(full):
-                        mx = midx.PackMidx(full)
-                        (mxd, mxf) = os.path.split(mx.name)
+                for full, info in listing.iteritems():
+                    if _is_midx(full) and not d.get(full):
+                        mxf = os.path.basename(full)
                         broken = False
-                        for n in mx.idxnames:
-                            if not os.path.exists(os.path.join(mxd, n)):
+                        for n in info.idxnames:
+                            if os.path.join(self.dir, n) not in listing:
                                 log(('warning: index %s missing\n' +
                                     '  used by %s\n') % (n, mxf))
                                 broken = True
                         if broken:
-                            mx.close()
-                            del mx
                             unlink(full)
                         else:
-                            midxl.append(mx)
-                midxl.sort(key=lambda ix:
-                           (-len(ix), -xstat.stat(ix.name).st_mtime))
-                for ix in midxl:
+                            midxl.append((full, info))
+                midxl.sort(key=lambda (full, info): (-info.count, -info.mtime))
+                for full, info in midxl:
                     any_needed = False
-                    for sub in ix.idxnames:
+                    for sub in info.idxnames:
                         found = d.get(os.path.join(self.dir, sub))
-                        if not found or isinstance(found, PackIdx):
+                        if not found or not _is_midx(found):
                             # doesn't exist, or exists but not in a midx
                             any_needed = True
                             break
                     if any_needed:
+                        ix = _LazyIdx(full, info)
                         d[ix.name] = ix
                         for name in ix.idxnames:
                             d[os.path.join(self.dir, name)] = ix
-                    elif not ix.force_keep:
+                    elif not info.force_keep:
                         debug1('midx: removing redundant: %s\n'
-                               % os.path.basename(ix.name))
-                        ix.close()
-                        unlink(ix.name)
-            for full in glob.glob(os.path.join(self.dir,'*.idx')):
-                if not d.get(full):
-                    try:
-                        ix = open_idx(full)
-                    except GitError as e:
-                        add_error(e)
-                        continue
-                    d[full] = ix
+                               % os.path.basename(full))
+                        unlink(full)
+            for full, info in listing.iteritems():
+                if not _is_midx(full) and not d.get(full):
+                    d[full] = _LazyIdx(full, info)
             bfull = os.path.join(self.dir, 'bup.bloom')
             if self.bloom is None and os.path.exists(bfull):
                 self.bloom = bloom.ShaBloom(bfull)
@@ -565,6 +821,81 @@ class PackIdxList:
         self.also.add(hash)
 
 
+class HashedPackIdxList(PackIdxList):
+    """A PackIdxList that answers exists() with a single probe of the
+    bup.hashtable in dir (see bup.hashtable) for the objects in the
+    idxes it covers, and only searches the other indexes for the rest.
+    The table is created or brought up to date as needed by refresh()."""
+    def __init__(self, dir):
+        self.table = None
+        self.uncovered = []
+        PackIdxList.__init__(self, dir)
+
+    def refresh(self, skip_midx = False):
+        PackIdxList.refresh(self, skip_midx=skip_midx)
+        self.table = None
+        self.uncovered = []
+        if not os.path.exists(self.dir):
+            return
+        idxnames = set(os.path.basename(name)
+                       for ix in self.packs for name in ix.idxnames)
+        try:
+            hashtable.update(self.dir, idxnames, complete=True,
+                             create_missing=True)
+        except (EnvironmentError, GitError, ValueError) as e:
+            add_error('%s: hashtable: %s' % (self.dir, e))
+            return
+        table = hashtable.ShaHashTable(os.path.join(self.dir,
+                                                    'bup.hashtable'))
+        if not table.valid():
+            return
+        covered = set(table.idxnames)
+        self.table = table
+        self.uncovered = [ix for ix in self.packs
+                          if not all(os.path.basename(name) in covered
+                                     for name in ix.idxnames)]
+        debug1('HashedPackIdxList: %d of %d indexes not in the hash table.\n'
+               % (len(self.uncovered), len(self.packs)))
+
+    def exists(self, hash, want_source=False):
+        """Return nonempty if the object exists in the index files."""
+        if want_source or not self.table:
+            return PackIdxList.exists(self, hash, want_source=want_source)
+        if hash in self.also or self.table.exists(hash):
+            return True
+        for p in self.uncovered:
+            if p.exists(hash):
+                return True
+        return None
+
+    def exists_many(self, hashes, want_source=False):
+        """Return a list of what exists() would return for each of the
+        sorted (binary) hashes."""
+        if want_source or not self.table:
+            return PackIdxList.exists_many(self, hashes,
+                                           want_source=want_source)
+        result = self.table.exists_many(hashes)
+        todo = []
+        for i, also in enumerate(self.also.exists_many(hashes)):
+            if not result[i]:
+                if also:
+                    result[i] = True
+                else:
+                    todo.append(i)
+        for p in self.uncovered:
+            if not todo:
+                break
+            found = p.exists_many([hashes[i] for i in todo])
+            missing = []
+            for i, ix in zip(todo, found):
+                if ix:
+                    result[i] = True
+                else:
+                    missing.append(i)
+            todo = missing
+        return result
+
+
 def open_idx(filename):
     if filename.endswith('.idx'):
         f = open(filename, 'rb')
@@ -598,9 +929,144 @@ def idxmerge(idxlist, final_progress=True):
     return merge_iter(idxlist, 10024, pfunc, pfinal)
 
 
+class _EncodeJob:
+    def __init__(self, encode, type, content, data=None):
+        self.encode = encode
+        self.type = type
+        self.content = content
+        self.data = data
+        self.exc_info = None
+        self._done = threading.Event()
+        if data is not None:
+            self._done.set()
+
+    def _run(self):
+        try:
+            self.data = self.encode(self.type, self.content)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.content = None
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        """Wait for the job and return the encoded object, raising any
+        exception the worker encountered."""
+        self._done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.data
+
+
+class _EncodePool:
+    """Encode (i.e. zlib compress) pack objects on a set of worker
+    threads.  zlib releases the GIL while it works, so this scales with
+    the number of threads, particularly at higher compression levels."""
+    def __init__(self, workers):
+        assert(workers > 0)
+        self._jobs = Queue()
+        self._threads = []
+        for i in xrange(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            job._run()
+
+    def submit(self, encode, type, content):
+        """Queue encode(type, content) and return its job."""
+        job = _EncodeJob(encode, type, content)
+        self._jobs.put(job)
+        return job
+
+    def close(self):
+        for t in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+
+class _BackgroundCall:
+    """Run fn(*args) on a new thread."""
+    def __init__(self, fn, *args):
+        self.value = self.exc_info = None
+        self._thread = threading.Thread(target=self._run, args=(fn, args))
+        self._thread.start()
+
+    def _run(self, fn, args):
+        try:
+            self.value = fn(*args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def result(self):
+        """Wait for the call to finish and return its result, raising
+        any exception it raised."""
+        self._thread.join()
+        if self.exc_info:
+            # Drop the reference to avoid a cycle through the traceback
+            exc_info, self.exc_info = self.exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return self.value
+
+
+def _compressible(content, sample_size=2048):
+    """Return false if a sample from the middle of content doesn't
+    shrink by at least 1/32 at zlib level 1, i.e. if content is
+    probably already compressed (or encrypted)."""
+    if len(content) <= sample_size:
+        sample = content
+    else:
+        sample = buffer(content, (len(content) - sample_size) // 2,
+                        sample_size)
+    return len(zlib.compress(sample, 1)) < len(sample) - len(sample) // 32
+
+
 def _make_objcache():
+    # Setting bup.objcache to "hashtable" trades memory for faster
+    # lookups in repositories that are small relative to RAM.
+    kind = git_config_get('bup.objcache')
+    if kind and kind.strip() == 'hashtable':
+        return HashedPackIdxList(repo('objects/pack'))
     return PackIdxList(repo('objects/pack'))
 
+class _IdxRecords:
+    """The sha, crc and offset of each object in the pack a PackWriter
+    is writing, packed into 28 byte records as they'll be laid out in
+    the idx (see write_idx() in _helpers.c), which sorts them when the
+    idx is written.  As in the idx, offsets of 2^31 and beyond are kept
+    in a separate table of 8 byte offsets."""
+    def __init__(self):
+        self.records = bytearray()
+        self.ofs64 = bytearray()
+
+    def __len__(self):
+        return len(self.records) // 28
+
+    def add(self, sha, crc, ofs):
+        if ofs >= 0x80000000:
+            ofs64 = ofs
+            ofs = 0x80000000 | (len(self.ofs64) // 8)
+            self.ofs64 += struct.pack('!Q', ofs64)
+        self.records += sha
+        self.records += struct.pack('!II', crc, ofs)
+
+    def shas(self):
+        """Return a hashtable.ShaSet of all the shas."""
+        shas = hashtable.ShaSet()
+        shas.add_many(buffer(self.records), stride=28)
+        return shas
+
+
 # bup-gc assumes that it can disable all PackWriter activities
 # (bloom/midx/cache) via the constructor and close() arguments.
 
@@ -608,7 +1074,9 @@ class PackWriter:
     """Writes Git objects inside a pack file."""
     def __init__(self, objcache_maker=_make_objcache, compression_level=1,
                  run_midx=True, on_pack_finish=None,
-                 max_pack_size=None, max_pack_objects=None):
+                 max_pack_size=None, max_pack_objects=None,
+                 compress_threads=1, adaptive_compression=False,
+                 background_finish=False):
         self.repo_dir = repo()
         self.file = None
         self.parentfd = None
@@ -621,6 +1089,25 @@ class PackWriter:
         self.compression_level = compression_level
         self.run_midx=run_midx
         self.on_pack_finish = on_pack_finish
+        # With more than one compression thread, objects are encoded
+        # in the background and queued in _pending, and then written
+        # strictly in the order they were submitted, so the pack (and
+        # its idx) are byte-for-byte the same as with a single thread.
+        self.compress_threads = compress_threads
+        self._encode_pool = None
+        self._pending = deque()
+        self._pending_shas = set()
+        # With adaptive_compression, blobs that don't look compressible
+        # are stored at level 0.  probed_bytes and stored_bytes count
+        # the bytes of the blobs written that were checked, and the ones
+        # that were stored uncompressed as a result.
+        self.adaptive_compression = adaptive_compression
+        self.probed_bytes = self.stored_bytes = 0
+        # With background_finish, packs that fill up are finished (see
+        # _end_in_background()) while the next one is being written.
+        self.background_finish = background_finish
+        self._finishing = None
+        self._finishing_shas = hashtable.ShaSet()
         if not max_pack_size:
             max_pack_size = git_config_get('pack.packSizeLimit',
                                            repo_dir=self.repo_dir)
@@ -630,13 +1117,19 @@ class PackWriter:
                 # larger packs slow down pruning
                 max_pack_size = 1000 * 1000 * 1000
         self.max_pack_size = max_pack_size
-        # cache memory usage is about 83 bytes per object
+        # The idx records take 28 bytes per object, and the objcache's
+        # record of them (see PackIdxList.add()) up to about 50 more.
         self.max_pack_objects = max_pack_objects if max_pack_objects \
                                 else max(1, self.max_pack_size // 5000)
 
     def __del__(self):
         self.close()
 
+    def _close_encode_pool(self):
+        if self._encode_pool:
+            self._encode_pool.close()
+            self._encode_pool = None
+
     def _open(self):
         if not self.file:
             objdir = dir = os.path.join(self.repo_dir, 'objects')
@@ -656,9 +1149,9 @@ class PackWriter:
             assert(name.endswith('.pack'))
             self.filename = name[:-5]
             self.file.write('PACK\0\0\0\2\0\0\0\0')
-            self.idx = list(list() for i in xrange(256))
+            self.idx = _IdxRecords()
 
-    def _raw_write(self, datalist, sha):
+    def _raw_write(self, datalist, sha, crc=None):
         self._open()
         f = self.file
         # in case we get interrupted (eg. KeyboardInterrupt), it's best if
@@ -672,7 +1165,8 @@ class PackWriter:
         except IOError as e:
             raise GitError, e, sys.exc_info()[2]
         nw = len(oneblob)
-        crc = zlib.crc32(oneblob) & 0xffffffff
+        if crc is None:
+            crc = zlib.crc32(oneblob) & 0xffffffff
         self._update_idx(sha, crc, nw)
         self.outbytes += nw
         self.count += 1
@@ -680,28 +1174,86 @@ class PackWriter:
 
     def _update_idx(self, sha, crc, size):
         assert(sha)
-        if self.idx:
-            self.idx[ord(sha[0])].append((sha, crc, self.file.tell() - size))
+        if self.idx is not None:
+            self.idx.add(sha, crc, self.file.tell() - size)
 
     def _write(self, sha, type, content):
         if verbose:
             log('>')
         if not sha:
             sha = calc_hash(type, content)
-        size, crc = self._raw_write(_encode_packobj(type, content,
-                                                    self.compression_level),
-                                    sha=sha)
+        if self.compress_threads > 1:
+            if not self._encode_pool:
+                self._encode_pool = _EncodePool(self.compress_threads)
+            job = self._encode_pool.submit(self._encode, type, content)
+            self._queue_write(sha, job)
+            return sha
+        return self._write_object(sha, self._encode(type, content))
+
+    def _compression_level_for(self, type, content):
+        # Return the level, and the probed and stored byte counts.
+        level = self.compression_level
+        if not (self.adaptive_compression and level and type == 'blob'):
+            return level, 0, 0
+        if _compressible(content):
+            return level, len(content), 0
+        return 0, len(content), len(content)
+
+    def _encode(self, type, content):
+        # May be called from any thread.  Return (data, probed, stored),
+        # where the counts are only added to the statistics if the
+        # object's actually written (see _write_object()).
+        level, probed, stored = self._compression_level_for(type, content)
+        return ''.join(_encode_packobj(type, content, level)), probed, stored
+
+    def _write_object(self, sha, encoded):
+        data, probed, stored = encoded
+        self.probed_bytes += probed
+        self.stored_bytes += stored
+        return self._write_encoded(sha, (data,))
+
+    def _queue_write(self, sha, job):
+        self._pending.append((sha, job))
+        self._pending_shas.add(sha)
+        # Write whatever is finished at the head of the queue, and only
+        # wait for the oldest job when enough are outstanding to keep
+        # all the threads busy.
+        limit = 4 * self.compress_threads
+        while self._pending and (self._pending[0][1].done()
+                                 or len(self._pending) > limit):
+            self._write_next_pending()
+
+    def _write_next_pending(self):
+        sha, job = self._pending.popleft()
+        self._pending_shas.discard(sha)
+        self._write_object(sha, job.result())
+
+    def _finish_writes(self):
+        """Write any objects that are still being encoded."""
+        while self._pending:
+            self._write_next_pending()
+
+    def _write_encoded(self, sha, datalist, crc=None):
+        size, crc = self._raw_write(datalist, sha=sha, crc=crc)
         if self.outbytes >= self.max_pack_size \
            or self.count >= self.max_pack_objects:
-            self.breakpoint()
+            self._breakpoint(background=self.background_finish)
         return sha
 
-    def breakpoint(self):
-        """Clear byte and object counts and return the last processed id."""
-        id = self._end(self.run_midx)
+    def _breakpoint(self, background=False):
+        if background:
+            id = None
+            self._end_in_background()
+        else:
+            id = self._end(self.run_midx)
         self.outbytes = self.count = 0
         return id
 
+    def breakpoint(self):
+        """Clear byte and object counts and return the last processed id."""
+        self._finish_writes()
+        return self._breakpoint()
+
     def _require_objcache(self):
         if self.objcache is None and self.objcache_maker:
             self.objcache = self.objcache_maker()
@@ -711,18 +1263,45 @@ class PackWriter:
 
     def exists(self, id, want_source=False):
         """Return non-empty if an object is found in the object cache."""
+        if id in self._finishing_shas:
+            if not want_source:
+                return True
+            self._wait_for_finish()
         self._require_objcache()
         return self.objcache.exists(id, want_source=want_source)
 
+    def exists_many(self, ids, want_source=False):
+        """Return a list of what exists() would return for each of the
+        sorted ids."""
+        finishing = None
+        if self._finishing_shas:
+            finishing = self._finishing_shas.exists_many(ids)
+            if want_source and any(finishing):
+                self._wait_for_finish()
+                finishing = None
+        self._require_objcache()
+        result = self.objcache.exists_many(ids, want_source=want_source)
+        if finishing:
+            result = [True if f else found
+                      for f, found in zip(finishing, result)]
+        return result
+
     def just_write(self, sha, type, content):
         """Write an object to the pack file, bypassing the objcache.  Fails if
         sha exists()."""
         self._write(sha, type, content)
 
+    def just_write_encoded(self, sha, data, crc=None):
+        """Write an object that's already encoded as a (non-delta) pack
+        object, e.g. one copied from another pack, and whose crc32 is
+        crc (if known), bypassing the objcache.  Fails if sha exists()."""
+        self._finish_writes()  # Keep the objects in order
+        self._write_encoded(sha, (data,), crc=crc)
+
     def maybe_write(self, type, content):
         """Write an object to the pack file if not present and return its id."""
         sha = calc_hash(type, content)
-        if not self.exists(sha):
+        if sha not in self._pending_shas and not self.exists(sha):
             self.just_write(sha, type, content)
             self._require_objcache()
             self.objcache.add(sha)
@@ -732,6 +1311,49 @@ class PackWriter:
         """Create a blob object in the pack with the supplied content."""
         return self.maybe_write('blob', blob)
 
+    def encode_blob(self, blob):
+        """Return (sha, data) where data is blob encoded as a pack object
+        at this writer's compression level (along with what's needed for
+        the writer's statistics).  Nothing is written, and nothing but
+        the compression settings are touched, so this may be called
+        from other threads.  Pass the result to maybe_write_encoded() to
+        add it to the pack.
+        """
+        return calc_hash('blob', blob), self._encode('blob', blob)
+
+    def maybe_write_encoded(self, sha, data):
+        """Write an object produced by encode_blob() to the pack file if
+        not present and return its id."""
+        if sha not in self._pending_shas and not self.exists(sha):
+            self._add_encoded(sha, data)
+        return sha
+
+    def maybe_write_encoded_many(self, encoded):
+        """Look up all the (sha, data) pairs produced by encode_blob()
+        in encoded at once, and then yield each sha, writing the object
+        first (like maybe_write_encoded()) if it isn't present.  The
+        writes happen as the ids are consumed, so objects the caller
+        creates in between (e.g. trees) land in the same place in the
+        pack as they would with maybe_write_encoded()."""
+        shas = sorted(set(sha for sha, data in encoded))
+        present = set(sha for sha, found in zip(shas, self.exists_many(shas))
+                      if found)
+        for sha, data in encoded:
+            if sha not in present and sha not in self._pending_shas:
+                present.add(sha)
+                self._add_encoded(sha, data)
+            yield sha
+
+    def _add_encoded(self, sha, data):
+        if verbose:
+            log('>')
+        if self._pending:
+            self._queue_write(sha, _EncodeJob(None, 'blob', None, data=data))
+        else:
+            self._write_object(sha, data)
+        self._require_objcache()
+        self.objcache.add(sha)
+
     def new_tree(self, shalist):
         """Create a tree object in the pack."""
         content = tree_encode(shalist)
@@ -762,37 +1384,57 @@ class PackWriter:
 
     def abort(self):
         """Remove the pack file from disk."""
+        self._pending.clear()
+        self._pending_shas.clear()
+        self._close_encode_pool()
         f = self.file
-        if f:
-            pfd = self.parentfd
-            self.file = None
-            self.parentfd = None
-            self.idx = None
-            try:
+        try:
+            if f:
+                pfd = self.parentfd
+                self.file = None
+                self.parentfd = None
+                self.idx = None
                 try:
-                    os.unlink(self.filename + '.pack')
+                    try:
+                        os.unlink(self.filename + '.pack')
+                    finally:
+                        f.close()
                 finally:
-                    f.close()
-            finally:
-                if pfd is not None:
-                    os.close(pfd)
+                    if pfd is not None:
+                        os.close(pfd)
+        finally:
+            # An earlier pack may still be on its way into place
+            self._wait_for_finish()
 
-    def _end(self, run_midx=True):
+    def _detach_pack(self):
+        # Stop writing to the current pack, and return what
+        # _finish_pack() needs to finish it, or None if there's no pack.
         f = self.file
-        if not f: return None
+        if not f:
+            return None
         self.file = None
-        try:
-            self.objcache = None
-            idx = self.idx
-            self.idx = None
+        self.objcache = None
+        pack = (f, self.filename, self.parentfd, self.idx, self.count)
+        self.parentfd = None
+        self.idx = None
+        return pack
 
+    def _finish_pack(self, f, filename, parentfd, idx, count, run_midx):
+        # Must not touch any of the writer's state, since this may run
+        # in the background while the writer fills the next pack.
+        try:
             # update object count
             f.seek(8)
-            cp = struct.pack('!i', self.count)
+            cp = struct.pack('!i', count)
             assert(len(cp) == 4)
             f.write(cp)
 
-            # calculate the pack sha1sum
+            # calculate the pack sha1sum.  The object count is part of
+            # the first block SHA-1 consumes, so the sum can't be kept
+            # up to date as the objects are written.  Read the pack
+            # back while it's still in the page cache instead, and
+            # then drop it from the cache once it's on disk, since
+            # nothing is going to read it again soon.
             f.seek(0)
             sum = Sha1()
             for b in chunkyreader(f):
@@ -800,42 +1442,80 @@ class PackWriter:
             packbin = sum.digest()
             f.write(packbin)
             fdatasync(f.fileno())
+            _helpers.fadvise_done(f.fileno(), 0, f.tell())
         finally:
             f.close()
 
-        obj_list_sha = self._write_pack_idx_v2(self.filename + '.idx', idx, packbin)
+        obj_list_sha = self._write_pack_idx_v2(filename + '.idx', idx, packbin)
         nameprefix = os.path.join(self.repo_dir,
                                   'objects/pack/pack-' +  obj_list_sha)
-        if os.path.exists(self.filename + '.map'):
-            os.unlink(self.filename + '.map')
-        os.rename(self.filename + '.pack', nameprefix + '.pack')
-        os.rename(self.filename + '.idx', nameprefix + '.idx')
+        if os.path.exists(filename + '.map'):
+            os.unlink(filename + '.map')
+        os.rename(filename + '.pack', nameprefix + '.pack')
+        os.rename(filename + '.idx', nameprefix + '.idx')
         try:
-            os.fsync(self.parentfd)
+            os.fsync(parentfd)
         finally:
-            os.close(self.parentfd)
+            os.close(parentfd)
 
         if run_midx:
-            auto_midx(os.path.join(self.repo_dir, 'objects/pack'))
+            auto_midx(os.path.join(self.repo_dir, 'objects/pack'),
+                      [nameprefix + '.idx'])
 
+        return nameprefix
+
+    def _end(self, run_midx=True):
+        self._wait_for_finish()
+        pack = self._detach_pack()
+        if not pack:
+            return None
+        nameprefix = self._finish_pack(*(pack + (run_midx,)))
         if self.on_pack_finish:
             self.on_pack_finish(nameprefix)
+        return nameprefix
 
+    def _end_in_background(self):
+        # Like _end(), but finish the pack on another thread, so that
+        # the caller can carry on with the next one.  Only one pack is
+        # finished at a time, and its objects are remembered in
+        # _finishing_shas until it's in place.
+        self._wait_for_finish()
+        pack = self._detach_pack()
+        if not pack:
+            return
+        self._finishing_shas = pack[3].shas()
+        self._finishing = _BackgroundCall(self._finish_pack,
+                                          *(pack + (self.run_midx,)))
+
+    def _wait_for_finish(self):
+        """Wait for the pack being finished in the background (if any),
+        raising any exception it encountered, and return its name."""
+        call = self._finishing
+        if not call:
+            return None
+        self._finishing = None
+        self._finishing_shas = hashtable.ShaSet()
+        nameprefix = call.result()
+        if self.objcache:
+            self.objcache.refresh()
+        if self.on_pack_finish:
+            self.on_pack_finish(nameprefix)
         return nameprefix
 
     def close(self, run_midx=True):
         """Close the pack file and move it to its definitive path."""
+        try:
+            self._finish_writes()
+        finally:
+            self._close_encode_pool()
         return self._end(run_midx=run_midx)
 
     def _write_pack_idx_v2(self, filename, idx, packbin):
-        ofs64_count = 0
-        for section in idx:
-            for entry in section:
-                if entry[2] >= 2**31:
-                    ofs64_count += 1
+        count = len(idx)
+        ofs64_count = len(idx.ofs64) // 8
 
         # Length: header + fan-out + shas-and-crcs + overflow-offsets
-        index_len = 8 + (4 * 256) + (28 * self.count) + (8 * ofs64_count)
+        index_len = 8 + (4 * 256) + (28 * count) + (8 * ofs64_count)
         idx_map = None
         idx_f = open(filename, 'w+b')
         try:
@@ -843,8 +1523,9 @@ class PackWriter:
             fdatasync(idx_f.fileno())
             idx_map = mmap_readwrite(idx_f, close=False)
             try:
-                count = _helpers.write_idx(filename, idx_map, idx, self.count)
-                assert(count == self.count)
+                written = _helpers.write_idx(filename, idx_map, idx.records,
+                                             idx.ofs64, count)
+                assert(written == count)
                 idx_map.flush()
             finally:
                 idx_map.close()
@@ -860,7 +1541,7 @@ class PackWriter:
             idx_sum.update(b)
 
             obj_list_sum = Sha1()
-            for b in chunkyreader(idx_f, 20*self.count):
+            for b in chunkyreader(idx_f, 20*count):
                 idx_sum.update(b)
                 obj_list_sum.update(b)
             namebase = obj_list_sum.hexdigest()
@@ -1147,8 +1828,16 @@ class _AbortableIter:
 
 
 _ver_warned = 0
+_hex_oid_rx = re.compile(r'^[0-9a-f]{40}$')
+# Well under the capacity of any pipe, so that requests that git
+# hasn't read yet can't block get_many() while it's not reading git's
+# output.
+_CAT_WINDOW_BYTES = 8192
+
 class CatPipe:
-    """Link to 'git cat-file' that is used to retrieve blob data."""
+    """Link to 'git cat-file' that is used to retrieve blob data.
+    Objects requested by (hex) id are read directly from the packs
+    (see bup.packread) when possible."""
     def __init__(self, repo_dir = None):
         global _ver_warned
         self.repo_dir = repo_dir
@@ -1156,53 +1845,100 @@ class CatPipe:
         if ver() < wanted:
             log('error: git version must be at least 1.5.6\n')
             sys.exit(1)
-        self.p = self.inprogress = None
+        self.p = self.check_p = self.inprogress = None
+        self.reader = None
 
     def _abort(self):
-        if self.p:
-            self.p.stdout.close()
-            self.p.stdin.close()
-        self.p = None
+        for p in (self.p, self.check_p):
+            if p:
+                p.stdout.close()
+                p.stdin.close()
+        self.p = self.check_p = None
         self.inprogress = None
 
+    def _popen(self, mode):
+        return subprocess.Popen(['git', 'cat-file', mode],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                close_fds = True,
+                                bufsize = 4096,
+                                preexec_fn = _gitenv(self.repo_dir))
+
     def restart(self):
         self._abort()
-        self.p = subprocess.Popen(['git', 'cat-file', '--batch'],
-                                  stdin=subprocess.PIPE,
-                                  stdout=subprocess.PIPE,
-                                  close_fds = True,
-                                  bufsize = 4096,
-                                  preexec_fn = _gitenv(self.repo_dir))
+        if self.reader:
+            # Forget any packs that have been removed
+            self.reader.close()
+        self.p = self._popen('--batch')
+
+    def _read_direct(self, ref, include_data=True):
+        # Return (type, data), or just (type, size) unless
+        # include_data, for ref if the PackReader can find it.
+        if not _hex_oid_rx.match(ref):
+            return None
+        if not self.reader:
+            self.reader = packread.PackReader(self.repo_dir)
+        if include_data:
+            return self.reader.read(ref.decode('hex'))
+        return self.reader.read_info(ref.decode('hex'))
+
+    def _start(self, include_data=True):
+        # Return the (running) cat-file --batch, or --batch-check
+        # unless include_data.
+        if include_data:
+            if not self.p or self.p.poll() != None:
+                self.restart()
+            p = self.p
+        else:
+            if not self.check_p or self.check_p.poll() != None:
+                self.check_p = self._popen('--batch-check')
+            p = self.check_p
+        assert(p)
+        poll_result = p.poll()
+        assert(poll_result == None)
+        return p
+
+    def _request(self, p, ref):
+        assert(ref.find('\n') < 0)
+        assert(ref.find('\r') < 0)
+        assert(not ref.startswith('-'))
+        p.stdin.write('%s\n' % ref)
+
+    def _read_info(self, p):
+        hdr = p.stdout.readline()
+        if hdr.endswith(' missing\n'):
+            return None, None, None
+        info = hdr.split(' ')
+        if len(info) != 3 or len(info[0]) != 40:
+            raise GitError('expected object (id, type, size), got %r' % hdr)
+        oidx, typ, size = info
+        return oidx, typ, int(size)
 
     def get(self, ref):
         """Yield (oidx, type, size), followed by the data referred to by ref.
         If ref does not exist, only yield (None, None, None).
 
         """
-        if not self.p or self.p.poll() != None:
-            self.restart()
-        assert(self.p)
-        poll_result = self.p.poll()
-        assert(poll_result == None)
+        found = self._read_direct(ref)
+        if found:
+            typ, data = found
+            yield ref, typ, len(data)
+            if data:
+                yield data
+            return
+        self._start()
         if self.inprogress:
             log('get: opening %r while %r is open\n' % (ref, self.inprogress))
         assert(not self.inprogress)
-        assert(ref.find('\n') < 0)
-        assert(ref.find('\r') < 0)
-        assert(not ref.startswith('-'))
         self.inprogress = ref
-        self.p.stdin.write('%s\n' % ref)
+        self._request(self.p, ref)
         self.p.stdin.flush()
-        hdr = self.p.stdout.readline()
-        if hdr.endswith(' missing\n'):
+        info = self._read_info(self.p)
+        if not info[0]:
             self.inprogress = None
-            yield None, None, None
+            yield info
             return
-        info = hdr.split(' ')
-        if len(info) != 3 or len(info[0]) != 40:
-            raise GitError('expected object (id, type, size), got %r' % spl)
         oidx, typ, size = info
-        size = int(size)
         it = _AbortableIter(chunkyreader(self.p.stdout, size),
                             onabort=self._abort)
         try:
@@ -1216,6 +1952,93 @@ class CatPipe:
             it.abort()
             raise
 
+    def get_info(self, ref):
+        """Return (oidx, type, size) for ref, or (None, None, None) if
+        it doesn't exist, without reading the object's content."""
+        info, = self.get_many((ref,), include_data=False)
+        return info[:3]
+
+    def get_many(self, refs, window=64, include_data=True):
+        """Yield (oidx, type, size, data_iter) for each of the refs, in
+        order, or (None, None, None, None) for any that don't exist,
+        just like Client.cat_batch().  Each data_iter is drained (if
+        the caller hasn't) before the next result is produced.  Unless
+        include_data is true, only the objects' headers are read, and
+        data_iter is always None.
+
+        Rather than waiting for each reply before sending the next
+        request, up to window refs (but no more than about 8k of
+        them, so that git can never block us by not reading them) are
+        taken from refs and sent to git ahead of the one being read.
+        Objects that can be read directly from the packs are read as
+        they're taken.
+
+        """
+        if self.inprogress:
+            log('get_many: opening while %r is open\n' % (self.inprogress,))
+        assert(not self.inprogress)
+        self.inprogress = 'get_many'
+        refs = iter(refs)
+        pending = deque() # (ref, found), with found None when git has it
+        unread = 0 # bytes requested from git and not yet read
+        p = None
+        try:
+            while True:
+                wrote = False
+                while len(pending) < window and unread < _CAT_WINDOW_BYTES:
+                    ref = next(refs, None)
+                    if ref is None:
+                        break
+                    found = self._read_direct(ref, include_data)
+                    if not found:
+                        if not wrote and not unread:
+                            p = self._start(include_data)
+                            # (in case restarting cleared it)
+                            self.inprogress = 'get_many'
+                        self._request(p, ref)
+                        unread += len(ref) + 1
+                        wrote = True
+                    pending.append((ref, found))
+                if wrote:
+                    p.stdin.flush()
+                if not pending:
+                    break
+                ref, found = pending.popleft()
+                if found:
+                    if include_data:
+                        typ, data = found
+                        yield ref, typ, len(data), iter((data,) if data else ())
+                    else:
+                        yield ref, found[0], found[1], None
+                    continue
+                unread -= len(ref) + 1
+                oidx, typ, size = self._read_info(p)
+                if not oidx:
+                    yield None, None, None, None
+                    continue
+                if not include_data:
+                    yield oidx, typ, size, None
+                    continue
+                it = chunkyreader(p.stdout, size)
+                yield oidx, typ, size, it
+                for ignored in it:
+                    pass
+                readline_result = p.stdout.readline()
+                assert(readline_result == '\n')
+        except:
+            # Including GeneratorExit, i.e. the caller didn't finish
+            if unread:
+                self._abort()
+            raise
+        finally:
+            self.inprogress = None
+
+    def close(self):
+        self._abort()
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+
     def _join(self, it):
         _, typ, _ = next(it)
         if typ == 'blob':
@@ -1263,6 +2086,94 @@ def cp(repo_dir=None):
     return cp
 
 
+_default_pool_size = 4
+
+class CatPipePool:
+    """A thread-safe pool of CatPipes, so that more than one object can
+    be read from repo_dir at a time.  Each read (each get(), get_many(),
+    or join()) is handed a CatPipe of its own for as long as it's
+    running.  Up to size CatPipes are kept for reuse; more are started
+    whenever they're all busy (so that nested reads in one thread can't
+    deadlock), and closed when they're done."""
+    def __init__(self, repo_dir=None, size=None):
+        size = size or _default_pool_size
+        assert(size > 0)
+        self.repo_dir = repo_dir
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return CatPipe(self.repo_dir)
+
+    def _release(self, cp):
+        if cp.inprogress:
+            # The read was abandoned, so the pipe is out of step
+            cp._abort()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(cp)
+                return
+        cp.close()
+
+    def _run(self, method, *args):
+        cp = self._acquire()
+        try:
+            for x in getattr(cp, method)(*args):
+                yield x
+        finally:
+            self._release(cp)
+
+    def get(self, ref):
+        """See CatPipe.get()."""
+        return self._run('get', ref)
+
+    def get_info(self, ref):
+        """See CatPipe.get_info()."""
+        cp = self._acquire()
+        try:
+            return cp.get_info(ref)
+        finally:
+            self._release(cp)
+
+    def get_many(self, refs, window=64, include_data=True):
+        """See CatPipe.get_many()."""
+        return self._run('get_many', refs, window, include_data)
+
+    def join(self, id):
+        """See CatPipe.join()."""
+        return self._run('join', id)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for cp in idle:
+            cp.close()
+
+
+_cp_pools = {}
+_cp_pools_lock = threading.Lock()
+
+def cp_pool(repo_dir=None, size=None):
+    """Return the CatPipePool for repo_dir, creating it if necessary.
+    If size is given, the pool will keep (at least) that many CatPipes
+    for reuse."""
+    if not repo_dir:
+        repo_dir = repodir or repo()
+    repo_dir = os.path.abspath(repo_dir)
+    with _cp_pools_lock:
+        pool = _cp_pools.get(repo_dir)
+        if not pool:
+            pool = _cp_pools[repo_dir] = \
+                CatPipePool(repo_dir, size or _default_pool_size)
+        elif size and size > pool.size:
+            pool.size = size
+    return pool
+
+
 def tags(repo_dir = None):
     """Return a dictionary of all tags in the form {hash: [tag_names, ...]}."""
     tags = {}
@@ -1295,6 +2206,8 @@ WalkItem = namedtuple('WalkItem', ['oid', 'type', 'mode',
 #   ...
 
 
+_walk_prefetch = 32
+
 def walk_object(cat_pipe, oidx,
                 stop_at=None,
                 include_data=None):
@@ -1304,40 +2217,59 @@ def walk_object(cat_pipe, oidx,
     read or return blob content in the data field unless include_data
     is set.
     """
+    def must_read(oidx, mode):
+        # If the object is a "regular file" or a symlink, then it's a
+        # leaf in the graph, so we can skip reading the data if the
+        # caller hasn't requested it.
+        return include_data \
+            or not (mode and (stat.S_ISREG(mode) or stat.S_ISLNK(mode)))
+
     # Maintain the pending stack on the heap to avoid stack overflow
     pending = [(oidx, [], [], None)]
+    # (type, data) for objects fetched along with an earlier one
+    prefetched = {}
     while len(pending):
         oidx, parent_path, chunk_path, mode = pending.pop()
         oid = oidx.decode('hex')
         if stop_at and stop_at(oidx):
+            prefetched.pop(oidx, None)
             continue
 
-        if (not include_data) and mode and stat.S_ISREG(mode):
-            # If the object is a "regular file", then it's a leaf in
-            # the graph, so we can skip reading the data if the caller
-            # hasn't requested it.
+        if not must_read(oidx, mode):
             yield WalkItem(oid=oid, type='blob',
                            chunk_path=chunk_path, path=parent_path,
                            mode=mode,
                            data=None)
             continue
 
-        item_it = cat_pipe.get(oidx)
-        get_oidx, typ, _ = next(item_it)
-        if not get_oidx:
-            raise MissingObject(oidx.decode('hex'))
+        found = prefetched.pop(oidx, None)
+        if not found:
+            # Fetch the objects that will be needed next too (in the
+            # order they'll be popped), so that they're requested
+            # together.
+            batch = [oidx]
+            for next_item in reversed(pending[-_walk_prefetch:]):
+                next_oidx, next_mode = next_item[0], next_item[3]
+                if must_read(next_oidx, next_mode) \
+                   and not (stop_at and stop_at(next_oidx)):
+                    batch.append(next_oidx)
+            for want, info in izip(batch, cat_pipe.get_many(batch)):
+                get_oidx, typ, _, item_it = info
+                if not get_oidx:
+                    continue
+                if typ == 'blob' and not include_data:
+                    # Drained by get_many()
+                    prefetched[want] = typ, None
+                else:
+                    prefetched[want] = typ, ''.join(item_it)
+            found = prefetched.pop(oidx, None)
+            if not found:
+                raise MissingObject(oidx.decode('hex'))
+        typ, data = found
         if typ not in ('blob', 'commit', 'tree'):
             raise Exception('unexpected repository object type %r' % typ)
 
         # FIXME: set the mode based on the type when the mode is None
-        if typ == 'blob' and not include_data:
-            # Dump data until we can ask cat_pipe not to fetch it
-            for ignored in item_it:
-                pass
-            data = None
-        else:
-            data = ''.join(item_it)
-
         yield WalkItem(oid=oid, type=typ,
                        chunk_path=chunk_path, path=parent_path,
                        mode=mode,
@@ -1,9 +1,13 @@
-import io, math, os
+from Queue import Queue
+from itertools import islice, izip
+import errno, hashlib, io, math, os, stat, sys, threading, time
 
 from bup import _helpers, helpers
 from bup.helpers import sc_page_size
 
 _fmincore = getattr(helpers, 'fmincore', None)
+_SEEK_DATA = getattr(_helpers, 'SEEK_DATA', None)
+_SEEK_HOLE = getattr(_helpers, 'SEEK_HOLE', None)
 
 BLOB_MAX = 8192*4   # 8192 is the "typical" blob size for bupsplit
 BLOB_READ_SIZE = 1024*1024
@@ -11,36 +15,71 @@ MAX_PER_TREE = 256
 progress_callback = None
 fanout = 16
 
+# The repository's bup.split.chunker setting decides which of these
+# finds the split points (see chunker_from_config()).
+CHUNKERS = ('rollsum', 'fastcdc')
+chunker = 'rollsum'
+
 GIT_MODE_FILE = 0o100644
 GIT_MODE_TREE = 0o40000
 GIT_MODE_SYMLINK = 0o120000
 
 # The purpose of this type of buffer is to avoid copying on peek(), get(),
-# and eat().  We do copy the buffer contents on put(), but that should
-# be ok if we always only put() large amounts of data at a time.
+# and eat().  The data lives in a single bytearray that is reused for
+# the whole file: put() and fill() only move the unconsumed tail
+# (normally less than BLOB_MAX once _splitbuf() has run) back to the
+# front, and only grow the array when the new block won't fit.  fill()
+# reads straight into the array when it can.  peek() and get() return
+# buffer() views into the array, so they're only valid until the next
+# put() or fill().
 class Buf:
     def __init__(self):
-        self.data = ''
+        self.data = bytearray()
         self.start = 0
+        self.end = 0
+
+    def _reserve(self, count):
+        used = self.end - self.start
+        if self.end + count > len(self.data):
+            if self.start:
+                self.data[0:used] = self.data[self.start:self.end]
+                self.start, self.end = 0, used
+            if used + count > len(self.data):
+                self.data.extend(b'\0' * (used + count - len(self.data)))
 
     def put(self, s):
         if s:
-            self.data = buffer(self.data, self.start) + s
-            self.start = 0
-            
+            n = len(s)
+            self._reserve(n)
+            self.data[self.end:self.end + n] = s
+            self.end += n
+
+    def fill(self, f, count):
+        """Read up to count bytes from f straight into the buffer (via
+        readinto() when f has it) and return a view of what was read."""
+        readinto = getattr(f, 'readinto', None)
+        if not readinto:
+            b = f.read(count)
+            self.put(b)
+            return b
+        self._reserve(count)
+        n = readinto(memoryview(self.data)[self.end:self.end + count]) or 0
+        self.end += n
+        return buffer(self.data, self.end - n, n)
+
     def peek(self, count):
-        return buffer(self.data, self.start, count)
-    
+        return buffer(self.data, self.start, min(count, self.used()))
+
     def eat(self, count):
         self.start += count
 
     def get(self, count):
-        v = buffer(self.data, self.start, count)
-        self.start += count
+        v = self.peek(count)
+        self.start += len(v)
         return v
 
     def used(self):
-        return len(self.data) - self.start
+        return self.end - self.start
 
 
 def _fadvise_pages_done(fd, first_page, count):
@@ -88,7 +127,7 @@ def _uncache_ours_upto(fd, offset, first_region, remaining_regions):
     return (rstart, rlen)
 
 
-def readfile_iter(files, progress=None):
+def _readfile_iter(files, progress, read):
     for filenum,f in enumerate(files):
         ofs = 0
         b = ''
@@ -108,7 +147,7 @@ def readfile_iter(files, progress=None):
         while 1:
             if progress:
                 progress(filenum, len(b))
-            b = f.read(BLOB_READ_SIZE)
+            b = read(f)
             ofs += len(b)
             if rpr:
                 rstart, rlen = _uncache_ours_upto(fd, ofs, (rstart, rlen), rpr)
@@ -119,33 +158,156 @@ def readfile_iter(files, progress=None):
             rstart, rlen = _uncache_ours_upto(fd, ofs, (rstart, rlen), rpr)
 
 
-def _splitbuf(buf, basebits, fanbits):
-    while 1:
-        b = buf.peek(buf.used())
-        (ofs, bits) = _helpers.splitbuf(b)
-        if ofs:
-            if ofs > BLOB_MAX:
-                ofs = BLOB_MAX
-                level = 0
-            else:
-                level = (bits-basebits)//fanbits  # integer division
-            buf.eat(ofs)
-            yield buffer(b, 0, ofs), level
+def readfile_iter(files, progress=None):
+    return _readfile_iter(files, progress, lambda f: f.read(BLOB_READ_SIZE))
+
+
+def _splitbuf(buf, basebits, fanbits, chunker):
+    b = buf.peek(buf.used())
+    for ofs, bits in _helpers.splitbuf_all(b, BLOB_MAX, chunker):
+        if bits:
+            level = (bits-basebits)//fanbits  # integer division
         else:
-            break
+            level = 0  # cut at BLOB_MAX
+        yield buf.get(ofs), level
     while buf.used() >= BLOB_MAX:
         # limit max blob size
         yield buf.get(BLOB_MAX), 0
 
 
+class _Zeros(str):
+    """A chunk of all zero bytes that was produced from a hole without
+    reading or scanning it.  Every _Zeros of a given length is the same
+    blob, so consumers only need to hash (or store) the first one."""
+    pass
+
+
+class _Hole:
+    """A block of a file that lies entirely within a hole."""
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class _SparseReader:
+    """Provide the read function for _readfile_iter(), reading each
+    block into buf, except that blocks of regular files which lie
+    entirely within a hole (per SEEK_DATA/SEEK_HOLE) are skipped and
+    returned as a _Hole instead."""
+    def __init__(self, buf):
+        self.buf = buf
+        self.f = None
+
+    def _start(self, f):
+        self.f = f
+        self.fd = None
+        if _SEEK_DATA is None:
+            return
+        try:
+            fd = f.fileno()
+            st = os.fstat(fd)
+            pos = f.tell()
+        except (AttributeError, EnvironmentError, io.UnsupportedOperation):
+            return
+        if not stat.S_ISREG(st.st_mode):
+            return
+        self.fd = fd
+        self.pos = pos
+        self.size = st.st_size
+        self.data_end = self.hole_end = pos
+
+    def _seek_next(self, whence):
+        try:
+            return os.lseek(self.fd, self.pos, whence)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # only a hole from here to EOF
+                return max(self.pos, os.fstat(self.fd).st_size)
+            raise
+
+    def _hole_len(self):
+        """Return how many bytes from self.pos are known to be a hole."""
+        if self.pos < self.data_end:
+            return 0
+        if self.pos >= self.hole_end:
+            try:
+                self.hole_end = self._seek_next(_SEEK_DATA)
+                if self.hole_end == self.pos:
+                    self.data_end = self._seek_next(_SEEK_HOLE)
+            except EnvironmentError:
+                self.fd = None
+                return 0
+            finally:
+                # Our lseek()s moved the file offset out from under f.
+                self.f.seek(self.pos)
+        return self.hole_end - self.pos
+
+    def read(self, f):
+        if f is not self.f:
+            self._start(f)
+        if self.fd is None:
+            return self.buf.fill(f, BLOB_READ_SIZE)
+        n = min(BLOB_READ_SIZE, self.size - self.pos)
+        if n > 0 and self._hole_len() >= n:
+            self.pos += n
+            f.seek(self.pos)
+            return _Hole(n)
+        b = self.buf.fill(f, BLOB_READ_SIZE)
+        self.pos += len(b)
+        return b
+
+
+_zero_chunks = {}
+def _zero_chunk(basebits, fanbits, chunker):
+    """Return (blob, level) for the chunks that the splitter cuts a long
+    run of zeros into, once a chunk starts within the run."""
+    key = (BLOB_MAX, basebits, fanbits, chunker)
+    result = _zero_chunks.get(key)
+    if not result:
+        splits = _helpers.splitbuf_all(b'\0' * (2 * BLOB_MAX), BLOB_MAX,
+                                       chunker)
+        if splits and splits[0][1]:
+            ofs, bits = splits[0]
+            result = _Zeros(b'\0' * ofs), (bits-basebits)//fanbits
+        else:
+            result = _Zeros(b'\0' * BLOB_MAX), 0
+        _zero_chunks[key] = result
+    return result
+
+
+def _splithole(buf, size, basebits, fanbits, chunker):
+    """Split size zero bytes following the data in buf, producing the
+    same chunks _splitbuf() would if the zeros were read into buf."""
+    used = buf.used()
+    if str(buf.peek(used)).strip(b'\0'):
+        # The current chunk starts with data, so it has to be scanned.
+        buf.put(b'\0' * size)
+        for buf_and_level in _splitbuf(buf, basebits, fanbits, chunker):
+            yield buf_and_level
+        return
+    # A scan starting anywhere in a run of zeros finds the same split
+    # over and over, so the chunks can be produced without scanning.
+    blob, level = _zero_chunk(basebits, fanbits, chunker)
+    count, rest = divmod(used + size, len(blob))
+    buf.eat(used)
+    for i in xrange(count):
+        yield blob, level
+    buf.put(b'\0' * rest)
+
+
 def _hashsplit_iter(files, progress):
     assert(BLOB_READ_SIZE > BLOB_MAX)
     basebits = _helpers.blobbits()
     fanbits = int(math.log(fanout or 128, 2))
     buf = Buf()
-    for inblock in readfile_iter(files, progress):
-        buf.put(inblock)
-        for buf_and_level in _splitbuf(buf, basebits, fanbits):
+    reader = _SparseReader(buf)
+    for inblock in _readfile_iter(files, progress, reader.read):
+        if isinstance(inblock, _Hole):
+            chunks = _splithole(buf, len(inblock), basebits, fanbits, chunker)
+        else:
+            chunks = _splitbuf(buf, basebits, fanbits, chunker)
+        for buf_and_level in chunks:
             yield buf_and_level
     if buf.used():
         yield buf.get(buf.used()), 0
@@ -171,11 +333,67 @@ def hashsplit_iter(files, keep_boundaries, progress):
         return _hashsplit_iter(files, progress)
 
 
+def chunker_from_config(value):
+    """Return the chunker named by a bup.split.chunker config value
+    (None when it isn't set), or raise ValueError if there is no such
+    chunker."""
+    name = (value or 'rollsum').strip()
+    if name not in CHUNKERS:
+        raise ValueError('unknown bup.split.chunker %r (expected one of %s)'
+                         % (name, ', '.join(CHUNKERS)))
+    return name
+
+
+def compare_chunkers(files, progress=None):
+    """Split the data in files with every chunker in CHUNKERS and
+    return a list of (chunker, seconds, bytes, chunks, unique_bytes)
+    tuples, where seconds only covers the splitting itself, and
+    unique_bytes is the total size of the distinct chunks."""
+    basebits = _helpers.blobbits()
+    fanbits = int(math.log(fanout or 128, 2))
+    bufs = [Buf() for name in CHUNKERS]
+    secs = [0.0] * len(CHUNKERS)
+    counts = [0] * len(CHUNKERS)
+    unique = [0] * len(CHUNKERS)
+    seen = [set() for name in CHUNKERS]
+    total = 0
+    blocks = readfile_iter(files, progress)
+    while True:
+        block = next(blocks, None)
+        if block is not None:
+            total += len(block)
+        for i, name in enumerate(CHUNKERS):
+            start = time.time()
+            if block is not None:
+                bufs[i].put(block)
+                blobs = [b for b, level
+                         in _splitbuf(bufs[i], basebits, fanbits, name)]
+            else:
+                blobs = [bufs[i].get(bufs[i].used())] if bufs[i].used() else []
+            secs[i] += time.time() - start
+            for blob in blobs:
+                counts[i] += 1
+                sha = hashlib.sha1(blob).digest()
+                if sha not in seen[i]:
+                    seen[i].add(sha)
+                    unique[i] += len(blob)
+        if block is None:
+            break
+    return [(name, secs[i], total, counts[i], unique[i])
+            for i, name in enumerate(CHUNKERS)]
+
+
 total_split = 0
 def split_to_blobs(makeblob, files, keep_boundaries, progress):
     global total_split
+    zero_shas = {}
     for (blob, level) in hashsplit_iter(files, keep_boundaries, progress):
-        sha = makeblob(blob)
+        if isinstance(blob, _Zeros):
+            sha = zero_shas.get(len(blob))
+            if not sha:
+                sha = zero_shas[len(blob)] = makeblob(blob)
+        else:
+            sha = makeblob(blob)
         total_split += len(blob)
         if progress_callback:
             progress_callback(len(blob))
@@ -210,9 +428,7 @@ def _squish(maketree, stacks, n):
         i += 1
 
 
-def split_to_shalist(makeblob, maketree, files,
-                     keep_boundaries, progress=None):
-    sl = split_to_blobs(makeblob, files, keep_boundaries, progress)
+def _blobs_to_shalist(maketree, sl):
     assert(fanout != 0)
     if not fanout:
         shal = []
@@ -230,10 +446,13 @@ def split_to_shalist(makeblob, maketree, files,
         return _make_shalist(stacks[-1])[0]
 
 
-def split_to_blob_or_tree(makeblob, maketree, files,
-                          keep_boundaries, progress=None):
-    shalist = list(split_to_shalist(makeblob, maketree,
-                                    files, keep_boundaries, progress))
+def split_to_shalist(makeblob, maketree, files,
+                     keep_boundaries, progress=None):
+    sl = split_to_blobs(makeblob, files, keep_boundaries, progress)
+    return _blobs_to_shalist(maketree, sl)
+
+
+def _shalist_to_blob_or_tree(makeblob, maketree, shalist):
     if len(shalist) == 1:
         return (shalist[0][0], shalist[0][2])
     elif len(shalist) == 0:
@@ -242,6 +461,237 @@ def split_to_blob_or_tree(makeblob, maketree, files,
         return (GIT_MODE_TREE, maketree(shalist))
 
 
+def split_to_blob_or_tree(makeblob, maketree, files,
+                          keep_boundaries, progress=None):
+    shalist = list(split_to_shalist(makeblob, maketree,
+                                    files, keep_boundaries, progress))
+    return _shalist_to_blob_or_tree(makeblob, maketree, shalist)
+
+
+class _SplitJob:
+    def __init__(self, f, maxsize):
+        self.f = f
+        self.cancelled = False
+        self._results = Queue(maxsize)
+
+    def _run(self, encode_blob):
+        zeros = {}
+        try:
+            try:
+                for blob, level in hashsplit_iter([self.f],
+                                                  keep_boundaries=False,
+                                                  progress=None):
+                    if self.cancelled:
+                        break
+                    if isinstance(blob, _Zeros):
+                        if len(blob) not in zeros:
+                            zeros[len(blob)] = encode_blob(blob)
+                        sha, data = zeros[len(blob)]
+                    else:
+                        sha, data = encode_blob(blob)
+                    self._results.put(((sha, len(blob), level, data), None))
+            finally:
+                self.f.close()
+        except Exception:
+            self._results.put((None, sys.exc_info()))
+            return
+        self._results.put((None, None))
+
+    def __iter__(self):
+        """Yield (sha, size, level, data) for each blob of the file in
+        order, raising any exception the worker encountered."""
+        while True:
+            item, exc_info = self._results.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is None:
+                return
+            yield item
+
+    def cancel(self):
+        """Discard any remaining results, and wait for the worker to
+        finish with the file."""
+        self.cancelled = True
+        try:
+            for item in self:
+                pass
+        except Exception:
+            pass
+
+
+class SplitPool:
+    """Split, hash, and encode files on a set of worker threads.
+
+    Each submit()ed file is split exactly as split_to_blobs() would
+    split it, and each of its blobs is handed to encode_blob(blob),
+    which must return (sha, data) and be safe to call from any thread
+    (cf. PackWriter.encode_blob()).  The returned jobs yield their
+    (sha, size, level, data) results in order, so a single consumer
+    can write them (see encoded_to_blob_or_tree()) and produce exactly
+    the same objects, in the same order, as a serial split.  Files are
+    picked up by the workers in submission order, and each job only
+    queues up to queue_size results before its worker waits for the
+    consumer.
+    """
+    def __init__(self, encode_blob, workers, queue_size=64):
+        assert(workers > 0)
+        self.encode_blob = encode_blob
+        self.queue_size = queue_size
+        self._jobs = Queue()
+        self._threads = []
+        for i in xrange(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            job._run(self.encode_blob)
+
+    def submit(self, f):
+        """Queue the open file f for splitting and return its job.  The
+        file will be closed by the worker."""
+        assert(self._threads)
+        job = _SplitJob(f, self.queue_size)
+        self._jobs.put(job)
+        return job
+
+    def close(self):
+        for t in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+
+class _Prefetch:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.fd = None
+        self.mcore = None
+        self.finished = False
+
+
+class Prefetcher:
+    """Ask the kernel to start reading upcoming files (with
+    POSIX_FADV_WILLNEED) from a background thread, so that the disk
+    (or network filesystem) can work on them while earlier files are
+    being split.
+
+    The caller should only prefetch() while has_room(), i.e. while the
+    outstanding prefetches (those that haven't been done()) add up to
+    less than max_bytes and max_files.  Once a file has been read, the
+    caller must call done() on its handle, which drops any of the
+    file's pages that were only cached because of the prefetch, just
+    as readfile_iter() drops the pages it reads itself.
+    """
+    def __init__(self, max_bytes, max_files=1024):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.nbytes = self.nfiles = 0
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            pf = self._queue.get()
+            if pf is None:
+                return
+            if pf.finished:
+                continue
+            try:
+                fd = _helpers.open_noatime(pf.path)
+            except EnvironmentError:
+                continue  # The reader will report it
+            mcore = None
+            try:
+                if _fmincore:
+                    mcore = _fmincore(fd)
+                _helpers.fadvise_willneed(fd, 0, pf.size)
+            except EnvironmentError:
+                pass
+            with self._lock:
+                if not pf.finished:
+                    pf.fd, pf.mcore = fd, mcore
+                    fd = None
+            if fd is not None:
+                os.close(fd)
+
+    def has_room(self):
+        return self.nbytes < self.max_bytes and self.nfiles < self.max_files
+
+    def prefetch(self, path, size):
+        """Start prefetching up to size bytes of path, and return the
+        handle to pass to done()."""
+        pf = _Prefetch(path, min(size, self.max_bytes))
+        self.nbytes += pf.size
+        self.nfiles += 1
+        self._queue.put(pf)
+        return pf
+
+    def done(self, pf):
+        """Finish the prefetch pf, after its file has been read."""
+        with self._lock:
+            pf.finished = True
+            fd, mcore = pf.fd, pf.mcore
+            pf.fd = pf.mcore = None
+        self.nbytes -= pf.size
+        self.nfiles -= 1
+        if fd is None:
+            return
+        try:
+            if mcore:
+                pages = (pf.size + sc_page_size - 1) // sc_page_size
+                for start, count in _nonresident_page_regions(
+                        mcore[:pages], helpers.MINCORE_INCORE):
+                    _fadvise_pages_done(fd, start, count)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+def write_encoded_blobs(write_encoded, encoded, batch_size=64):
+    """Pass the (sha, data) of each (sha, size, level, data) from
+    encoded to write_encoded() in lists of up to batch_size, so that
+    they can be looked up together (cf.
+    PackWriter.maybe_write_encoded_many()), and yield (sha, size,
+    level) like split_to_blobs().  write_encoded() must return an
+    iterator that writes each object as it yields its sha."""
+    global total_split
+    encoded = iter(encoded)
+    while True:
+        batch = list(islice(encoded, batch_size))
+        if not batch:
+            return
+        written = write_encoded([(sha, data)
+                                 for (sha, size, level, data) in batch])
+        for (sha, size, level, data), id in izip(batch, written):
+            assert(id == sha)
+            total_split += size
+            if progress_callback:
+                progress_callback(size)
+            yield (sha, size, level)
+
+
+def encoded_to_blob_or_tree(write_encoded, makeblob, maketree, encoded):
+    """Return the same (mode, sha) as split_to_blob_or_tree() for the
+    results of a SplitPool job (cf. write_encoded_blobs())."""
+    sl = write_encoded_blobs(write_encoded, encoded)
+    shalist = list(_blobs_to_shalist(maketree, sl))
+    return _shalist_to_blob_or_tree(makeblob, maketree, shalist)
+
+
 def open_noatime(name):
     fd = _helpers.open_noatime(name)
     try:
@@ -0,0 +1,291 @@
+"""An exact, persistent set of object ids.
+
+bup.hashtable (next to bup.bloom in objects/pack) is an open-addressed
+hash table of every object id in the idx files it lists.  Unlike the
+bloom filter it never answers "maybe", and unlike a midx it doesn't
+need a search: an object's home slot is given by the first bits of its
+id, and it's either there or in one of the following slots, so a lookup
+usually touches a single cache line.  The price is space, about 40 bytes
+per object at the load the table is kept at, so it's only worth having
+for repositories that are small relative to RAM.  The table is
+optional; git.HashedPackIdxList uses it when the bup.objcache git
+config option is set to "hashtable", and creates it if necessary.
+
+The file is a 32 byte header ('HTBL', then the version, the log2 of
+the number of slots and the number of entries, all big-endian),
+followed by the 20 byte slots, all zeros when free, and then the
+NUL-separated names of the idx files whose objects are in the table.
+
+Since objects are only ever added, and an entry never moves once it's
+in a slot, the table is updated in place while other processes may be
+reading it.  When it gets too full, or idx files it covers have been
+removed (e.g. by "bup gc"), it's rebuilt and atomically replaced.
+"""
+
+from contextlib import contextmanager
+import fcntl, math, mmap, os, struct
+
+import git
+from bup import _helpers
+from bup.helpers import (atomically_replaced_file, debug1, log, mmap_read,
+                         mmap_readwrite, unlink)
+
+
+HASHTABLE_VERSION = 1
+HEADERLEN = 32
+MIN_BITS = 10
+SET_MIN_BITS = 6 # for a ShaSet
+MAX_BITS = 40
+TARGET_LOAD = 0.5 # for a new table
+MAX_LOAD = 0.75 # rebuild once adding objects would go beyond this
+
+_total_searches = 0
+_total_steps = 0
+
+shatable_add = _helpers.shatable_add
+shatable_contains = _helpers.shatable_contains
+shatable_contains_many = _helpers.shatable_contains_many
+
+
+class ShaHashTable:
+    """The objects in the idx files listed in a bup.hashtable."""
+    def __init__(self, filename, f=None, readwrite=False):
+        self.name = filename
+        self.rwfile = None
+        self.map = None
+        assert(filename.endswith('.hashtable'))
+        if readwrite:
+            self.rwfile = f = f or open(filename, 'r+b')
+            f.seek(0)
+            self.map = mmap_readwrite(f, close=False)
+        else:
+            f = f or open(filename, 'rb')
+            self.map = mmap_read(f)
+        if len(self.map) < HEADERLEN or str(self.map[0:4]) != 'HTBL':
+            log('Warning: invalid HTBL header in %r\n' % filename)
+            return self._init_failed()
+        ver, self.bits, self.entries = \
+            struct.unpack('!IH2xQ', self.map[4:20])
+        if ver != HASHTABLE_VERSION:
+            log('Warning: ignoring unsupported (v%d) hash table %r\n'
+                % (ver, filename))
+            return self._init_failed()
+        if not MIN_BITS <= self.bits <= MAX_BITS \
+           or len(self.map) < HEADERLEN + 20 * 2**self.bits:
+            log('Warning: truncated hash table %r\n' % filename)
+            return self._init_failed()
+        idxnamestr = str(self.map[HEADERLEN + 20 * 2**self.bits:])
+        if idxnamestr:
+            self.idxnames = idxnamestr.split('\0')
+        else:
+            self.idxnames = []
+
+    def _init_failed(self):
+        if self.map:
+            self.map = None
+        if self.rwfile:
+            self.rwfile.close()
+            self.rwfile = None
+        self.idxnames = []
+        self.bits = self.entries = 0
+
+    def valid(self):
+        return self.map and self.bits
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.map and self.rwfile:
+            self.map[12:20] = struct.pack('!Q', self.entries)
+            self.map.flush()
+            self.rwfile.seek(HEADERLEN + 20 * 2**self.bits)
+            self.rwfile.write('\0'.join(self.idxnames))
+            self.rwfile.truncate()
+        self._init_failed()
+
+    def __len__(self):
+        return int(self.entries)
+
+    def load(self, additional=0):
+        """Return the fraction of the slots that would be used after
+        adding additional more objects."""
+        return float(self.entries + additional) / 2**self.bits
+
+    def add(self, shas, stride=20, offset=0):
+        """Add the hashes in shas (packed binary 20-bytes, at offset in
+        each of the stride byte records) to the table."""
+        if not self.rwfile:
+            raise Exception('Cannot add to read-only hash table')
+        self.entries += shatable_add(self.map, shas, self.bits, stride, offset)
+
+    def add_idx(self, ix):
+        if isinstance(ix, git.PackIdxV1):
+            # Each sha follows its (4 byte) offset
+            self.add(ix.shatable, stride=24, offset=4)
+        else:
+            self.add(ix.shatable)
+        self.idxnames.append(os.path.basename(ix.name))
+
+    def slots(self):
+        """Return a buffer of all the slots, for adding to another table."""
+        return buffer(self.map, HEADERLEN, 20 * 2**self.bits)
+
+    def exists(self, sha):
+        """Return true if the object is in the table."""
+        global _total_searches, _total_steps
+        _total_searches += 1
+        if not self.map:
+            return None
+        found, steps = shatable_contains(self.map, str(sha), self.bits)
+        _total_steps += steps
+        return found
+
+    def exists_many(self, shas):
+        """Return a list of what exists() would return for each of the
+        (binary) shas."""
+        global _total_searches
+        _total_searches += len(shas)
+        if not self.map:
+            return [None] * len(shas)
+        found = shatable_contains_many(self.map, ''.join(shas), self.bits)
+        return [c == '\1' or None for c in found]
+
+
+class ShaSet:
+    """An in-memory set of (binary) shas, kept in the same kind of
+    table as a bup.hashtable.  At around 20 to 50 bytes per sha, it's
+    much smaller than a python set of strings."""
+    def __init__(self):
+        self.entries = 0
+        self._resize(0)
+
+    def _resize(self, expected):
+        bits = int(math.ceil(math.log(max(expected, 1) / TARGET_LOAD, 2)))
+        bits = max(bits, SET_MIN_BITS)
+        old = getattr(self, 'table', None)
+        self.bits = bits
+        # An anonymous map starts out zeroed (i.e. with every slot
+        # free), and only takes memory as it's filled in.
+        self.table = mmap.mmap(-1, HEADERLEN + 20 * 2**bits)
+        if old:
+            shatable_add(self.table, buffer(old, HEADERLEN), bits)
+            old.close()
+
+    def __len__(self):
+        return self.entries
+
+    def __contains__(self, sha):
+        if not self.entries:
+            return False
+        return bool(shatable_contains(self.table, sha, self.bits)[0])
+
+    def add(self, sha):
+        self.add_many(sha)
+
+    def add_many(self, shas, stride=20, offset=0):
+        """Add the shas at offset in each of the stride byte records
+        in shas."""
+        n = len(shas) // stride
+        if self.entries + n > MAX_LOAD * 2**self.bits:
+            self._resize(self.entries + n)
+        self.entries += shatable_add(self.table, shas, self.bits, stride,
+                                     offset)
+
+    def exists_many(self, shas):
+        """Return a list of whether each of the shas is in the set."""
+        if not self.entries:
+            return [False] * len(shas)
+        found = shatable_contains_many(self.table, ''.join(shas), self.bits)
+        return [c == '\1' for c in found]
+
+    def clear(self):
+        self.table.close()
+        self.table = None
+        self.entries = 0
+        self._resize(0)
+
+
+def create(name, expected, f=None):
+    """Create and return an empty, writable hash table with room for
+    `expected` entries."""
+    bits = int(math.ceil(math.log(max(expected, 1) / TARGET_LOAD, 2)))
+    bits = max(bits, MIN_BITS)
+    if bits > MAX_BITS:
+        raise ValueError('too many objects (%d) for a hash table' % expected)
+    debug1('hashtable: using 2^%d slots for %d objects\n' % (bits, expected))
+    f = f or open(name, 'w+b')
+    f.write('HTBL')
+    f.write(struct.pack('!IH2xQ', HASHTABLE_VERSION, bits, 0))
+    f.write('\0' * (HEADERLEN - f.tell()))
+    f.truncate(HEADERLEN + 20 * 2**bits)
+    f.seek(0)
+    return ShaHashTable(name, f=f, readwrite=True)
+
+
+@contextmanager
+def locked(dir):
+    """Hold an exclusive lock on dir/bup.hashtable while in the context."""
+    fd = os.open(os.path.join(dir, 'bup.hashtable.lock'),
+                 os.O_RDWR | os.O_CREAT, 0666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _rebuild(name, old, ixs):
+    # Atomically replace name with a table of the objects in the old
+    # table (if any) and the open idxs ixs.
+    expected = sum(len(ix) for ix in ixs) + (old and len(old) or 0)
+    with atomically_replaced_file(name, 'w+b') as f:
+        t = create(name, expected, f=f)
+        if old:
+            t.add(old.slots())
+            t.idxnames.extend(old.idxnames)
+        for ix in ixs:
+            t.add_idx(ix)
+        t.close()
+
+
+def update(dir, idxnames, complete=False, create_missing=False):
+    """Add the objects in the idx files idxnames (in dir) that aren't
+    already in dir/bup.hashtable to it, under its lock, and return true.
+    If complete is true, idxnames lists every idx file in dir, and the
+    table is rebuilt if it covers any others (i.e. they've been
+    removed).  Return false without changing anything if there's no
+    valid table, unless create_missing is true."""
+    name = os.path.join(dir, 'bup.hashtable')
+    idxnames = [os.path.basename(n) for n in idxnames]
+    with locked(dir):
+        t = None
+        if os.path.exists(name):
+            t = ShaHashTable(name)
+            if not t.valid():
+                t = None
+        if not t and not create_missing:
+            return False
+        if t and complete and set(t.idxnames) - set(idxnames):
+            debug1('hashtable: rebuilding without removed indexes\n')
+            t = None
+        have = set(t.idxnames) if t else set()
+        ixs = [git.open_idx(os.path.join(dir, n))
+               for n in idxnames if n not in have]
+        if t and not ixs:
+            return True
+        if not t or t.load(sum(len(ix) for ix in ixs)) > MAX_LOAD:
+            _rebuild(name, t, ixs)
+            return True
+        t.close()
+        t = ShaHashTable(name, readwrite=True)
+        if not t.valid():
+            return False
+        for ix in ixs:
+            t.add_idx(ix)
+        t.close()
+        return True
+
+
+def clear_hashtable(dir):
+    unlink(os.path.join(dir, 'bup.hashtable'))
@@ -1,15 +1,25 @@
 
-import git, glob, mmap, os, struct
+import git, glob, math, mmap, os, struct
 
-from bup import _helpers
-from bup.helpers import log, mmap_read
+from bup import _helpers, xstat
+from bup.helpers import (Sha1, atomically_replaced_file, debug1, fdatasync,
+                         log, mmap_read, mmap_readwrite, unlink)
 
 
 MIDX_VERSION = 4
 
+PAGE_SIZE = 4096
+SHA_PER_PAGE = PAGE_SIZE/20.
+
+# A new midx is made from the indexes in a tier once there are this many
+TIER_FANIN = 4
+
 extract_bits = _helpers.extract_bits
+midx_find = _helpers.midx_find
 _total_searches = 0
 _total_steps = 0
+# Search with _helpers.midx_find() rather than in python (cf. bup memtest)
+native_search = True
 
 
 class PackMidx:
@@ -58,6 +68,7 @@ class PackMidx:
         self.entries = 1
         self.fanout = buffer('\0\0\0\0')
         self.shatable = buffer('\0'*20)
+        self.whichlist = buffer('\0\0\0\0')
         self.idxnames = []
 
     def _fanget(self, i):
@@ -81,6 +92,24 @@ class PackMidx:
 
     def exists(self, hash, want_source=False):
         """Return nonempty if the object exists in the index files."""
+        global _total_searches, _total_steps
+        if not native_search:
+            return self._exists_py(hash, want_source)
+        _total_searches += 1
+        if not want_source:
+            # Don't touch the whichlist unless we need it
+            found, steps = midx_find(self.fanout, self.shatable, self.bits,
+                                     str(hash))
+            _total_steps += steps
+            return found
+        found, steps = midx_find(self.fanout, self.shatable, self.bits,
+                                 str(hash), self.whichlist)
+        _total_steps += steps
+        if found is None:
+            return None
+        return self.idxnames[found]
+
+    def _exists_py(self, hash, want_source=False):
         global _total_searches, _total_steps
         _total_searches += 1
         want = str(hash)
@@ -113,6 +142,18 @@ class PackMidx:
                 return want_source and self._get_idxname(mid) or True
         return None
 
+    def exists_many(self, hashes, want_source=False):
+        """Return a list of what exists() would return for each of the
+        sorted (binary) hashes."""
+        global _total_searches
+        _total_searches += len(hashes)
+        found = _helpers.find_sorted_shas(self.shatable, 20, len(self),
+                                          ''.join(hashes))
+        if not want_source:
+            return [i is not None or None for i in found]
+        return [self._get_idxname(i) if i is not None else None
+                for i in found]
+
     def __iter__(self):
         for i in xrange(self._fanget(self.entries-1)):
             yield buffer(self.shatable, i*20, 20)
@@ -125,3 +166,128 @@ def clear_midxes(dir=None):
     dir = dir or git.repo('objects/pack')
     for midx in glob.glob(os.path.join(dir, '*.midx')):
         os.unlink(midx)
+
+
+def write_midx(outfilename, ixs):
+    """Write a midx containing all the objects in the open idx and midx
+    files ixs to outfilename, and return the number of objects."""
+    inp = []
+    total = 0
+    allfilenames = []
+    for ix in ixs:
+        inp.append((
+            ix.map,
+            len(ix),
+            ix.sha_ofs,
+            isinstance(ix, PackMidx) and ix.which_ofs or 0,
+            len(allfilenames),
+        ))
+        for n in ix.idxnames:
+            allfilenames.append(os.path.basename(n))
+        total += len(ix)
+    inp.sort(lambda x,y: cmp(str(y[0][y[2]:y[2]+20]),str(x[0][x[2]:x[2]+20])))
+
+    pages = int(total/SHA_PER_PAGE) or 1
+    bits = int(math.ceil(math.log(pages, 2)))
+    entries = 2**bits
+    debug1('midx: table size: %d (%d bits)\n' % (entries*4, bits))
+
+    unlink(outfilename)
+    with atomically_replaced_file(outfilename, 'wb') as f:
+        f.write('MIDX')
+        f.write(struct.pack('!II', MIDX_VERSION, bits))
+        assert(f.tell() == 12)
+
+        f.truncate(12 + 4*entries + 20*total + 4*total)
+        f.flush()
+        fdatasync(f.fileno())
+
+        fmap = mmap_readwrite(f, close=False)
+
+        count = _helpers.merge_into(fmap, bits, total, inp)
+        del fmap # Assume this calls msync() now.
+        f.seek(0, os.SEEK_END)
+        f.write('\0'.join(allfilenames))
+    return total
+
+
+def _tier(count):
+    tier = 0
+    while count >= TIER_FANIN:
+        count //= TIER_FANIN
+        tier += 1
+    return tier
+
+
+def _unmerged_indexes(dir):
+    # Return the (count, name) of each midx in dir that isn't redundant
+    # and each idx that isn't in one of those, after deleting the
+    # redundant midxes.
+    sizes = {}
+    contents = {}
+    for mname in glob.glob('%s/*.midx' % dir):
+        m = PackMidx(mname)
+        try:
+            if m.force_keep:
+                continue
+            contents[mname] = [os.path.join(dir, i) for i in m.idxnames]
+            sizes[mname] = len(m)
+        finally:
+            m.close()
+    midxs = sorted(contents, key=lambda mname: (-sizes[mname],
+                                                -xstat.stat(mname).st_mtime))
+    covered = set()
+    result = []
+    for mname in midxs:
+        if covered.issuperset(contents[mname]):
+            debug1('midx: removing redundant: %s\n' % os.path.basename(mname))
+            unlink(mname)
+        else:
+            covered.update(contents[mname])
+            result.append((sizes[mname], mname))
+    for iname in glob.glob('%s/*.idx' % dir):
+        if iname not in covered:
+            result.append((len(git.open_idx(iname)), iname))
+    return result
+
+
+def compact(dir, max_files=None):
+    """Merge the idx and midx files in dir into tiers of midx files, and
+    return the names of any new midx files.
+
+    An index with n objects is in tier floor(log(n, TIER_FANIN)), and
+    whenever a tier holds TIER_FANIN indexes, they're merged into a new
+    midx in a higher tier.  So each object is only rewritten once per
+    tier, and there are never more than TIER_FANIN - 1 indexes per tier
+    to search, no matter how big the repository gets.  max_files limits
+    the number of indexes merged at once.
+    """
+    indexes = _unmerged_indexes(dir)
+    created = []
+    while True:
+        tiers = {}
+        for count, name in indexes:
+            if count:  # merging empty indexes wouldn't get anywhere
+                tiers.setdefault(_tier(count), []).append((count, name))
+        full = [t for t in sorted(tiers) if len(tiers[t]) >= TIER_FANIN]
+        if not full:
+            break
+        group = sorted(tiers[full[0]])[:max_files]
+        names = [name for count, name in group]
+        outfilename = '%s/midx-%s.midx' % (dir,
+                                           Sha1('\0'.join(names)).hexdigest())
+        debug1('midx: merging %d tier %d indexes.\n' % (len(names), full[0]))
+        ixs = [git.open_idx(name) for name in names]
+        try:
+            total = write_midx(outfilename, ixs)
+        finally:
+            for ix in ixs:
+                if isinstance(ix, PackMidx):
+                    ix.close()
+        for name in names:
+            if name.endswith('.midx'):
+                unlink(name)
+        indexes = [x for x in indexes if x not in group]
+        indexes.append((total, outfilename))
+        created.append(outfilename)
+    return [name for name in created if os.path.exists(name)]
@@ -0,0 +1,326 @@
+"""Read git objects directly from a repository's packs.
+
+A PackReader finds an object's pack and offset via the same (lazily
+opened) indexes PackIdxList uses, and inflates it straight from the
+mmapped .pack, so CatPipe doesn't need a "git cat-file --batch"
+round trip for every object.  bup never writes deltas, but packs
+written by git may contain OFS_DELTA and REF_DELTA objects, and those
+are resolved here too.  Objects that aren't in any pack are read from
+objects/xx/... if they're loose.  Anything else (e.g. alternates) is
+left to git.
+
+A StoredObjects returns a pack's objects exactly as they're stored,
+i.e. still compressed, so that they can be copied to another pack
+without being inflated and deflated again (e.g. by "bup gc").
+"""
+
+from bisect import bisect_right
+from collections import OrderedDict
+import errno, os, zlib
+
+import git
+from bup import xstat
+from bup.helpers import mmap_read
+
+
+_OFS_DELTA = 6
+_REF_DELTA = 7
+
+MAX_OPEN_PACKS = 64
+MAX_CACHED_BASES = 64
+MAX_CACHED_BASE_SIZE = 1024 * 1024
+
+
+def _parse_obj_header(map, ofs):
+    """Return the type, inflated size, and data offset of the pack
+    object at ofs."""
+    c = ord(map[ofs])
+    ofs += 1
+    typ = (c >> 4) & 7
+    size = c & 0x0f
+    shift = 4
+    while c & 0x80:
+        c = ord(map[ofs])
+        ofs += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+    return typ, size, ofs
+
+
+def _inflate(map, ofs, size, want=None):
+    """Return the size bytes that the zlib stream at ofs inflates to,
+    or just the first want of them."""
+    if want is None:
+        want = size
+    d = zlib.decompressobj()
+    result = []
+    got = 0
+    # Small objects usually fit in the first window, big ones can't be
+    # much bigger compressed than not.
+    window = want + 64
+    while got < want:
+        chunk = buffer(map, ofs, window)
+        if not len(chunk):
+            raise git.GitError('truncated object at %d' % ofs)
+        ofs += len(chunk)
+        data = d.decompress(chunk, want - got)
+        result.append(data)
+        got += len(data)
+        if d.unconsumed_tail or d.unused_data:
+            break
+        window = 65536
+    if got != want:
+        raise git.GitError('object at %d inflates to %d bytes, not %d'
+                           % (ofs, got, want))
+    return ''.join(result)
+
+
+def _ofs_delta_base(map, ofs):
+    """Return the (negative) relative offset of an OFS_DELTA's base,
+    and the offset of the delta data."""
+    c = ord(map[ofs])
+    ofs += 1
+    rel = c & 0x7f
+    while c & 0x80:
+        c = ord(map[ofs])
+        ofs += 1
+        rel = ((rel + 1) << 7) | (c & 0x7f)
+    return rel, ofs
+
+
+def _delta_size(delta, i):
+    size = shift = 0
+    while True:
+        c = ord(delta[i])
+        i += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, i
+
+
+def apply_delta(base, delta):
+    """Return the result of applying the git delta to base."""
+    base_size, i = _delta_size(delta, 0)
+    if base_size != len(base):
+        raise git.GitError('delta expects a %d byte base, not %d'
+                           % (base_size, len(base)))
+    size, i = _delta_size(delta, i)
+    result = []
+    end = len(delta)
+    while i < end:
+        c = ord(delta[i])
+        i += 1
+        if c & 0x80:
+            cp_ofs = cp_size = 0
+            for bit, shift in ((0x01, 0), (0x02, 8), (0x04, 16), (0x08, 24)):
+                if c & bit:
+                    cp_ofs |= ord(delta[i]) << shift
+                    i += 1
+            for bit, shift in ((0x10, 0), (0x20, 8), (0x40, 16)):
+                if c & bit:
+                    cp_size |= ord(delta[i]) << shift
+                    i += 1
+            result.append(base[cp_ofs : cp_ofs + (cp_size or 0x10000)])
+        elif c:
+            result.append(delta[i : i + c])
+            i += c
+        else:
+            raise git.GitError('invalid delta opcode 0')
+    result = ''.join(result)
+    if len(result) != size:
+        raise git.GitError('delta produced %d bytes, not %d'
+                           % (len(result), size))
+    return result
+
+
+class PackReader:
+    """Read objects from the packs (or loose objects) in repo_dir."""
+    def __init__(self, repo_dir=None):
+        self.repo_dir = repo_dir or git.repo()
+        self.pack_dir = os.path.join(self.repo_dir, 'objects/pack')
+        self.idxlist = None
+        self._dir_mtime = None
+        self._idxes = {}
+        self._packs = OrderedDict()
+        self._bases = OrderedDict()
+
+    def close(self):
+        self.idxlist = None
+        self._idxes.clear()
+        for map in self._packs.itervalues():
+            map.close()
+        self._packs.clear()
+        self._bases.clear()
+
+    def _refresh(self):
+        # Only worth doing if packs have come or gone since last time
+        try:
+            mtime = xstat.stat(self.pack_dir).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        if self.idxlist and mtime == self._dir_mtime:
+            return False
+        self._dir_mtime = mtime
+        if self.idxlist:
+            self.idxlist.refresh()
+        else:
+            self.idxlist = git.PackIdxList(self.pack_dir, exclusive=False)
+        return True
+
+    def _pack_map(self, name):
+        map = self._packs.pop(name, None)
+        if not map:
+            map = mmap_read(open(os.path.join(self.pack_dir, name), 'rb'))
+            if len(self._packs) >= MAX_OPEN_PACKS:
+                self._packs.popitem(last=False)[1].close()
+        self._packs[name] = map
+        return map
+
+    def _find(self, oid):
+        # Return the name of the pack containing oid and its offset.
+        if not self.idxlist:
+            self._refresh()
+        source = self.idxlist and self.idxlist.exists(oid, want_source=True)
+        if not source and self._refresh():
+            source = self.idxlist.exists(oid, want_source=True)
+        if not source:
+            return None, None
+        ix = self._idxes.get(source)
+        if not ix:
+            ix = self._idxes[source] = \
+                git.open_idx(os.path.join(self.pack_dir, source))
+        return source[:-4] + '.pack', ix.find_offset(oid)
+
+    def _read_at(self, pack, ofs):
+        # Return the type and content of the object at ofs in pack.
+        map = self._pack_map(pack)
+        typ, size, pos = _parse_obj_header(map, ofs)
+        if typ == _OFS_DELTA:
+            rel, pos = _ofs_delta_base(map, pos)
+            base_type, base = self._read_base(pack, ofs - rel)
+        elif typ == _REF_DELTA:
+            base_oid = map[pos : pos + 20]
+            pos += 20
+            base_pack, base_ofs = self._find(base_oid)
+            if not base_pack:
+                raise git.GitError('%s: missing delta base %s'
+                                   % (pack, base_oid.encode('hex')))
+            base_type, base = self._read_base(base_pack, base_ofs)
+        else:
+            return git._typermap[typ], _inflate(map, pos, size)
+        map = self._pack_map(pack)
+        return base_type, apply_delta(base, _inflate(map, pos, size))
+
+    def _info_at(self, pack, ofs):
+        # Return the type and size of the object at ofs in pack.
+        map = self._pack_map(pack)
+        typ, size, pos = _parse_obj_header(map, ofs)
+        if typ == _OFS_DELTA:
+            rel, pos = _ofs_delta_base(map, pos)
+            base_type = self._info_at(pack, ofs - rel)[0]
+        elif typ == _REF_DELTA:
+            base_oid = map[pos : pos + 20]
+            pos += 20
+            base_pack, base_ofs = self._find(base_oid)
+            if not base_pack:
+                raise git.GitError('%s: missing delta base %s'
+                                   % (pack, base_oid.encode('hex')))
+            base_type = self._info_at(base_pack, base_ofs)[0]
+        else:
+            return git._typermap[typ], size
+        # The delta starts with the sizes of the base and the result
+        map = self._pack_map(pack)
+        delta = _inflate(map, pos, size, want=min(size, 20))
+        base_size, i = _delta_size(delta, 0)
+        return base_type, _delta_size(delta, i)[0]
+
+    def _read_base(self, pack, ofs):
+        # Delta chains tend to share bases, so keep the recent ones.
+        key = (pack, ofs)
+        found = self._bases.pop(key, None)
+        if not found:
+            found = self._read_at(pack, ofs)
+            if len(found[1]) > MAX_CACHED_BASE_SIZE:
+                return found
+            if len(self._bases) >= MAX_CACHED_BASES:
+                self._bases.popitem(last=False)
+        self._bases[key] = found
+        return found
+
+    def _read_loose(self, oid, info_only=False):
+        oidx = oid.encode('hex')
+        name = os.path.join(self.repo_dir, 'objects', oidx[:2], oidx[2:])
+        try:
+            with open(name, 'rb') as f:
+                if not info_only:
+                    return git._decode_looseobj(f.read())
+                # Just inflate the "<type> <size>\0" header
+                hdr = zlib.decompressobj().decompress(f.read(512), 64)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        hdr = hdr[:hdr.find('\0')].split(' ')
+        if len(hdr) != 2 or hdr[0] not in git._typemap:
+            raise git.GitError('%s: invalid object header' % name)
+        return hdr[0], int(hdr[1])
+
+    def _from_packs(self, oid, read_at):
+        try:
+            pack, ofs = self._find(oid)
+            if pack:
+                return read_at(pack, ofs)
+        except IOError as e:
+            # A pack that was removed (e.g. by gc) since we listed them
+            if e.errno != errno.ENOENT:
+                raise
+            self.close()
+        return None
+
+    def read(self, oid):
+        """Return the type and content of the object with the (binary)
+        id oid, or None if it's not in a pack or loose."""
+        return self._from_packs(oid, self._read_at) or self._read_loose(oid)
+
+    def read_info(self, oid):
+        """Return the type and size of the object with the (binary) id
+        oid, or None if it's not in a pack or loose, without reading
+        (much more than) the object's header."""
+        return self._from_packs(oid, self._info_at) \
+            or self._read_loose(oid, info_only=True)
+
+
+class StoredObjects:
+    """The objects in the pack for the open idx ix, as stored in the
+    pack, by their position in the idx."""
+    def __init__(self, ix, pack_name):
+        self.ix = ix
+        self.map = mmap_read(open(pack_name, 'rb'))
+        # An object ends where the next one in the pack starts, and
+        # the last one where the trailing pack checksum does.
+        self._starts = sorted(ix._ofs_from_idx(i) for i in xrange(len(ix)))
+        self._starts.append(len(self.map) - 20)
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+
+    def get(self, i):
+        """Return the data and crc32 of the object at position i in the
+        idx, or (None, None) if it's a delta (which can't be copied
+        without its base), or it doesn't match the idx's crc."""
+        ofs = self.ix._ofs_from_idx(i)
+        end = self._starts[bisect_right(self._starts, ofs)]
+        typ = _parse_obj_header(self.map, ofs)[0]
+        if typ in (_OFS_DELTA, _REF_DELTA):
+            return None, None
+        data = self.map[ofs:end]
+        crc = zlib.crc32(data) & 0xffffffff
+        want_crc = self.ix._crc_from_idx(i)
+        if want_crc is not None and crc != want_crc:
+            return None, None
+        return data, crc
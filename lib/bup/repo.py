@@ -1,14 +1,127 @@
 
+from collections import OrderedDict
 from functools import partial
+from io import BytesIO
+import threading
 
 from bup import client, git
+from bup.metadata import Metadata
 
 
-class LocalRepo:
-    def __init__(self, repo_dir=None):
+default_cache_size = 32 * 1024 * 1024
+
+
+class ObjectCache:
+    """A byte-bounded LRU cache of values decoded from repository
+    objects.  Since objects never change, nothing ever needs to be
+    invalidated."""
+    def __init__(self, max_size=None):
+        self.max_size = default_cache_size if max_size is None else max_size
+        self.size = 0
+        self.hits = self.misses = 0
+        self._items = OrderedDict() # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Return the value cached for key, or None."""
+        with self._lock:
+            found = self._items.pop(key, None)
+            if not found:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items[key] = found
+            return found[0]
+
+    def put(self, key, value, size):
+        """Cache value for key, counting it as (approximately) size
+        bytes."""
+        if size > self.max_size:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old:
+                self.size -= old[1]
+            self._items[key] = value, size
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._items.popitem(last=False)[1][1]
+
+
+def _read_bupm(data):
+    f = BytesIO(data)
+    records = []
+    while True:
+        try:
+            records.append(Metadata.read(f))
+        except EOFError:
+            return tuple(records)
+
+
+class _DecodedObjects:
+    """Decoded (and cached) access to the objects a repo's cat()
+    returns.  Only objects requested by (hex) id are cached, since
+    anything else (e.g. a branch name) might refer to something
+    different next time."""
+
+    def decoded(self, ref):
+        """Return (type, value) for the object ref refers to, or (None,
+        None) if it doesn't exist.  The value is a tuple of the
+        git.tree_decode() entries for a tree, a git.CommitInfo for a
+        commit, and the object's content for anything else.  Don't
+        modify the value; it may be shared."""
+        cacheable = git._hex_oid_rx.match(ref)
+        if cacheable:
+            found = self.cache.get(('object', ref))
+            if found:
+                return found
+        it = self.cat(ref)
+        _, typ, size = next(it)
+        data = ''.join(it)
+        if typ == 'tree':
+            value = tuple(git.tree_decode(data))
+            cost = size + 100 * len(value)
+        elif typ == 'commit':
+            value = git.parse_commit(data)
+            cost = size + 400
+        else:
+            return typ, (data if typ else None)
+        if cacheable:
+            self.cache.put(('object', ref), (typ, value), cost)
+        return typ, value
+
+    def bupm(self, ref):
+        """Return a tuple of the Metadata records (or None for empty
+        records) in the .bupm blob (or chunked tree) ref refers to.  As
+        with decoded(), the records may be shared, so don't modify
+        them."""
+        cacheable = git._hex_oid_rx.match(ref)
+        if cacheable:
+            found = self.cache.get(('bupm', ref))
+            if found is not None:
+                return found
+        data = ''.join(self.join(ref))
+        records = _read_bupm(data)
+        if cacheable:
+            self.cache.put(('bupm', ref), records,
+                           len(data) + 1000 * len(records))
+        return records
+
+
+class LocalRepo(_DecodedObjects):
+    def __init__(self, repo_dir=None, readers=None, cache_size=None):
+        """Objects are read via the repo_dir's git.cp_pool(), which will
+        keep at least readers (if given) CatPipes, so the repo can be
+        read from more than one thread at a time.  Up to cache_size
+        bytes (default_cache_size by default) of decoded objects are
+        cached; see decoded()."""
         self.repo_dir = repo_dir or git.repo()
-        self._cp = git.cp(repo_dir)
+        self._cp = git.cp_pool(repo_dir, size=readers)
         self.rev_list = partial(git.rev_list, repo_dir=repo_dir)
+        self.cache = ObjectCache(cache_size)
 
     def cat(self, ref):
         """If ref does not exist, yield (None, None, None).  Otherwise yield
@@ -24,6 +137,22 @@ class LocalRepo:
                 yield data
         assert not next(it, None)
 
+    def info(self, ref):
+        """Return (oidx, type, size) for ref, or (None, None, None) if it
+        does not exist, without reading the object's content."""
+        return self._cp.get_info(ref)
+
+    def cat_batch(self, refs, include_data=True):
+        """Yield (oidx, type, size, data_iter) for each of the refs, or
+        (None, None, None, None) for any that don't exist.  Each
+        data_iter must be finished with before the next item is
+        requested.  (A RemoteRepo can't be used for anything else until
+        the batch is done.)  Unless include_data is true, only the
+        types and sizes are read, and data_iter is always None.
+
+        """
+        return self._cp.get_many(refs, include_data=include_data)
+
     def join(self, ref):
         return self._cp.join(ref)
 
@@ -34,11 +163,12 @@ class LocalRepo:
                                  repo_dir=self.repo_dir):
             yield ref
 
-class RemoteRepo:
-    def __init__(self, address):
+class RemoteRepo(_DecodedObjects):
+    def __init__(self, address, cache_size=None):
         self.address = address
         self.client = client.Client(address)
         self.rev_list = self.client.rev_list
+        self.cache = ObjectCache(cache_size)
 
     def cat(self, ref):
         """If ref does not exist, yield (None, None, None).  Otherwise yield
@@ -58,6 +188,15 @@ class RemoteRepo:
                 yield data
         assert not next(items, None)
 
+    def info(self, ref):
+        """See LocalRepo.info()."""
+        info, = self.client.cat_batch((ref,), include_data=False)
+        return info[:3]
+
+    def cat_batch(self, refs, include_data=True):
+        """See LocalRepo.cat_batch()."""
+        return self.client.cat_batch(tuple(refs), include_data=include_data)
+
     def join(self, ref):
         return self.client.join(ref)
 
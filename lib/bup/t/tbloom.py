@@ -18,12 +18,15 @@ def test_bloom():
             ix = Idx()
             ix.name='dummy.idx'
             ix.shatable = ''.join(hashes)
-            for k in (4, 5):
-                b = bloom.create(tmpdir + '/pybuptest.bloom', expected=100, k=k)
+            for version, k in ((2, 4), (2, 5), (3, 4), (3, 5)):
+                b = bloom.create(tmpdir + '/pybuptest.bloom', expected=100, k=k,
+                                 version=version)
                 b.add_idx(ix)
-                WVPASSLT(b.pfalse_positive(), .1)
+                # Blocking costs v3 a bit of accuracy
+                WVPASSLT(b.pfalse_positive(), version == 2 and .1 or .2)
                 b.close()
                 b = bloom.ShaBloom(tmpdir + '/pybuptest.bloom')
+                WVPASSEQ(b.version, version)
                 all_present = True
                 for h in hashes:
                     all_present &= b.exists(h)
@@ -33,6 +36,9 @@ def test_bloom():
                     if b.exists(h):
                         false_positives += 1
                 WVPASSLT(false_positives, 5)
+                WVPASSEQ(b.exists_many(hashes), [True] * len(hashes))
+                others = [os.urandom(20) for i in range(1000)]
+                WVPASSEQ(b.exists_many(others), [b.exists(h) for h in others])
                 os.unlink(tmpdir + '/pybuptest.bloom')
 
             tf = tempfile.TemporaryFile(dir=tmpdir)
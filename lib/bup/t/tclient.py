@@ -141,6 +141,58 @@ def test_midx_refreshing():
             WVPASSEQ(len(pi.packs), 1)
 
 
+@wvtest
+def test_config_get():
+    with no_lingering_errors():
+        with test_tempdir('bup-tclient-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = '../../../bup'
+            os.environ['BUP_DIR'] = bupdir = tmpdir
+            git.init_repo(bupdir)
+            for name, value in (('bup.split.chunker', 'fastcdc'),
+                                ('remote.origin.url', 'secret')):
+                subprocess.check_call(['git', '--git-dir', bupdir,
+                                       'config', name, value])
+            c = client.Client(bupdir, create=True)
+            WVPASSEQ(c.config_get('bup.split.chunker'), 'fastcdc')
+            # Only the settings clients need are available
+            WVPASSEQ(c.config_get('remote.origin.url'), None)
+            c.close()
+
+
+@wvtest
+def test_cat_batch():
+    with no_lingering_errors():
+        with test_tempdir('bup-tclient-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = '../../../bup'
+            os.environ['BUP_DIR'] = bupdir = tmpdir
+            git.init_repo(bupdir)
+            lw = git.PackWriter()
+            blob = lw.new_blob(s1)
+            tree = lw.new_tree([(0100644, 'x', blob)])
+            lw.close()
+            c = client.Client(bupdir, create=True)
+            refs = (blob.encode('hex'), 'nonexistent',
+                    tree.encode('hex') + ':x')
+            WVPASSEQ([(oidx, typ, size, ''.join(it) if it else it)
+                      for oidx, typ, size, it in c.cat_batch(refs)],
+                     [(blob.encode('hex'), 'blob', 10000, s1),
+                      (None, None, None, None),
+                      (blob.encode('hex'), 'blob', 10000, s1)])
+            WVPASSEQ(list(c.cat_batch(refs, include_data=False)),
+                     [(blob.encode('hex'), 'blob', 10000, None),
+                      (None, None, None, None),
+                      (blob.encode('hex'), 'blob', 10000, None)])
+            # Servers without cat-batch-check send the content anyway
+            c._available_commands -= frozenset(('cat-batch-check',))
+            WVPASSEQ(list(c.cat_batch(refs, include_data=False)),
+                     [(blob.encode('hex'), 'blob', 10000, None),
+                      (None, None, None, None),
+                      (blob.encode('hex'), 'blob', 10000, None)])
+            WVPASSEQ([''.join(it) for oidx, typ, size, it
+                      in c.cat_batch(refs[:1])], [s1])
+            c.close()
+
+
 @wvtest
 def test_remote_parsing():
     with no_lingering_errors():
@@ -0,0 +1,60 @@
+
+from subprocess import check_call
+import glob, os, time
+
+from wvtest import *
+
+from bup import gc, git
+from buptest import no_lingering_errors, test_tempdir
+
+
+top_dir = os.path.realpath('../../..')
+bup_exe = top_dir + '/bup'
+
+
+def _all_objects(packdir):
+    r = git.PackIdxList(packdir, exclusive=False)
+    return set(str(sha) for sha in r)
+
+
+@wvtest
+def test_gc():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgc-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            packdir = git.repo('objects/pack')
+
+            w = git.PackWriter()
+            blobs = [w.new_blob('blob %d' % i) for i in range(10)]
+            tree = w.new_tree([(0100644, 'f%d' % i, blobs[i])
+                               for i in range(5)])
+            sub = w.new_tree([(040000, 'sub', tree)])
+            commit = w.new_commit(sub, None, 'x <x@x>', time.time(), 0,
+                                  'x <x@x>', time.time(), 0, 'msg')
+            w.close()
+            # Garbage, and copies of (live) objects in the first pack
+            w = git.PackWriter()
+            garbage = [w.new_blob('garbage %d' % i) for i in range(10)]
+            w.just_write(blobs[0], 'blob', 'blob 0')
+            w.close()
+            git.update_ref('refs/heads/master', commit, None)
+
+            live = gc.find_live_objects(len(_all_objects(packdir)), git.cp())
+            want = set(blobs[:5] + [tree, sub, commit])
+            WVPASSEQ(live.count, len(want))
+            WVPASS(all(oid in live for oid in want))
+            WVPASS(not any(oid in live for oid in blobs[5:] + garbage))
+            # Each object is only live in one of the packs
+            WVPASSEQ(sum(gc._live_count(b) for b in live.bitmaps.values()),
+                     len(want))
+            WVPASS(not live.add(tree))
+            live.close()
+
+            gc.bup_gc(threshold=10)
+            WVPASSEQ(_all_objects(packdir), want)
+            packs = glob.glob(packdir + '/*.pack')
+            WVPASSEQ(len(packs), 1)
+            # The copied objects are intact
+            check_call(['git', '--git-dir', bupdir, 'verify-pack', packs[0]])
@@ -1,10 +1,10 @@
 
 from subprocess import check_call
-import struct, os, time
+import fnmatch, struct, os, threading, time
 
 from wvtest import *
 
-from bup import git
+from bup import bloom, git, midx
 from bup.helpers import localtime, log, mkdirp, readpipe
 from buptest import no_lingering_errors, test_tempdir
 
@@ -125,6 +125,12 @@ def testpacks():
             WVPASS(r.exists(hashes[6]))
             WVFAIL(r.exists('\0'*20))
 
+            missing = ['\0'*20, '\xff'*20]
+            want = sorted(hashes + missing)
+            WVPASSEQ(r.exists_many(want),
+                     [None if h in missing else True for h in want])
+            WVPASSEQ(r.exists_many([]), [])
+
 
 @wvtest
 def test_pack_name_lookup():
@@ -147,10 +153,289 @@ def test_pack_name_lookup():
                 idxnames.append(os.path.basename(w.close() + '.idx'))
 
             r = git.PackIdxList(packdir)
-            WVPASSEQ(len(r.packs), 2)
+            # Three midxes of four packs each, and the last two packs
+            WVPASSEQ(len(r.packs), 5)
             for e,idxname in enumerate(idxnames):
                 for i in range(e*2, (e+1)*2):
                     WVPASSEQ(r.exists(hashes[i], want_source=True), idxname)
+            sources = dict((h, idxnames[i // 2]) for i, h in enumerate(hashes))
+            want = sorted(hashes + ['\0'*20])
+            WVPASSEQ(r.exists_many(want, want_source=True),
+                     [sources.get(h) for h in want])
+
+
+@wvtest
+def test_midx_search():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            packdir = git.repo('objects/pack')
+
+            sources = {}
+            for p in range(3):
+                w = git.PackWriter()
+                hashes = [w.new_blob('%d-%d' % (p, i)) for i in range(1000)]
+                idxname = os.path.basename(w.close() + '.idx')
+                sources.update((h, idxname) for h in hashes)
+            exc(bup_exe, 'midx', '-f', '--dir', packdir)
+            midxname = [f for f in os.listdir(packdir)
+                        if f.endswith('.midx')][0]
+            m = midx.PackMidx(os.path.join(packdir, midxname))
+            WVPASSEQ(len(m), len(sources))
+
+            others = [os.urandom(20) for i in range(1000)]
+            others += ['\0' * 20, '\xff' * 20]
+            try:
+                for native in (True, False):
+                    midx.native_search = native
+                    WVPASS(all(m.exists(h) for h in sources))
+                    WVPASS(all(m.exists(h, want_source=True) == sources[h]
+                               for h in sources))
+                    WVFAIL(any(m.exists(h) for h in others))
+            finally:
+                midx.native_search = True
+
+            # A plain exists() never reads the whichlist
+            whichlist = m.whichlist
+            m.whichlist = ''
+            WVPASS(all(m.exists(h) for h in sources))
+            WVFAIL(any(m.exists(h) for h in others))
+            WVEXCEPT(ValueError, m.exists, sources.keys()[0], want_source=True)
+            m.whichlist = whichlist
+
+
+@wvtest
+def test_midx_tiers():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            packdir = git.repo('objects/pack')
+
+            hashes = []
+            for p in range(40):
+                w = git.PackWriter()
+                for i in range(1 + p % 7):
+                    hashes.append(w.new_blob('%d-%d' % (p, i)))
+                w.close()
+                tiers = [midx._tier(count) for count, name
+                         in midx._unmerged_indexes(packdir)]
+                WVPASS(max(tiers.count(t) for t in tiers) < midx.TIER_FANIN)
+
+            r = git.PackIdxList(packdir)
+            WVPASSLT(len(r.packs), 40)
+            WVPASSEQ(len(r), len(hashes))
+            WVPASS(all(r.exists(h) for h in hashes))
+            exc(bup_exe, 'midx', '--check', '-a', '--dir', packdir)
+
+
+@wvtest
+def test_bloom_updates():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            packdir = git.repo('objects/pack')
+
+            hashes = []
+            idxnames = []
+            for p in range(6):
+                w = git.PackWriter()
+                hashes.extend(w.new_blob('%d-%d' % (p, i)) for i in range(50))
+                idxnames.append(os.path.basename(w.close() + '.idx'))
+                b = bloom.ShaBloom(packdir + '/bup.bloom')
+                WVPASSEQ(len(b), len(hashes))
+                WVPASSEQ(sorted(b.idxnames), sorted(idxnames))
+                WVPASS(all(b.exists(h) for h in hashes))
+                b.close()
+                r = git.PackIdxList(packdir)
+                WVPASS(r.bloom)
+                del r
+
+
+@wvtest
+def test_lazy_indexes():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            packdir = git.repo('objects/pack')
+
+            hashes = []
+            idxnames = []
+            for p in range(3):
+                w = git.PackWriter()
+                hashes.append([w.new_blob('%d-%d' % (p, i)) for i in range(10)])
+                idxnames.append(w.close() + '.idx')
+            old = time.time() - 60
+            os.utime(packdir, (old, old))
+
+            r = git.PackIdxList(packdir)
+            WVPASS(os.path.exists(packdir + '.manifest'))
+            WVPASSEQ(len(r.packs), 3)
+            WVPASSEQ(len(r), 30)
+            WVPASS(all(ix._ix is None for ix in r.packs))
+            # Ruled out by the bloom filter
+            WVPASSEQ(r.exists('\0' * 20), None)
+            WVPASS(all(ix._ix is None for ix in r.packs))
+            WVPASSEQ(r.exists(hashes[1][0], want_source=True),
+                     os.path.basename(idxnames[1]))
+            del r
+
+            # The next list comes from the manifest, without reading
+            # any of the indexes.
+            with open(idxnames[0], 'r+b') as f:
+                f.write('junk')
+            r = git.PackIdxList(packdir)
+            WVPASSEQ(len(r), 30)
+            del r
+            os.unlink(idxnames[0])
+            os.unlink(idxnames[0][:-4] + '.pack')
+
+            # A midx that disappears before it's opened is searched via
+            # its idxes instead.
+            ixs = [git.open_idx(name) for name in idxnames[1:]]
+            midx.write_midx(packdir + '/x.midx', ixs)
+            del ixs
+            r = git.PackIdxList(packdir)
+            WVPASSEQ(len(r.packs), 1)
+            os.unlink(packdir + '/x.midx')
+            WVPASS(r.exists(hashes[2][3]))
+            WVPASSEQ(r.exists_many(sorted(hashes[1])), [True] * 10)
+            WVPASSEQ(r.exists(hashes[0][0]), None)
+            del r
+
+
+@wvtest
+def test_compress_threads():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            blobs = [os.urandom(5000) for i in range(20)] \
+                    + ['x' * i for i in range(1, 50000, 997)]
+            def write_packs(bupdir, compress_threads):
+                os.environ['BUP_DIR'] = bupdir
+                git.init_repo(bupdir)
+                w = git.PackWriter(compression_level=9,
+                                   max_pack_objects=7,
+                                   compress_threads=compress_threads)
+                shas = []
+                for i, blob in enumerate(blobs + blobs[:5]):
+                    if i % 3:
+                        shas.append(w.new_blob(blob))
+                    else:
+                        shas.append(w.maybe_write_encoded(*w.encode_blob(blob)))
+                shas.append(w.new_tree([(0o100644, 'x', shas[0])]))
+                w.close()
+                packdir = bupdir + '/objects/pack'
+                packs = {}
+                for name in fnmatch.filter(os.listdir(packdir), 'pack-*'):
+                    with open(packdir + '/' + name, 'rb') as f:
+                        packs[name] = f.read()
+                return shas, packs
+            serial = write_packs(tmpdir + '/serial', 1)
+            threaded = write_packs(tmpdir + '/threaded', 4)
+            WVPASSEQ(threaded[0], serial[0])
+            WVPASSEQ(sorted(threaded[1].keys()), sorted(serial[1].keys()))
+            WVPASS(len(serial[1]) > 4)
+            WVPASS(threaded[1] == serial[1])
+
+
+@wvtest
+def test_background_finish():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            blobs = [str(i) * 100 for i in range(40)]
+            def write_packs(bupdir, background):
+                os.environ['BUP_DIR'] = bupdir
+                git.init_repo(bupdir)
+                finished = []
+                w = git.PackWriter(max_pack_objects=7,
+                                   on_pack_finish=finished.append,
+                                   background_finish=background)
+                for blob in blobs + blobs[-10:]:
+                    w.new_blob(blob)
+                WVPASS(w.exists(git.calc_hash('blob', blobs[-10])))
+                finished.append(w.close())
+                packs = {}
+                for name in fnmatch.filter(os.listdir(bupdir + '/objects/pack'),
+                                           'pack-*'):
+                    with open(bupdir + '/objects/pack/' + name, 'rb') as f:
+                        packs[name] = f.read()
+                return [os.path.basename(x) for x in finished], packs
+            serial = write_packs(tmpdir + '/serial', False)
+            background = write_packs(tmpdir + '/background', True)
+            WVPASSEQ(len(serial[0]), 7)
+            WVPASSEQ(background[0][:-1], serial[0][:-1])
+            WVPASSEQ(sorted(background[1].keys()), sorted(serial[1].keys()))
+            WVPASS(background[1] == serial[1])
+
+            os.environ['BUP_DIR'] = bupdir = tmpdir + '/broken'
+            git.init_repo(bupdir)
+            w = git.PackWriter(max_pack_objects=2, background_finish=True)
+            def broken_idx(filename, idx, packbin):
+                raise IOError('no room for the idx')
+            w._write_pack_idx_v2 = broken_idx
+            w.new_blob('1')
+            w.new_blob('2')
+            try:
+                w.close()
+            except IOError as ex:
+                WVPASSEQ(str(ex), 'no room for the idx')
+            else:
+                WVFAIL('close() reported the failure')
+            w.abort()
+
+
+@wvtest
+def test_adaptive_compression():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            noise = os.urandom(20000)
+            text = ' '.join(str(i) for i in xrange(5000))
+            WVFAIL(git._compressible(noise))
+            WVFAIL(git._compressible(noise[:100]))
+            WVPASS(git._compressible(text))
+            WVPASS(git._compressible(buffer(text)))
+
+            w = git.PackWriter(compression_level=9, adaptive_compression=True)
+            noise_sha = w.new_blob(noise)
+            text_sha = w.new_blob(text)
+            w.new_blob(noise)  # already present, so not probed again
+            WVPASSEQ(w.probed_bytes, len(noise) + len(text))
+            WVPASSEQ(w.stored_bytes, len(noise))
+            sha, (data, probed, stored) = w.encode_blob(noise)
+            WVPASS(len(data) > len(noise))
+            WVPASSEQ((probed, stored), (len(noise), len(noise)))
+            sha, (data, probed, stored) = w.encode_blob(text)
+            WVPASS(len(data) < len(text) // 2)
+            WVPASSEQ((probed, stored), (len(text), 0))
+            # Only what's written is counted
+            WVPASSEQ(w.maybe_write_encoded(*w.encode_blob(noise)), noise_sha)
+            WVPASSEQ(w.probed_bytes, len(noise) + len(text))
+            text2 = text + ' more'
+            w.maybe_write_encoded(*w.encode_blob(text2))
+            WVPASSEQ(w.probed_bytes, len(noise) + len(text) + len(text2))
+            WVPASSEQ(w.stored_bytes, len(noise))
+            w.close()
+            WVPASSEQ(readpipe(['git', '--git-dir', bupdir, 'cat-file',
+                               'blob', noise_sha.encode('hex')]), noise)
+            WVPASSEQ(readpipe(['git', '--git-dir', bupdir, 'cat-file',
+                               'blob', text_sha.encode('hex')]), text)
+
+            w = git.PackWriter(compression_level=0, adaptive_compression=True)
+            w.new_blob(os.urandom(100))
+            WVPASSEQ((w.probed_bytes, w.stored_bytes), (0, 0))
+            w.abort()
 
 
 @wvtest
@@ -169,10 +454,10 @@ def test_long_index():
                     0x22334455, 0x66778899, 0x00112233, 0x44556677, 0x88990011)
             pack_bin = struct.pack('!IIIII',
                     0x99887766, 0x55443322, 0x11009988, 0x77665544, 0x33221100)
-            idx = list(list() for i in xrange(256))
-            idx[0].append((obj_bin, 1, 0xfffffffff))
-            idx[0x11].append((obj2_bin, 2, 0xffffffffff))
-            idx[0x22].append((obj3_bin, 3, 0xff))
+            idx = git._IdxRecords()
+            idx.add(obj2_bin, 2, 0xffffffffff)
+            idx.add(obj3_bin, 3, 0xff)
+            idx.add(obj_bin, 1, 0xfffffffff)
             w.count = 3
             name = tmpdir + '/tmp.idx'
             r = w._write_pack_idx_v2(name, idx, pack_bin)
@@ -180,6 +465,7 @@ def test_long_index():
             WVPASSEQ(i.find_offset(obj_bin), 0xfffffffff)
             WVPASSEQ(i.find_offset(obj2_bin), 0xffffffffff)
             WVPASSEQ(i.find_offset(obj3_bin), 0xff)
+            WVPASSEQ([str(sha) for sha in i], [obj_bin, obj2_bin, obj3_bin])
 
 
 @wvtest
@@ -441,3 +727,104 @@ def test_cat_pipe():
             for buf in it.next():
                 pass
             WVPASSEQ((oidx, typ, size), get_info)
+
+
+@wvtest
+def test_cat_pipe_get_many():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            w = git.PackWriter()
+            datas = [str(i) * i for i in range(300)]
+            blobs = [w.new_blob(data) for data in datas]
+            tree = w.new_tree([(0100644, '%03d' % i, blob)
+                               for i, blob in enumerate(blobs)])
+            w.close()
+            treex = tree.encode('hex')
+            # By name, so it's up to git, and more than fit in a window
+            refs = ['%s:%03d' % (treex, i) for i in range(300)]
+            # Mixed with some it isn't, and some that don't exist
+            refs[10:10] = [blobs[7].encode('hex'), 'nonexistent',
+                           blobs[0].encode('hex')]
+            cp = git.CatPipe(bupdir)
+            got = [(oidx, typ, size, it and ''.join(it))
+                   for oidx, typ, size, it in cp.get_many(iter(refs))]
+            expected = [(blob.encode('hex'), 'blob', len(data), data)
+                        for data, blob in zip(datas, blobs)]
+            expected[10:10] = [expected[7], (None, None, None, None),
+                               expected[0]]
+            WVPASSEQ(len(got), len(expected))
+            WVPASS(got == expected)
+            WVPASS(not cp.inprogress)
+
+            # Types and sizes alone
+            WVPASS(list(cp.get_many(refs, include_data=False))
+                   == [x[:3] + (None,) for x in expected])
+            WVPASSEQ(cp.get_info(refs[301]), expected[301][:3])
+            WVPASSEQ(cp.get_info(refs[11]), (None, None, None))
+            WVPASSEQ(cp.get_info(refs[12]), expected[12][:3])
+
+            # Items left unread are skipped
+            items = cp.get_many(refs[:20])
+            WVPASSEQ(len(list(items)), 20)
+
+            # And abandoning a batch doesn't leave git out of step
+            items = cp.get_many(refs)
+            WVPASSEQ(next(items)[:3], (blobs[0].encode('hex'), 'blob', 0))
+            items.close()
+            WVPASS(not cp.inprogress)
+            WVPASSEQ(''.join(list(cp.get(refs[5]))[1:]), '5' * 5)
+
+            # walk_object() batches its reads
+            walked = [item.oid for item in git.walk_object(cp, treex)]
+            WVPASSEQ(sorted(walked), sorted([tree] + blobs))
+
+
+@wvtest
+def test_cat_pipe_pool():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            w = git.PackWriter()
+            datas = ['%d' % i * 100 for i in range(100)]
+            blobs = [w.new_blob(data) for data in datas]
+            tree = w.new_tree([(0100644, '%03d' % i, blob)
+                               for i, blob in enumerate(blobs)])
+            w.close()
+            pool = git.CatPipePool(bupdir, size=2)
+            # Read by id (from the packs) and by name (via git)
+            refs = [blob.encode('hex') for blob in blobs] \
+                   + ['%s:%03d' % (tree.encode('hex'), i) for i in range(100)]
+            results = []
+            def read_all():
+                results.append([''.join(list(pool.get(ref))[1:])
+                                for ref in refs])
+            threads = [threading.Thread(target=read_all) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            WVPASSEQ(len(results), 8)
+            WVPASS(all(r == datas + datas for r in results))
+            WVPASS(len(pool._idle) <= 2)
+
+            # Nested reads in one thread get readers of their own
+            outer = pool.get(refs[100])
+            next(outer)
+            for i in range(3):
+                WVPASSEQ(list(pool.get(refs[1]))[1:], [datas[1]])
+            WVPASSEQ(list(outer), [datas[0]])
+            WVPASS(len(pool._idle) <= 2)
+
+            # An abandoned read doesn't leave its reader out of step
+            it = pool.get(refs[101])
+            next(it)
+            it.close()
+            WVPASS(all(not cp.inprogress for cp in pool._idle))
+            WVPASSEQ(list(pool.get(refs[102]))[1:], [datas[2]])
+            pool.close()
+            WVPASSEQ(pool._idle, [])
@@ -1,9 +1,10 @@
+import os
 from io import BytesIO
 
 from wvtest import *
 
 from bup import hashsplit, _helpers, helpers
-from buptest import no_lingering_errors
+from buptest import no_lingering_errors, test_tempdir
 
 
 def nr_regions(x, max_count=None):
@@ -82,11 +83,136 @@ def test_uncache_ours_upto():
             hashsplit._fadvise_pages_done = orig_pages_done
 
 
+@wvtest
+def test_buf():
+    with no_lingering_errors():
+        b = hashsplit.Buf()
+        WVPASSEQ(b.used(), 0)
+        b.put('abcdef')
+        WVPASSEQ(str(b.peek(3)), 'abc')
+        WVPASSEQ(str(b.get(2)), 'ab')
+        b.eat(1)
+        WVPASSEQ(b.used(), 3)
+        cap = len(b.data)
+        # The unconsumed tail moves to the front instead of the array growing
+        b.put('gh')
+        WVPASSEQ(str(b.peek(b.used())), 'defgh')
+        WVPASSEQ(len(b.data), cap)
+        WVPASSEQ(str(b.fill(BytesIO('ijklmnop'), 4)), 'ijkl')
+        WVPASSEQ(str(b.get(100)), 'defghijkl')
+        WVPASSEQ(b.used(), 0)
+        # Files without readinto() are read() and put()
+        class ReadOnly:
+            def __init__(self, data):
+                self.f = BytesIO(data)
+            def read(self, size):
+                return self.f.read(size)
+        WVPASSEQ(str(b.fill(ReadOnly('qrs'), 10)), 'qrs')
+        WVPASSEQ(str(b.fill(ReadOnly(''), 10)), '')
+        WVPASSEQ(str(b.get(b.used())), 'qrs')
+
+
 @wvtest
 def test_rolling_sums():
     with no_lingering_errors():
         WVPASS(_helpers.selftest())
 
+
+@wvtest
+def test_splitbuf_all():
+    with no_lingering_errors():
+        data = os.urandom(1000000)
+        for max_blob in (8192*4, 1000):
+            expected = []
+            pos = 0
+            while 1:
+                ofs, bits = _helpers.splitbuf(buffer(data, pos))
+                if not ofs:
+                    break
+                if ofs > max_blob:
+                    ofs, bits = max_blob, 0
+                expected.append((ofs, bits))
+                pos += ofs
+            WVPASS(len(expected) > 1)
+            WVPASSEQ(_helpers.splitbuf_all(data, max_blob), expected)
+        WVPASSEQ(_helpers.splitbuf_all('', 10), [])
+        WVEXCEPT(ValueError, _helpers.splitbuf_all, data, 0)
+
+@wvtest
+def test_fastcdc():
+    with no_lingering_errors():
+        data = os.urandom(1000000)
+        splits = _helpers.splitbuf_all(data, 1 << 30, 'fastcdc')
+        WVPASS(len(splits) > 50)
+        WVPASS(min(ofs for ofs, bits in splits) > 2048)
+        WVPASS(min(bits for ofs, bits in splits) >= _helpers.blobbits())
+        WVEXCEPT(ValueError, _helpers.splitbuf_all, data, 10, 'nope')
+
+        def chunks(data):
+            return [str(b) for b, level in
+                    hashsplit.hashsplit_iter([BytesIO(data)], False, None)]
+        old_chunker = hashsplit.chunker
+        hashsplit.chunker = 'fastcdc'
+        try:
+            a = chunks(data)
+            b = chunks('xyz' + data)
+        finally:
+            hashsplit.chunker = old_chunker
+        WVPASSEQ(''.join(a), data)
+        WVPASSEQ(''.join(b), 'xyz' + data)
+        # Inserting bytes at the start only changes the first chunk
+        WVPASSEQ(a[1:], b[1:])
+        WVPASSNE(a, chunks(data))
+
+
+@wvtest
+def test_chunker_from_config():
+    with no_lingering_errors():
+        WVPASSEQ(hashsplit.chunker_from_config(None), 'rollsum')
+        WVPASSEQ(hashsplit.chunker_from_config('rollsum\n'), 'rollsum')
+        WVPASSEQ(hashsplit.chunker_from_config('fastcdc\n'), 'fastcdc')
+        WVEXCEPT(ValueError, hashsplit.chunker_from_config, 'gear')
+
+
+@wvtest
+def test_sparse_split():
+    with no_lingering_errors(), test_tempdir('bup-thashsplit-') as tmpdir:
+        mb = 1024 * 1024
+        name = tmpdir + '/sparse'
+        f = open(name, 'wb')
+        content = []
+        for size, data in ((100, True), (5 * mb + 7, False), (70000, True),
+                           (2 * mb, False), (3, True), (3 * mb + 5, False)):
+            if data:
+                content.append(os.urandom(size))
+                f.write(content[-1])
+            else:
+                content.append('\0' * size)
+                f.seek(size, 1)
+        f.truncate()
+        f.close()
+        content = ''.join(content)
+        old_chunker = hashsplit.chunker
+        try:
+            for chunker in hashsplit.CHUNKERS:
+                hashsplit.chunker = chunker
+                split = lambda f: [(str(b), l) for b, l in
+                                   hashsplit.hashsplit_iter([f], False, None)]
+                WVPASSEQ(split(open(name, 'rb')), split(BytesIO(content)))
+        finally:
+            hashsplit.chunker = old_chunker
+        # Each distinct zero chunk is only handed to makeblob() once.
+        blobs = []
+        def makeblob(blob):
+            blobs.append(str(blob))
+            return len(blobs)
+        shas = [sha for sha, size, level in
+                hashsplit.split_to_blobs(makeblob, [open(name, 'rb')],
+                                         False, None)]
+        WVPASSEQ(''.join(blobs[i - 1] for i in shas), content)
+        WVPASS(len(blobs) < len(shas) - 100)
+
+
 @wvtest
 def test_fanout_behaviour():
 
@@ -101,9 +227,21 @@ def test_fanout_behaviour():
                 return ofs, ord(c)
         return 0, 0
 
+    def splitbuf_all(buf, max_blob, chunker):
+        result = []
+        pos = 0
+        while 1:
+            ofs, bits = splitbuf(buffer(buf, pos))
+            if not ofs:
+                return result
+            if ofs > max_blob:
+                ofs, bits = max_blob, 0
+            result.append((ofs, bits))
+            pos += ofs
+
     with no_lingering_errors():
-        old_splitbuf = _helpers.splitbuf
-        _helpers.splitbuf = splitbuf
+        old_splitbuf_all = _helpers.splitbuf_all
+        _helpers.splitbuf_all = splitbuf_all
         old_BLOB_MAX = hashsplit.BLOB_MAX
         hashsplit.BLOB_MAX = 4
         old_BLOB_READ_SIZE = hashsplit.BLOB_READ_SIZE
@@ -129,7 +267,90 @@ def test_fanout_behaviour():
         WVPASSEQ(levels(split_many),
             [(1, 1), (4, 2), (4, 0), (1, 0), (4, 0), (1, 5), (1, 0)])
 
-        _helpers.splitbuf = old_splitbuf
+        _helpers.splitbuf_all = old_splitbuf_all
         hashsplit.BLOB_MAX = old_BLOB_MAX
         hashsplit.BLOB_READ_SIZE = old_BLOB_READ_SIZE
         hashsplit.fanout = old_fanout
+
+
+@wvtest
+def test_split_pool():
+    with no_lingering_errors():
+        data = ''.join(chr((i * 7 + i / 301) & 0xff) for i in xrange(300000))
+        def split_serially(content):
+            objs = []
+            def makeblob(blob):
+                objs.append(('blob', str(blob)))
+                return str(blob)[:20].ljust(20, '\0')
+            def maketree(shalist):
+                objs.append(('tree', shalist))
+                return str(len(objs)).ljust(20, '\0')
+            result = hashsplit.split_to_blob_or_tree(makeblob, maketree,
+                                                     [BytesIO(content)],
+                                                     keep_boundaries=False)
+            return result, objs
+
+        def split_in_pool(pool, content):
+            objs = []
+            def write_encoded(encoded):
+                for sha, data in encoded:
+                    objs.append(('blob', data))
+                    yield sha
+            def makeblob(blob):
+                objs.append(('blob', str(blob)))
+                return str(blob)[:20].ljust(20, '\0')
+            def maketree(shalist):
+                objs.append(('tree', shalist))
+                return str(len(objs)).ljust(20, '\0')
+            job = pool.submit(BytesIO(content))
+            result = hashsplit.encoded_to_blob_or_tree(write_encoded,
+                                                       makeblob, maketree,
+                                                       job)
+            return result, objs
+
+        encode = lambda blob: (str(blob)[:20].ljust(20, '\0'), str(blob))
+        pool = hashsplit.SplitPool(encode, 3, queue_size=2)
+        try:
+            for content in ('', 'x', data):
+                WVPASSEQ(split_in_pool(pool, content),
+                         split_serially(content))
+            jobs = [pool.submit(BytesIO(data)) for i in range(4)]
+            jobs[0].cancel()
+            WVPASSEQ(''.join(x[3] for x in jobs[1]), data)
+            jobs[2].cancel()
+            WVPASSEQ(''.join(x[3] for x in jobs[3]), data)
+        finally:
+            pool.close()
+
+
+@wvtest
+def test_prefetcher():
+    with no_lingering_errors():
+        with test_tempdir('bup-thashsplit-') as tmpdir:
+            paths = []
+            for i in range(3):
+                path = '%s/f%d' % (tmpdir, i)
+                with open(path, 'wb') as f:
+                    f.write('x' * 50000)
+                paths.append(path)
+            pfr = hashsplit.Prefetcher(80000, max_files=2)
+            try:
+                WVPASS(pfr.has_room())
+                a = pfr.prefetch(paths[0], 50000)
+                WVPASS(pfr.has_room())
+                b = pfr.prefetch(paths[1], 50000)
+                WVPASSEQ((pfr.nbytes, pfr.nfiles), (100000, 2))
+                WVFAIL(pfr.has_room())
+                pfr.done(a)
+                WVPASS(pfr.has_room())
+                c = pfr.prefetch(tmpdir + '/missing', 50000)
+                WVFAIL(pfr.has_room())
+                pfr.done(b)
+                pfr.done(c)
+                big = pfr.prefetch(paths[2], 1 << 30)
+                WVPASSEQ(pfr.nbytes, 80000)
+                pfr.done(big)
+                WVPASSEQ((pfr.nbytes, pfr.nfiles), (0, 0))
+            finally:
+                pfr.close()
+            WVPASSEQ(pfr.nfiles, 0)
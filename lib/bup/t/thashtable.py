@@ -0,0 +1,132 @@
+
+import os, subprocess
+
+from wvtest import *
+
+from bup import git, hashtable
+from buptest import no_lingering_errors, test_tempdir
+
+
+top_dir = os.path.realpath('../../..')
+bup_exe = top_dir + '/bup'
+
+
+@wvtest
+def test_hashtable():
+    with no_lingering_errors():
+        with test_tempdir('bup-thashtable-') as tmpdir:
+            hashes = [os.urandom(20) for i in range(2000)]
+            class Idx:
+                pass
+            ix = Idx()
+            ix.name = 'dummy.idx'
+            ix.shatable = ''.join(hashes)
+            name = tmpdir + '/pybuptest.hashtable'
+            t = hashtable.create(name, expected=2000)
+            WVPASSEQ(t.bits, 12)
+            t.add_idx(ix)
+            t.add(hashes[0] + '\0' * 20)  # already there, and a free slot
+            WVPASSEQ(len(t), 2000)
+            t.close()
+
+            t = hashtable.ShaHashTable(name)
+            WVPASS(t.valid())
+            WVPASSEQ(len(t), 2000)
+            WVPASSEQ(t.idxnames, ['dummy.idx'])
+            WVPASS(all(t.exists(h) for h in hashes))
+            others = [os.urandom(20) for i in range(1000)]
+            WVPASS(not any(t.exists(h) for h in others))
+            WVPASS(all(t.exists_many(hashes)))
+            WVPASS(not any(t.exists_many(others)))
+            WVPASS(not t.exists('\0' * 20))
+
+            # A table can be refilled from another's slots
+            t2 = hashtable.create(name + '2.hashtable', expected=4000)
+            t2.add(t.slots())
+            WVPASSEQ(len(t2), 2000)
+            WVPASS(all(t2.exists(h) for h in hashes))
+            t2.close()
+
+
+@wvtest
+def test_hashtable_updates():
+    with no_lingering_errors():
+        with test_tempdir('bup-thashtable-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            packdir = git.repo('objects/pack')
+
+            def write_pack(p, n):
+                w = git.PackWriter()
+                shas = [w.new_blob('%d-%d' % (p, i)) for i in range(n)]
+                return w.close() + '.idx', shas
+
+            idx0, shas0 = write_pack(0, 100)
+            # Only updated once it exists
+            WVPASS(not os.path.exists(packdir + '/bup.hashtable'))
+            r = git.HashedPackIdxList(packdir)
+            WVPASS(r.table)
+            WVPASSEQ(r.uncovered, [])
+            WVPASSEQ(r.table.idxnames, [os.path.basename(idx0)])
+            WVPASS(all([r.exists(sha) for sha in shas0]))
+            WVPASSEQ(r.exists(shas0[0], want_source=True),
+                     os.path.basename(idx0))
+            del r
+
+            # Big enough to need a bigger table
+            idx1, shas1 = write_pack(1, 1000)
+            t = hashtable.ShaHashTable(packdir + '/bup.hashtable')
+            WVPASSEQ(sorted(t.idxnames),
+                     sorted(os.path.basename(n) for n in (idx0, idx1)))
+            WVPASSEQ(len(t), 1100)
+            WVPASS(t.load() <= hashtable.MAX_LOAD)
+            t.close()
+
+            # A pack the table doesn't cover is searched directly, and
+            # added by the next refresh.
+            git.auto_midx(packdir, [])  # (i.e. no change)
+            idx2, shas2 = write_pack(2, 10)
+            t = hashtable.ShaHashTable(packdir + '/bup.hashtable',
+                                       readwrite=True)
+            t.idxnames.remove(os.path.basename(idx2))
+            t.close()
+            r = git.HashedPackIdxList(packdir)
+            WVPASSEQ(r.uncovered, [])
+            WVPASS(all(r.exists_many(sorted(shas2 + shas1))))
+            WVPASSEQ(r.exists('\0' * 20), None)
+            del r
+
+            # Removed packs are dropped from the table
+            os.unlink(idx1)
+            os.unlink(idx1[:-4] + '.pack')
+            r = git.HashedPackIdxList(packdir)
+            WVPASSEQ(len(r.table), 110)
+            WVPASS(not any(r.exists_many(sorted(shas1))))
+            WVPASS(all(r.exists_many(sorted(shas0 + shas2))))
+            del r
+
+
+@wvtest
+def test_hashtable_v1_idx():
+    with no_lingering_errors():
+        with test_tempdir('bup-thashtable-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            packdir = git.repo('objects/pack')
+            w = git.PackWriter(run_midx=False)
+            shas = [w.new_blob('%d' % i) for i in range(100)]
+            idx = w.close() + '.idx'
+            os.unlink(idx)
+            subprocess.check_call(['git', 'index-pack', '--index-version=1',
+                                   '-o', idx, idx[:-4] + '.pack'],
+                                  stdout=open(os.devnull, 'w'))
+            ix = git.open_idx(idx)
+            WVPASS(isinstance(ix, git.PackIdxV1))
+            del ix
+            WVPASS(hashtable.update(packdir, [idx], create_missing=True))
+            t = hashtable.ShaHashTable(packdir + '/bup.hashtable')
+            WVPASSEQ(len(t), 100)
+            WVPASS(all(t.exists_many(shas)))
+            t.close()
@@ -0,0 +1,137 @@
+
+from subprocess import PIPE, Popen, check_call
+import glob, os, random
+
+from wvtest import *
+
+from bup import git, packread
+from bup.helpers import readpipe
+from buptest import no_lingering_errors, test_tempdir
+
+
+top_dir = os.path.realpath('../../..')
+bup_exe = top_dir + '/bup'
+
+
+def _git(bupdir, *args):
+    return ['git', '--git-dir', bupdir] + list(args)
+
+
+def _objects(bupdir):
+    out = readpipe(_git(bupdir, 'cat-file', '--batch-all-objects',
+                        '--batch-check'))
+    return [line.split(' ')[:2] for line in out.splitlines()]
+
+
+def _check_all(bupdir):
+    r = packread.PackReader(bupdir)
+    objs = _objects(bupdir)
+    WVPASS(objs)
+    ok = True
+    for oidx, typ in objs:
+        want = readpipe(_git(bupdir, 'cat-file', typ, oidx))
+        ok &= r.read(oidx.decode('hex')) == (typ, want)
+        ok &= r.read_info(oidx.decode('hex')) == (typ, len(want))
+    WVPASS(ok)
+    WVPASSEQ(r.read('\0' * 20), None)
+    WVPASSEQ(r.read_info('\0' * 20), None)
+    r.close()
+
+
+def _check_stored(bupdir):
+    # The non-delta objects come back as stored, and the rest as None
+    packdir = bupdir + '/objects/pack'
+    for name in glob.glob(packdir + '/*.idx'):
+        ix = git.open_idx(name)
+        stored = packread.StoredObjects(ix, name[:-3] + 'pack')
+        ok = True
+        copied = 0
+        for i in xrange(len(ix)):
+            oidx = ix._idx_to_hash(i).encode('hex')
+            data, crc = stored.get(i)
+            if data is None:
+                continue
+            copied += 1
+            typ, content = git._decode_packobj(data)
+            ok &= content == readpipe(_git(bupdir, 'cat-file', typ, oidx))
+            ok &= crc == ix._crc_from_idx(i)
+        stored.close()
+        WVPASS(ok)
+        WVPASS(0 < copied < len(ix))
+
+
+@wvtest
+def test_foreign_packs():
+    with no_lingering_errors():
+        with test_tempdir('bup-tpackread-') as tmpdir:
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            rnd = random.Random(42)
+            words = [str(rnd.random()) for i in range(2000)]
+            src = tmpdir + '/src'
+            # Similar files, so that git will store most as deltas
+            for i in range(20):
+                words[rnd.randrange(len(words))] = 'changed %d' % i
+                with open(src, 'w') as f:
+                    f.write('\n'.join(words))
+                check_call(_git(bupdir, 'hash-object', '-w', src))
+            oids = '\n'.join(oidx for oidx, typ in _objects(bupdir)) + '\n'
+            packdir = bupdir + '/objects/pack'
+            for delta_opt in ('--delta-base-offset', '--no-delta-base-offset'):
+                p = Popen(_git(bupdir, 'pack-objects', '-q', '--depth=5',
+                               delta_opt, tmpdir + '/pack'),
+                          stdin=PIPE, stdout=PIPE)
+                packsha = p.communicate(oids)[0].strip()
+                WVPASSEQ(p.returncode, 0)
+                for name in os.listdir(packdir):
+                    os.unlink(packdir + '/' + name)
+                for ext in ('.pack', '.idx'):
+                    os.rename('%s/pack-%s%s' % (tmpdir, packsha, ext),
+                              '%s/pack-%s%s' % (packdir, packsha, ext))
+                check_call(_git(bupdir, 'prune-packed'))
+                verify = readpipe(_git(bupdir, 'verify-pack', '-v',
+                                       '%s/pack-%s.idx' % (packdir, packsha)))
+                WVPASS('chain length' in verify)
+                _check_all(bupdir)
+                _check_stored(bupdir)
+
+            # And loose objects
+            with open(src, 'w') as f:
+                f.write('loose')
+            loose = readpipe(_git(bupdir, 'hash-object', '-w', src)).strip()
+            WVPASS(os.path.exists('%s/objects/%s/%s'
+                                  % (bupdir, loose[:2], loose[2:])))
+            _check_all(bupdir)
+
+
+@wvtest
+def test_cat_pipe():
+    with no_lingering_errors():
+        with test_tempdir('bup-tpackread-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            w = git.PackWriter()
+            blob = w.new_blob('x' * 100000)
+            empty = w.new_blob('')
+            tree = w.new_tree([(0100644, 'x', blob), (0100644, 'y', empty)])
+            w.close()
+            cp = git.CatPipe(bupdir)
+            WVPASSEQ(list(cp.get(blob.encode('hex'))),
+                     [(blob.encode('hex'), 'blob', 100000), 'x' * 100000])
+            WVPASSEQ(list(cp.get(empty.encode('hex'))),
+                     [(empty.encode('hex'), 'blob', 0)])
+            WVPASS(cp.reader)
+            WVPASS(not cp.p)  # Didn't need git
+            WVPASSEQ(''.join(cp.join(tree.encode('hex'))), 'x' * 100000)
+            # Anything else is still up to git
+            WVPASSEQ(''.join(list(cp.get(tree.encode('hex') + ':x'))[1:]),
+                     'x' * 100000)
+            WVPASSEQ(list(cp.get('1' * 40)), [(None, None, None)])
+
+            # Packs written after the reader was opened are found too
+            w = git.PackWriter()
+            blob2 = w.new_blob('y')
+            w.close()
+            WVPASSEQ(list(cp.get(blob2.encode('hex'))),
+                     [(blob2.encode('hex'), 'blob', 1), 'y'])
@@ -13,7 +13,7 @@ from bup import git, metadata, vfs2 as vfs
 from bup.git import BUP_CHUNKED
 from bup.helpers import exc, exo, shstr
 from bup.metadata import Metadata
-from bup.repo import LocalRepo
+from bup.repo import LocalRepo, ObjectCache
 from buptest import no_lingering_errors, test_tempdir
 
 top_dir = '../../..'
@@ -373,4 +373,67 @@ def test_contents_with_mismatched_bupm_git_ordering():
             name, item = next(((n, i) for n, i in contents if n == 'foo.'))
             wvpass(S_ISREG(item.meta.mode))
 
+@wvtest
+def test_repo_cache():
+    with no_lingering_errors():
+        with test_tempdir('bup-tvfs-') as tmpdir:
+            bup_dir = tmpdir + '/bup'
+            environ['GIT_DIR'] = bup_dir
+            environ['BUP_DIR'] = bup_dir
+            git.repodir = bup_dir
+            data_path = tmpdir + '/src'
+            os.makedirs(data_path + '/dir/sub')
+            with open(data_path + '/dir/sub/file', 'w+') as tmpfile:
+                tmpfile.write(b'canary\n')
+            ex((bup_path, 'init'))
+            ex((bup_path, 'index', '-v', data_path))
+            ex((bup_path, 'save', '-tvvn', 'test', '--strip', data_path))
+
+            repo = LocalRepo()
+            res = vfs.resolve(repo, '/test/latest/dir/sub/file')
+            wvpasseq('file', res[-1][0])
+            misses = repo.cache.misses
+            wvpass(misses)
+            wvpass(len(repo.cache))
+            # Nothing has to be read (or decoded) again
+            wvpasseq(res, vfs.resolve(repo, '/test/latest/dir/sub/file'))
+            wvpasseq(misses, repo.cache.misses)
+            wvpass(repo.cache.hits)
+            wvpass(repo.cache.size <= repo.cache.max_size)
+
+            # The cached .bupm records aren't modified
+            file_item = res[-1][1]
+            size = file_item.meta.size
+            wvpasseq(7, vfs.augment_item_meta(repo, file_item,
+                                              include_size=True).meta.size)
+            wvpasseq(size, file_item.meta.size)
+            wvpasseq(res, vfs.resolve(repo, '/test/latest/dir/sub/file'))
+
+            # A short .bupm is an error, not a short listing
+            sub_oid = res[-2][1].oid
+            tree_ents, bupm_oid = vfs._tree_data_and_bupm(repo, sub_oid)
+            records = repo.bupm(bupm_oid.encode('hex'))
+            wvpasseq(2, len(records))
+            wvexcept(EOFError, list,
+                     vfs.tree_items(sub_oid, tree_ents,
+                                    bupm=iter(records[:1])))
+
+            # And without a cache, the answers are the same
+            uncached = LocalRepo(cache_size=0)
+            wvpasseq(res, vfs.resolve(uncached, '/test/latest/dir/sub/file'))
+            wvpasseq(0, len(uncached.cache))
+
+            cache = ObjectCache(max_size=10)
+            cache.put('a', 1, 4)
+            cache.put('b', 2, 4)
+            wvpasseq(1, cache.get('a'))
+            cache.put('c', 3, 4) # evicts b, the least recently used
+            wvpasseq(None, cache.get('b'))
+            wvpasseq(1, cache.get('a'))
+            wvpasseq(3, cache.get('c'))
+            wvpasseq(8, cache.size)
+            cache.put('d', 4, 11) # too big to cache at all
+            wvpasseq(None, cache.get('d'))
+            wvpasseq((3, 2), (cache.hits, cache.misses))
+
 # FIXME: add tests for the want_meta=False cases.
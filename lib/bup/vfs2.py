@@ -45,15 +45,16 @@ S_ISDIR(item_mode(item)) refers to a tree.
 
 from __future__ import print_function
 from collections import namedtuple
+from copy import copy
 from errno import ELOOP, ENOENT, ENOTDIR
-from itertools import chain, dropwhile, izip
+from itertools import chain, dropwhile, islice, izip
 from stat import S_IFDIR, S_IFLNK, S_IFREG, S_ISDIR, S_ISLNK, S_ISREG
 from time import localtime, strftime
 import exceptions, re, sys
 
 from bup import client, git, metadata
 from bup.git import BUP_CHUNKED, cp, get_commit_items, parse_commit, tree_decode
-from bup.helpers import debug2, last
+from bup.helpers import debug2
 from bup.metadata import Metadata
 from bup.repo import LocalRepo, RemoteRepo
 
@@ -82,37 +83,46 @@ def _default_mode_for_gitmode(gitmode):
 
 def _normal_or_chunked_file_size(repo, oid):
     """Return the size of the normal or chunked file indicated by oid."""
-    # FIXME: --batch-format CatPipe?
-    it = repo.cat(oid.encode('hex'))
-    _, obj_t, size = next(it)
+    oidx = oid.encode('hex')
     ofs = 0
-    while obj_t == 'tree':
-        mode, name, last_oid = last(tree_decode(''.join(it)))
+    while True:
+        _, obj_t, size = repo.info(oidx)
+        if obj_t != 'tree':
+            return ofs + size
+        mode, name, last_oid = repo.decoded(oidx)[1][-1]
         ofs += int(name, 16)
-        it = repo.cat(last_oid.encode('hex'))
-        _, obj_t, size = next(it)
-    return ofs + sum(len(b) for b in it)
+        oidx = last_oid.encode('hex')
+
+_max_chunk_batch = 16
 
 def _tree_chunks(repo, tree, startofs):
     "Tree should be a sequence of (name, mode, hash) as per tree_decode()."
     assert(startofs >= 0)
     # name is the chunk's hex offset in the original file
     tree = dropwhile(lambda (_1, name, _2): int(name, 16) < startofs, tree)
-    for mode, name, oid in tree:
-        ofs = int(name, 16)
-        skipmore = startofs - ofs
-        if skipmore < 0:
-            skipmore = 0
-        it = repo.cat(oid.encode('hex'))
-        _, obj_t, size = next(it)
-        data = ''.join(it)            
-        if S_ISDIR(mode):
-            assert obj_t == 'tree'
-            for b in _tree_chunks(repo, tree_decode(data), skipmore):
-                yield b
-        else:
-            assert obj_t == 'blob'
-            yield data[skipmore:]
+    # Fetch the chunks in batches that grow as the file is read, and
+    # finish each batch before recursing, since the repo can only
+    # handle one at a time.
+    batch_size = 1
+    while True:
+        batch = tuple(islice(tree, batch_size))
+        if not batch:
+            break
+        batch_size = min(batch_size * 2, _max_chunk_batch)
+        found = [(obj_t, ''.join(it)) for _, obj_t, _, it
+                 in repo.cat_batch([oid.encode('hex') for _, _, oid in batch])]
+        for (mode, name, oid), (obj_t, data) in izip(batch, found):
+            ofs = int(name, 16)
+            skipmore = startofs - ofs
+            if skipmore < 0:
+                skipmore = 0
+            if S_ISDIR(mode):
+                assert obj_t == 'tree'
+                for b in _tree_chunks(repo, tree_decode(data), skipmore):
+                    yield b
+            else:
+                assert obj_t == 'blob'
+                yield data[skipmore:]
 
 class _ChunkReader:
     def __init__(self, repo, oid, startofs):
@@ -232,50 +242,53 @@ def item_mode(item):
         return m.mode
     return m
 
+def _next_meta(bupm):
+    # Like Metadata.read(), raise EOFError if there's nothing left,
+    # since a StopIteration would just quietly end tree_items().
+    for m in bupm:
+        return m
+    raise EOFError('unexpected end of .bupm')
+
 def _read_dir_meta(bupm):
     # This is because save writes unmodified Metadata() entries for
     # fake parents -- test-save-strip-graft.sh demonstrates.
-    m = Metadata.read(bupm)
+    m = _next_meta(bupm)
     if not m:
         return default_dir_mode
     assert m.mode is not None
     if m.size is None:
+        m = copy(m)  # The records from repo.bupm() may be shared
         m.size = 0
     return m
 
 def _tree_data_and_bupm(repo, oid):
-    """Return (tree_bytes, bupm_oid) where bupm_oid will be None if the
-    tree has no metadata (i.e. older bup save, or non-bup tree).
+    """Return (tree_entries, bupm_oid) where tree_entries are as per
+    repo.decoded(), and bupm_oid will be None if the tree has no
+    metadata (i.e. older bup save, or non-bup tree).
 
     """    
     assert len(oid) == 20
-    it = repo.cat(oid.encode('hex'))
-    _, item_t, size = next(it)
-    data = ''.join(it)
+    item_t, value = repo.decoded(oid.encode('hex'))
     if item_t == 'commit':
-        commit = parse_commit(data)
-        it = repo.cat(commit.tree)
-        _, item_t, size = next(it)
-        data = ''.join(it)
+        item_t, value = repo.decoded(value.tree)
         assert item_t == 'tree'
     elif item_t != 'tree':
         raise Exception('%r is not a tree or commit' % oid.encode('hex'))
-    for _, mangled_name, sub_oid in tree_decode(data):
+    for _, mangled_name, sub_oid in value:
         if mangled_name == '.bupm':
-            return data, sub_oid
+            return value, sub_oid
         if mangled_name > '.bupm':
             break
-    return data, None
+    return value, None
 
 def _find_dir_item_metadata(repo, item):
     """Return the metadata for the tree or commit item, or None if the
     tree has no metadata (i.e. older bup save, or non-bup tree).
 
     """
-    tree_data, bupm_oid = _tree_data_and_bupm(repo, item.oid)
+    tree_ents, bupm_oid = _tree_data_and_bupm(repo, item.oid)
     if bupm_oid:
-        with _FileReader(repo, bupm_oid) as meta_stream:
-            return _read_dir_meta(meta_stream)
+        return _read_dir_meta(iter(repo.bupm(bupm_oid.encode('hex'))))
     return None
 
 def _readlink(repo, oid):
@@ -319,7 +332,8 @@ def augment_item_meta(repo, item, include_size=False):
     currently a mode, replace it with a compatible "fake" Metadata
     instance.  If include_size is true, ensure item.meta.size is
     correct, computing it if needed.  If item.meta is a Metadata
-    instance, this call may modify it in place or replace it.
+    instance, this call may replace it, but won't modify it (it may be
+    shared, cf. repo.bupm()).
 
     """
     # If we actually had parallelism, we'd need locking...
@@ -327,6 +341,7 @@ def augment_item_meta(repo, item, include_size=False):
     m = item.meta
     if isinstance(m, Metadata):
         if include_size and m.size is None:
+            m = copy(m)
             m.size = _compute_item_size(repo, item)
             return item._replace(meta=m)
         return item
@@ -350,11 +365,9 @@ def _commit_meta_from_auth_sec(author_sec):
     return m
 
 def _commit_meta_from_oidx(repo, oidx):
-    it = repo.cat(oidx)
-    _, typ, size = next(it)
+    typ, commit = repo.decoded(oidx)
     assert typ == 'commit'
-    author_sec = parse_commit(''.join(it)).author_sec
-    return _commit_meta_from_auth_sec(author_sec)
+    return _commit_meta_from_auth_sec(commit.author_sec)
 
 def parse_rev_auth_secs(f):
     tree, author_secs = f.readline().split(None, 2)
@@ -399,9 +412,9 @@ def root_items(repo, names=None):
         yield ref, RevList(meta=_commit_meta_from_auth_sec(commit.author_sec),
                            oid=oidx.decode('hex'))
 
-def ordered_tree_entries(tree_data, bupm=None):
-    """Yields (name, mangled_name, kind, gitmode, oid) for each item in
-    tree, sorted by name.
+def ordered_tree_entries(tree_ents, bupm=None):
+    """Yields (name, mangled_name, kind, gitmode, oid) for each of the
+    tree_ents (as per repo.decoded()), sorted by name.
 
     """
     # Sadly, the .bupm entries currently aren't in git tree order,
@@ -414,17 +427,20 @@ def ordered_tree_entries(tree_data, bupm=None):
         name, kind = git.demangle_name(mangled_name, gitmode)
         return name, mangled_name, kind, gitmode, oid
 
-    tree_ents = (result_from_tree_entry(x) for x in tree_decode(tree_data))
+    results = (result_from_tree_entry(x) for x in tree_ents)
     if bupm:
-        tree_ents = sorted(tree_ents, key=lambda x: x[0])
-    for ent in tree_ents:
+        results = sorted(results, key=lambda x: x[0])
+    for ent in results:
         yield ent
     
-def tree_items(oid, tree_data, names=frozenset(tuple()), bupm=None):
+def tree_items(oid, tree_ents, names=frozenset(tuple()), bupm=None):
+    """Yield (name, item) for the tree_ents (as per repo.decoded()).
+    If the tree has a .bupm, bupm must be an iterator over its records
+    (see repo.bupm())."""
 
     def tree_item(ent_oid, kind, gitmode):
         if kind == BUP_CHUNKED:
-            meta = Metadata.read(bupm) if bupm else default_file_mode
+            meta = _next_meta(bupm) if bupm else default_file_mode
             return Chunky(oid=ent_oid, meta=meta)
 
         if S_ISDIR(gitmode):
@@ -432,14 +448,14 @@ def tree_items(oid, tree_data, names=frozenset(tuple()), bupm=None):
             return Item(meta=default_dir_mode, oid=ent_oid)
 
         return Item(oid=ent_oid,
-                    meta=(Metadata.read(bupm) if bupm \
+                    meta=(_next_meta(bupm) if bupm \
                           else _default_mode_for_gitmode(gitmode)))
 
     assert len(oid) == 20
     if not names:
         dot_meta = _read_dir_meta(bupm) if bupm else default_dir_mode
         yield '.', Item(oid=oid, meta=dot_meta)
-        tree_entries = ordered_tree_entries(tree_data, bupm)
+        tree_entries = ordered_tree_entries(tree_ents, bupm)
         for name, mangled_name, kind, gitmode, ent_oid in tree_entries:
             if mangled_name == '.bupm':
                 continue
@@ -463,7 +479,7 @@ def tree_items(oid, tree_data, names=frozenset(tuple()), bupm=None):
             return
         remaining -= 1
 
-    tree_entries = ordered_tree_entries(tree_data, bupm)
+    tree_entries = ordered_tree_entries(tree_ents, bupm)
     for name, mangled_name, kind, gitmode, ent_oid in tree_entries:
         if mangled_name == '.bupm':
             continue
@@ -476,26 +492,26 @@ def tree_items(oid, tree_data, names=frozenset(tuple()), bupm=None):
                 if name > last_name:
                     break  # given bupm sort order, we're finished
             if (kind == BUP_CHUNKED or not S_ISDIR(gitmode)) and bupm:
-                Metadata.read(bupm)
+                _next_meta(bupm)
             continue
         yield name, tree_item(ent_oid, kind, gitmode)
         if remaining == 1:
             break
         remaining -= 1
 
-def tree_items_with_meta(repo, oid, tree_data, names):
+def tree_items_with_meta(repo, oid, tree_ents, names):
     # For now, the .bupm order doesn't quite match git's, and we don't
     # load the tree data incrementally anyway, so we just work in RAM
-    # via tree_data.
+    # via tree_ents.
     assert len(oid) == 20
     bupm = None
-    for _, mangled_name, sub_oid in tree_decode(tree_data):
+    for _, mangled_name, sub_oid in tree_ents:
         if mangled_name == '.bupm':
-            bupm = _FileReader(repo, sub_oid)
+            bupm = iter(repo.bupm(sub_oid.encode('hex')))
             break
         if mangled_name > '.bupm':
             break
-    for item in tree_items(oid, tree_data, names, bupm):
+    for item in tree_items(oid, tree_ents, names, bupm):
         yield item
 
 _save_name_rx = re.compile(r'^\d\d\d\d-\d\d-\d\d-\d{6}$')
@@ -552,14 +568,11 @@ def tags_items(repo, names):
     def tag_item(oid):
         assert len(oid) == 20
         oidx = oid.encode('hex')
-        it = repo.cat(oidx)
-        _, typ, size = next(it)
+        typ, value = repo.decoded(oidx)
         if typ == 'commit':
-            tree_oid = parse_commit(''.join(it)).tree.decode('hex')
-            assert len(tree_oid) == 20
             # FIXME: more efficient/bulk?
-            return RevList(meta=_commit_meta_from_oidx(repo, oidx), oid=oid)
-        for _ in it: pass
+            return RevList(meta=_commit_meta_from_auth_sec(value.author_sec),
+                           oid=oid)
         if typ == 'blob':
             return Item(meta=default_file_mode, oid=oid)
         elif typ == 'tree':
@@ -623,28 +636,19 @@ def contents(repo, item, names=None, want_meta=True):
     assert S_ISDIR(item_mode(item))
     item_t = type(item)
     if item_t == Item:
-        it = repo.cat(item.oid.encode('hex'))
-        _, obj_type, size = next(it)
-        data = ''.join(it)
+        obj_type, value = repo.decoded(item.oid.encode('hex'))
         if obj_type == 'tree':
-            if want_meta:
-                item_gen = tree_items_with_meta(repo, item.oid, data, names)
-            else:
-                item_gen = tree_items(item.oid, data, names)
+            tree_oid, tree_ents = item.oid, value
         elif obj_type == 'commit':
-            tree_oidx = parse_commit(data).tree
-            it = repo.cat(tree_oidx)
-            _, obj_type, size = next(it)
+            tree_oid = value.tree.decode('hex')
+            obj_type, tree_ents = repo.decoded(value.tree)
             assert obj_type == 'tree'
-            tree_data = ''.join(it)
-            if want_meta:
-                item_gen = tree_items_with_meta(repo, tree_oidx.decode('hex'),
-                                                tree_data, names)
-            else:
-                item_gen = tree_items(tree_oidx.decode('hex'), tree_data, names)
         else:
-            for _ in it: pass
             raise Exception('unexpected git ' + obj_type)
+        if want_meta:
+            item_gen = tree_items_with_meta(repo, tree_oid, tree_ents, names)
+        else:
+            item_gen = tree_items(tree_oid, tree_ents, names)
     elif item_t == RevList:
         item_gen = revlist_items(repo, item.oid, names)
     elif item_t == Root:
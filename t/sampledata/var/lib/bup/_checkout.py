@@ -0,0 +1,3 @@
+COMMIT='ed26c626125619a154cd714df02b8cbf3bc3fac5'
+NAMES='(tag: ed26c62)'
+DATE='2026-10-16 20:12:41 +0000'
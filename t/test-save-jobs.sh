@@ -0,0 +1,75 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+. t/lib.sh || exit $?
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+
+bup() { "$top/bup" "$@"; }
+
+WVPASS cd "$tmpdir"
+
+WVPASS mkdir src
+WVPASS cp -pPR "$top/t/sampledata" src/
+WVPASS bup random 3M > src/big
+WVPASS bup random 100k > src/small
+WVPASS touch src/empty
+WVPASS bup random 50k > src/sparse
+WVPASS dd if=/dev/zero of=src/sparse seek=$((5 * 1024 * 1024)) bs=1 count=1 \
+    conv=notrunc
+
+WVSTART 'save -j'
+export BUP_DIR="$tmpdir/serial"
+WVPASS bup init
+WVPASS bup index src
+serial_tree="$(WVPASS bup save -t --strip src)" || exit $?
+serial_packs="$(WVPASS ls "$BUP_DIR/objects/pack/" | grep -v midx)" || exit $?
+
+export BUP_DIR="$tmpdir/parallel"
+WVPASS bup init
+WVPASS bup index src
+parallel_tree="$(WVPASS bup save -j 4 -t --strip src)" || exit $?
+parallel_packs="$(WVPASS ls "$BUP_DIR/objects/pack/" | grep -v midx)" || exit $?
+
+WVPASSEQ "$parallel_tree" "$serial_tree"
+WVPASSEQ "$parallel_packs" "$serial_packs"
+
+WVSTART 'save --prefetch'
+export BUP_DIR="$tmpdir/prefetch"
+WVPASS bup init
+WVPASS bup index src
+prefetch_tree="$(WVPASS bup save --prefetch=1M -t --strip src)" || exit $?
+WVPASSEQ "$prefetch_tree" "$serial_tree"
+prefetch_tree="$(WVPASS bup save -j 4 --prefetch=1M -t --strip src)" || exit $?
+WVPASSEQ "$prefetch_tree" "$serial_tree"
+
+export BUP_DIR="$tmpdir/parallel"
+
+for pack in $serial_packs; do
+    WVPASS cmp "$tmpdir/serial/objects/pack/$pack" \
+        "$tmpdir/parallel/objects/pack/$pack"
+done
+
+WVPASS bup save -j 4 -n src --strip src
+WVPASS bup restore -C restore /src/latest/big /src/latest/small \
+    /src/latest/sparse
+WVPASS cmp src/big restore/big
+WVPASS cmp src/small restore/small
+WVPASS cmp src/sparse restore/sparse
+
+WVFAIL bup save -j 0 -t src
+
+WVSTART 'save -j --adaptive-compression'
+export BUP_DIR="$tmpdir/adaptive"
+WVPASS bup init
+WVPASS bup index src
+WVPASS bup save -j 4 -v --adaptive-compression -n src --strip src 2> stats
+WVPASS grep -E 'Stored [0-9]+/[1-9][0-9]*k of blob data uncompressed' stats
+# Nothing new is written the second time, so nothing's counted
+WVPASS bup index --fake-invalid src
+WVPASS bup save -j 4 -v --adaptive-compression -n src --strip src 2> stats
+WVPASS grep -F 'Stored 0/0k of blob data uncompressed' stats
+
+WVPASS rm -rf "$tmpdir"
@@ -0,0 +1,49 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+. t/lib.sh || exit $?
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+
+bup() { "$top/bup" "$@"; }
+
+WVPASS cd "$tmpdir"
+
+WVPASS bup random 2M > data
+
+WVSTART 'split with the rollsum and fastcdc chunkers'
+export BUP_DIR="$tmpdir/rollsum"
+WVPASS bup init
+WVPASS bup split -b data > rollsum-ids
+
+export BUP_DIR="$tmpdir/fastcdc"
+WVPASS bup init
+WVPASS git --git-dir="$BUP_DIR" config bup.split.chunker fastcdc
+WVPASS bup split -b data > fastcdc-ids
+WVFAIL cmp rollsum-ids fastcdc-ids
+WVPASS bup split -n data data
+WVPASS bup join data > joined
+WVPASS cmp data joined
+
+WVSTART 'remote split uses the remote chunker'
+WVPASS bup split -r ":$tmpdir/rollsum" -b data > remote-rollsum-ids
+WVPASS cmp rollsum-ids remote-rollsum-ids
+WVPASS env BUP_DIR="$tmpdir/rollsum" "$top/bup" split -r ":$tmpdir/fastcdc" -b data \
+    > remote-fastcdc-ids
+WVPASS cmp fastcdc-ids remote-fastcdc-ids
+
+WVSTART 'split --noop --bench'
+WVPASS bup split --noop --bench data 2> bench
+WVPASS grep -E '^bup: rollsum: .* MB/s, [0-9]+ chunks' bench
+WVPASS grep -E '^bup: fastcdc: .* MB/s, [0-9]+ chunks' bench
+
+WVSTART 'unknown chunker'
+WVPASS git --git-dir="$BUP_DIR" config bup.split.chunker nope
+WVFAIL bup split -b data
+WVPASS mkdir src
+WVPASS bup index src
+WVFAIL bup save -n src src
+
+WVPASS rm -rf "$tmpdir"
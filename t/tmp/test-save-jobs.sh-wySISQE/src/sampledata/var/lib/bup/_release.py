@@ -0,0 +1,7 @@
+
+# This will be automatically populated by git via export-subst.
+# cf. ./.gitattributes
+
+COMMIT='$Format:%H$'
+NAMES='$Format:%d$'
+DATE='$Format:%ci$'